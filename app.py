@@ -27,8 +27,11 @@ from flask import Flask, request, render_template, session, redirect, jsonify, m
 from flask_assets import Environment, Bundle
 
 from config import CONF
-from db import DB, is_spotify_rate_limited, set_spotify_rate_limit, handle_spotify_exception
-from nests import pubsub_channel, NestManager, refresh_member_ttl, member_key, members_key
+from db import DB, is_spotify_rate_limited, set_spotify_rate_limit, handle_spotify_exception, BULK_ADD_MAX_SONGS
+from nests import pubsub_channel, NestManager, refresh_member_ttl, members_key, active_member_count
+from playlist_cache import playlist_cache
+from frame_meter import position_frames
+from player_pool import player_assignments
 import analytics
 import slack
 
@@ -80,6 +83,25 @@ def _check_rate_limit(r, email, action, limit, window=3600):
         r.expire(key, window)
     return count <= limit
 
+# Songs one user may queue per hour, singly or in bulk
+ADD_SONG_LIMIT = 50
+
+
+def _bulk_add_allowance(r, email):
+    """How many songs a bulk add by *email* may queue under the 'add_song' limit."""
+    used = int(r.get(f'RATE|add_song|{email}') or 0)
+    cap = getattr(CONF, 'BULK_ADD_MAX_SONGS', None) or BULK_ADD_MAX_SONGS
+    return max(min(ADD_SONG_LIMIT - used, cap), 0)
+
+
+def _charge_rate_limit(r, email, action, count, window=3600):
+    """Count *count* uses of *action* against the same bucket as _check_rate_limit."""
+    if count <= 0:
+        return
+    key = f'RATE|{action}|{email}'
+    if r.incrby(key, count) == count:
+        r.expire(key, window)
+
 def _parse_session_cookie():
     """Parse the session cookie manually when Flask's session isn't available."""
     from itsdangerous import URLSafeTimedSerializer, BadSignature
@@ -289,6 +311,10 @@ class WebSocketManager(object):
         msg = '1' + json.dumps(args)
         self._ws.send(msg)
 
+    def send_frame(self, msg):
+        """Send a frame that was already encoded (e.g. shared via playlist_cache)."""
+        self._ws.send(msg)
+
     def serve(self):
         try:
             while True:
@@ -348,6 +374,9 @@ class MusicNamespace(WebSocketManager):
         self.email = email
         self.penalty = penalty
         self.nest_id = nest_id
+        # Queue version this client last received; diffs are only sent on top of it
+        self.queue_diffs = False
+        self._sent_version = None
         # Create a per-nest DB instance
         self.db = DB(init_history_to_redis=False, nest_id=nest_id)
         self.auth = spotipy.oauth2.SpotifyOAuth(CONF.SPOTIFY_CLIENT_ID, CONF.SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI,
@@ -358,6 +387,7 @@ class MusicNamespace(WebSocketManager):
                 nest_manager.join_nest(nest_id, email)
             except Exception:
                 logger.exception('Failed to join nest %s', nest_id)
+        self._frame_token = position_frames.connect()
         self.spawn(self.listener)
         self.log('New namespace for {0} (nest={1})'.format(self.email, self.nest_id))
         _log_action('ws_connect', self.email, nest=self.nest_id)
@@ -365,6 +395,7 @@ class MusicNamespace(WebSocketManager):
 
     def _on_disconnect(self):
         """Leave nest on WebSocket disconnect."""
+        position_frames.disconnect(self._frame_token)
         _log_action('ws_disconnect', self.email, nest=self.nest_id)
         analytics.track(self.db._r, 'ws_disconnect', self.email)
         if nest_manager:
@@ -372,25 +403,26 @@ class MusicNamespace(WebSocketManager):
                 nest_manager.leave_nest(self.nest_id, self.email)
             except Exception:
                 logger.exception('Failed to leave nest %s', self.nest_id)
-        # Delete member TTL key
-        try:
-            mk = member_key(self.nest_id, self.email)
-            self.db._r.delete(mk)
-        except Exception:
-            pass
         # Remove from MEMBERS set
         try:
             mkey = members_key(self.nest_id)
-            self.db._r.srem(mkey, self.email)
+            self.db._r.zrem(mkey, self.email)
         except Exception:
             pass
 
+    def _heartbeat(self):
+        """Refresh this member's heartbeat, resuming the nest if it hibernated."""
+        if nest_manager:
+            nest_manager.heartbeat(self.nest_id, self.email)
+        else:
+            refresh_member_ttl(self.db._r, self.nest_id, self.email, 90)
+
     def serve(self):
         """Override serve to add membership heartbeat TTL refresh."""
         import time as _time
         # Initial heartbeat on connect
         try:
-            refresh_member_ttl(self.db._r, self.nest_id, self.email, 90)
+            self._heartbeat()
         except Exception:
             logger.exception('Failed initial heartbeat for %s', self.email)
 
@@ -405,7 +437,7 @@ class MusicNamespace(WebSocketManager):
                 now = _time.time()
                 if now - last_heartbeat >= 30:
                     try:
-                        refresh_member_ttl(self.db._r, self.nest_id, self.email, 90)
+                        self._heartbeat()
                     except Exception:
                         logger.exception('Failed heartbeat for %s', self.email)
                     last_heartbeat = now
@@ -454,15 +486,15 @@ class MusicNamespace(WebSocketManager):
             msg = m['data']
 
             if msg == 'playlist_update':
-                self.on_fetch_playlist()
+                self._push_playlist()
             elif msg == 'now_playing_update':
                 self.on_fetch_now_playing()
-                self.on_fetch_playlist()
+                self._push_playlist()
             elif msg.startswith('pp|'):
-                #self.log('sending position update to {0}'.format(self.email))
-                _, src, track, pos = msg.split('|', 3)
-#                logger.debug(session['spotify_token'])
-                self.emit('player_position', src, track, int(pos))
+                frame = _position_frame(msg)
+                self.emit('player_position', frame['src'], frame['trackid'], frame['pos'],
+                          frame['started'], frame['paused'])
+                position_frames.sent()
             elif msg.startswith('v|'):
                 _, vol = msg.split('|', 1)
                 self.emit('volume', vol)
@@ -526,8 +558,8 @@ class MusicNamespace(WebSocketManager):
 
     def on_add_song(self, song_id, src):
         logger.info('on_add_song called: song_id=%s, src=%s, email=%s', song_id, src, self.email)
-        if not _check_rate_limit(self.db._r, self.email, 'add_song', 50):
-            self.emit('error', {'message': 'Rate limit reached — max 50 songs/hour'})
+        if not _check_rate_limit(self.db._r, self.email, 'add_song', ADD_SONG_LIMIT):
+            self.emit('error', {'message': 'Rate limit reached — max %d songs/hour' % ADD_SONG_LIMIT})
             return
         result = None
         if src == 'spotify':
@@ -545,8 +577,50 @@ class MusicNamespace(WebSocketManager):
         if result not in (None, False):
             analytics.track(self.db._r, 'song_add', self.email)
 
+    def on_add_songs(self, uris):
+        """Bulk add: a list of track URIs, or a Spotify album/playlist URI."""
+        if isinstance(uris, str):
+            uris = [uris]
+        logger.info('on_add_songs called: %d uri(s), email=%s', len(uris or []), self.email)
+        allowed = _bulk_add_allowance(self.db._r, self.email)
+        if not allowed:
+            self.emit('error', {'message': 'Rate limit reached — max %d songs/hour' % ADD_SONG_LIMIT})
+            return
+        if not _check_rate_limit(self.db._r, self.email, 'add_songs', 10):
+            self.emit('error', {'message': 'Rate limit reached — max 10 bulk adds/hour'})
+            return
+        # Every queued song counts toward the per-song limit
+        ids = self._safe_db_call(self.db.add_songs, self.email, uris or [],
+                                 penalty=self.penalty, limit=allowed)
+        if ids:
+            _charge_rate_limit(self.db._r, self.email, 'add_song', len(ids))
+            analytics.track(self.db._r, 'song_add', self.email)
+
+    def on_enable_queue_diffs(self):
+        """Client can apply playlist_diff events (see playlist_cache.queue_diff)."""
+        self.queue_diffs = True
+
     def on_fetch_playlist(self):
-        self.emit('playlist_update', self.db.get_queued())
+        self._send_playlist(playlist_cache.get(self.db))
+
+    def _send_playlist(self, snapshot):
+        self.send_frame(snapshot.encoded(
+            'ws', lambda queue: '1' + json.dumps(['playlist_update', queue, snapshot.version])))
+        self._sent_version = snapshot.version
+
+    def _push_playlist(self):
+        """Send what changed since the last playlist this client received."""
+        snapshot = playlist_cache.get(self.db)
+        if snapshot.version == self._sent_version:
+            return
+        if (self.queue_diffs and self._sent_version is not None
+                and snapshot.base_version == self._sent_version):
+            frame = snapshot.encoded('ws-diff', lambda queue: _ws_diff_frame(snapshot))
+            if frame:
+                self.send_frame(frame)
+                self._sent_version = snapshot.version
+                return
+        self._send_playlist(snapshot)
 
     def on_fetch_now_playing(self):
         self.emit('now_playing_update', self.db.get_now_playing())
@@ -586,7 +660,7 @@ class MusicNamespace(WebSocketManager):
 
     def on_vote(self, id, up):
         self.log('Vote from {0} on {1} {2}'.format(self.email, id, up))
-        if self._safe_db_call(self.db.vote, self.email, id, up) not in (None, False):
+        if self._safe_db_call(self.db.vote, self.email, id, up) is not None:
             analytics.track(self.db._r, 'vote', self.email)
 
     def on_kill(self, id):
@@ -754,6 +828,13 @@ class MusicNamespace(WebSocketManager):
             logger.error("SoundCloud stream error for track %s: %s", track_id, e)
             self.emit('soundcloud_stream_error', {'error': 'Failed to get stream URL', 'track_id': track_id})
 
+def _ws_diff_frame(snapshot):
+    diff = snapshot.diff()
+    if diff is None:
+        return False
+    return '1' + json.dumps(['playlist_diff', diff])
+
+
 class VolumeNamespace(WebSocketManager):
     def log(self, msg, debug=True):
         if debug:
@@ -1106,13 +1187,13 @@ def playing():
 
 @app.route('/queue/')
 def queue():
-    queue = d.get_queued()
+    queue = playlist_cache.get(d).queue
     return jsonify(queue=[{k: x.get(k, '') for k in USEFUL_PROPS} for x in queue])
 
 
 @app.route('/queue/<int:id>')
 def queue_specific(id):
-    queue = d.get_queued()
+    queue = playlist_cache.get(d).queue
     for q in queue:
         x = q
         if x.get("id") == str(id):
@@ -1178,9 +1259,9 @@ def jam():
     email = g.auth_email
     app.logger.debug('Jam {0}, {1}'.format(email, id))
     _log_action('jam', email, song_id=id)
-    d.jam(id, email)
+    result = d.jam(id, email)
 
-    resp = jsonify({"success": True})
+    resp = jsonify(dict(success=True, **result))
     resp.status_code = 200
 
     return resp
@@ -1708,8 +1789,8 @@ def api_queue_vote():
         up = up.lower() in ('true', '1', 'yes')
     else:
         up = bool(up)
-    d.vote(API_EMAIL, song_id, up)
-    return jsonify(ok=True)
+    rank = d.vote(API_EMAIL, song_id, up)
+    return jsonify(ok=True, rank=rank)
 
 
 @app.route('/api/queue/pause', methods=['POST'])
@@ -1748,6 +1829,30 @@ def api_add_song():
     return jsonify(error='Failed to add song'), 500
 
 
+@app.route('/api/add_songs', methods=['POST'])
+@require_api_token
+def api_add_songs():
+    from flask import g
+    body = request.get_json(silent=True) or {}
+    uris = body.get('uris')
+    if isinstance(uris, str):
+        uris = [uris]
+    if not uris or not isinstance(uris, list):
+        return jsonify(error='Missing required field: uris'), 400
+    email = getattr(g, 'auth_email', API_EMAIL)
+    allowed = _bulk_add_allowance(d._r, email)
+    if not allowed:
+        return jsonify(error='Rate limit reached — max %d songs/hour' % ADD_SONG_LIMIT), 429
+    try:
+        ids = d.add_songs(email, uris, penalty=0, limit=allowed)
+    except RuntimeError as e:
+        return jsonify(error=str(e)), 409
+    if ids:
+        _charge_rate_limit(d._r, email, 'add_song', len(ids))
+        return jsonify(ok=True, ids=ids)
+    return jsonify(error='Failed to add songs'), 500
+
+
 # ---------------------------------------------------------------------------
 # Spotify Connect (device control) API
 # ---------------------------------------------------------------------------
@@ -1854,9 +1959,38 @@ def _pick(obj, keys):
     return {k: obj.get(k, '') for k in keys}
 
 
-def _serialize_queue():
-    queue = d.get_queued()
-    return [_pick(x, API_QUEUE_PROPS) for x in queue]
+def _serialize_queue(snapshot=None):
+    snapshot = snapshot or playlist_cache.get(d)
+    return snapshot.encoded('api', lambda queue: [_pick(x, API_QUEUE_PROPS) for x in queue])
+
+
+def _serialize_queue_json(snapshot=None):
+    """JSON-encoded _serialize_queue(), encoded once per queue version."""
+    snapshot = snapshot or playlist_cache.get(d)
+    return snapshot.encoded('api-json', lambda queue: json.dumps(_serialize_queue(snapshot)))
+
+
+def _queue_events(sent_version):
+    """SSE frames for a queue change when the stream opted into diffs.
+
+    Returns (frames, version): a queue_diff on top of the client's version
+    when one is available, otherwise a full queue_snapshot carrying its seq.
+    """
+    snapshot = playlist_cache.get(d)
+    if snapshot.version == sent_version:
+        return '', sent_version
+    if sent_version is None or snapshot.base_version == sent_version:
+        payload = snapshot.encoded('sse-diff', lambda queue: _sse_diff_json(snapshot))
+        if payload:
+            return 'event: queue_diff\ndata: %s\n\n' % payload, snapshot.version
+    payload = snapshot.encoded('sse-snapshot', lambda queue: json.dumps(
+        {'seq': snapshot.version, 'queue': _serialize_queue(snapshot)}))
+    return 'event: queue_snapshot\ndata: %s\n\n' % payload, snapshot.version
+
+
+def _sse_diff_json(snapshot):
+    diff = snapshot.diff('api', lambda queue: [_pick(x, API_QUEUE_PROPS) for x in queue])
+    return json.dumps(diff) if diff is not None else False
 
 
 def _serialize_playing():
@@ -1869,7 +2003,9 @@ def _serialize_playing():
 @app.route('/api/queue', methods=['GET'])
 @require_api_token
 def api_queue():
-    return jsonify(queue=_serialize_queue(), now=datetime.datetime.now().isoformat())
+    snapshot = playlist_cache.get(d)
+    return jsonify(queue=_serialize_queue(snapshot), seq=snapshot.version,
+                   now=datetime.datetime.now().isoformat())
 
 
 @app.route('/api/playing', methods=['GET'])
@@ -1914,6 +2050,10 @@ def api_stats():
         known_users=known_users,
         spotify_api=spotify_api,
         spotify_oauth=spotify_oauth,
+        playlist_cache=playlist_cache.stats(),
+        catalog=d._catalog.stats(),
+        position_frames=position_frames.stats(),
+        transitions=d.transition_stats(),
     )
 
 
@@ -2017,10 +2157,30 @@ def api_sync_token():
     return jsonify(token=configured_token, server=server_url)
 
 
+def _position_frame(msg):
+    """Decode a pp|src|trackid|pos[|started|paused] player message.
+
+    *started* (epoch of position 0, pause-adjusted) is None for frames from
+    a player that predates it.
+    """
+    parts = msg.split('|')
+    return {
+        'src': parts[1],
+        'trackid': parts[2],
+        'pos': int(parts[3]),
+        'started': float(parts[4]) if len(parts) > 4 else None,
+        'paused': len(parts) > 5 and parts[5] == '1',
+    }
+
+
 @app.route('/api/events', methods=['GET'])
 @require_api_token
 def api_events():
+    # ?diffs=1 streams queue_diff / queue_snapshot instead of full queue_update lists
+    diffs = request.args.get('diffs', '').lower() in ('1', 'true', 'yes')
+
     def generate():
+        sent_version = None
         r = redis.StrictRedis(
             host=CONF.REDIS_HOST or 'localhost',
             port=CONF.REDIS_PORT or 6379,
@@ -2028,6 +2188,7 @@ def api_events():
             decode_responses=True,
         ).pubsub()
         r.subscribe(pubsub_channel("main"))
+        frame_token = position_frames.connect()
         try:
             while True:
                 msg = None
@@ -2042,17 +2203,27 @@ def api_events():
                     continue
 
                 if data == 'playlist_update':
-                    payload = json.dumps(_serialize_queue())
+                    if diffs:
+                        frames, sent_version = _queue_events(sent_version)
+                        if frames:
+                            yield frames
+                        continue
+                    payload = _serialize_queue_json()
                     yield 'event: queue_update\ndata: %s\n\n' % payload
                 elif data == 'now_playing_update':
                     payload = json.dumps(_serialize_playing())
                     yield 'event: now_playing\ndata: %s\n\n' % payload
                     # Also send queue update like the WebSocket does
-                    q_payload = json.dumps(_serialize_queue())
+                    if diffs:
+                        frames, sent_version = _queue_events(sent_version)
+                        if frames:
+                            yield frames
+                        continue
+                    q_payload = _serialize_queue_json()
                     yield 'event: queue_update\ndata: %s\n\n' % q_payload
                 elif data.startswith('pp|'):
-                    _, src, track, pos = data.split('|', 3)
-                    payload = json.dumps({'src': src, 'trackid': track, 'pos': int(pos)})
+                    payload = json.dumps(_position_frame(data))
+                    position_frames.sent()
                     yield 'event: player_position\ndata: %s\n\n' % payload
                 elif data.startswith('v|'):
                     _, vol = data.split('|', 1)
@@ -2065,6 +2236,7 @@ def api_events():
         except GeneratorExit:
             pass
         finally:
+            position_frames.disconnect(frame_token)
             r.unsubscribe()
             r.close()
 
@@ -2134,7 +2306,7 @@ def api_nests_list():
     nests_list = nest_manager.list_nests()
     result = []
     for nest_id, meta in nests_list:
-        # Include now-playing summary and member count
+        # Include now-playing summary
         try:
             nest_db = DB(init_history_to_redis=False, nest_id=nest_id)
             np = nest_db.get_now_playing()
@@ -2147,15 +2319,25 @@ def api_nests_list():
                 meta['now_playing'] = None
         except Exception:
             meta['now_playing'] = None
-        try:
-            mkey = members_key(nest_id)
-            meta['member_count'] = nest_manager._r.scard(mkey)
-        except Exception:
-            meta['member_count'] = 0
+        # member_count comes from list_nests()
         result.append(meta)
     return jsonify(nests=result)
 
 
+@app.route('/api/players', methods=['GET'])
+@require_session_or_api_token
+def api_players():
+    """Admin view of the player pool: live workers and who plays each nest."""
+    from flask import g
+    if g.auth_email != API_EMAIL and not _is_admin(g.auth_email):
+        return jsonify(error='Admin only'), 403
+    if nest_manager is None:
+        nest_ids = ['main']
+    else:
+        nest_ids = [nid for nid, _ in nest_manager.list_nests()]
+    return jsonify(**player_assignments(d._r, nest_ids))
+
+
 @app.route('/api/nests/<code>', methods=['GET'])
 @require_session_or_api_token
 def api_nests_get(code):
@@ -2165,9 +2347,8 @@ def api_nests_get(code):
     if nest is None:
         return jsonify(error='not_found', message='Nest not found.'), 404
     # Include member count for frontend display
-    mkey = members_key(code)
     try:
-        nest['member_count'] = nest_manager._r.scard(mkey)
+        nest['member_count'] = active_member_count(nest_manager._r, code)
     except Exception:
         nest['member_count'] = 0
     return jsonify(nest)
@@ -2209,6 +2390,7 @@ def api_nests_delete(code):
     if nest.get('is_main'):
         return jsonify(error='forbidden', message='Cannot delete the main nest.'), 403
     nest_manager.delete_nest(code)
+    playlist_cache.forget(nest.get('nest_id', code))
     return jsonify(ok=True)
 
 
@@ -0,0 +1,180 @@
+"""Global Spotify metadata catalog shared by all nests.
+
+Tracks, artists (with genres) and album track lists are cached once per
+Spotify URI under ``CATALOG|{uri}`` instead of per nest, so a popular track
+or seed artist is fetched from Spotify once no matter how many nests use it.
+
+Entries carry a long TTL (CATALOG_TTL_SECONDS) and the catalog as a whole
+is held under a byte budget (CATALOG_MAX_BYTES): every read records the
+access time in ``CATALOG|lru`` and writes evict the least recently used
+entries until the budget fits again.
+"""
+
+import json
+import logging
+import time
+
+from config import CONF
+
+logger = logging.getLogger(__name__)
+
+LRU_KEY = 'CATALOG|lru'        # ZSET uri -> last access epoch
+SIZES_KEY = 'CATALOG|sizes'    # HASH uri -> encoded size
+BYTES_KEY = 'CATALOG|bytes'    # total of SIZES_KEY
+STATS_KEY = 'CATALOG|stats'    # HASH lookups / misses / evictions
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Bulky fields that no caller reads (per-market availability lists)
+_DROP_FIELDS = ('available_markets',)
+
+
+def track_uri(track_id):
+    return 'spotify:track:' + track_id.split(':')[-1]
+
+
+def artist_uri(artist_id):
+    return 'spotify:artist:' + artist_id.split(':')[-1]
+
+
+def album_uri(album_id):
+    return 'spotify:album:' + album_id.split(':')[-1]
+
+
+def _trim(obj):
+    """Drop per-market lists from a Spotify object and its album."""
+    if not isinstance(obj, dict):
+        return obj
+    obj = {k: v for k, v in obj.items() if k not in _DROP_FIELDS}
+    if isinstance(obj.get('album'), dict):
+        obj['album'] = _trim(obj['album'])
+    return obj
+
+
+def _entry_key(uri):
+    return 'CATALOG|' + uri
+
+
+class Catalog(object):
+    """Redis-backed metadata cache keyed by Spotify URI.
+
+    Keys are global (not nest-scoped); any DB or NestManager can build one
+    around its Redis client.
+    """
+
+    def __init__(self, redis_client, max_bytes=None, ttl=None):
+        self._r = redis_client
+        self.max_bytes = max_bytes or getattr(CONF, 'CATALOG_MAX_BYTES', None) or DEFAULT_MAX_BYTES
+        self.ttl = ttl or getattr(CONF, 'CATALOG_TTL_SECONDS', None) or DEFAULT_TTL
+
+    def get(self, uri):
+        """Return the cached object for *uri* (marking it recently used), or None."""
+        pipe = self._r.pipeline(transaction=False)
+        pipe.get(_entry_key(uri))
+        pipe.zadd(LRU_KEY, {uri: time.time()}, xx=True)
+        pipe.hincrby(STATS_KEY, 'lookups', 1)
+        raw = pipe.execute()[0]
+        if raw is None:
+            self._r.hincrby(STATS_KEY, 'misses', 1)
+            self._forget(uri)
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            logger.warning("Discarding unreadable catalog entry %s", uri)
+            return None
+
+    def get_many(self, uris):
+        """Return {uri: object} for the cached *uris* in one pipeline; misses are left out."""
+        if not uris:
+            return {}
+        pipe = self._r.pipeline(transaction=False)
+        for uri in uris:
+            pipe.get(_entry_key(uri))
+        now = time.time()
+        pipe.zadd(LRU_KEY, {uri: now for uri in uris}, xx=True)
+        pipe.hincrby(STATS_KEY, 'lookups', len(uris))
+        raws = pipe.execute()[:len(uris)]
+        found = {}
+        for uri, raw in zip(uris, raws):
+            if raw is None:
+                continue
+            try:
+                found[uri] = json.loads(raw)
+            except ValueError:
+                logger.warning("Discarding unreadable catalog entry %s", uri)
+        misses = [uri for uri in uris if uri not in found]
+        if misses:
+            self._r.hincrby(STATS_KEY, 'misses', len(misses))
+            for uri in misses:
+                self._forget(uri)
+        return found
+
+    def put(self, uri, obj):
+        """Store *obj* under *uri* and evict LRU entries past the byte budget."""
+        encoded = json.dumps(_trim(obj), separators=(',', ':'))
+        size = len(encoded)
+        old_size = int(self._r.hget(SIZES_KEY, uri) or 0)
+        pipe = self._r.pipeline()
+        pipe.set(_entry_key(uri), encoded, ex=self.ttl)
+        pipe.zadd(LRU_KEY, {uri: time.time()})
+        pipe.hset(SIZES_KEY, uri, size)
+        pipe.incrby(BYTES_KEY, size - old_size)
+        total = pipe.execute()[-1]
+        if total > self.max_bytes:
+            self._evict(total)
+
+    def fetch(self, uri, loader):
+        """Return the object for *uri*, calling loader() and caching it on a miss.
+
+        Exceptions from *loader* propagate and nothing is cached.
+        """
+        obj = self.get(uri)
+        if obj is None:
+            obj = loader()
+            if obj:
+                self.put(uri, obj)
+        return obj
+
+    def _forget(self, uri):
+        """Drop bookkeeping for an entry whose key expired on its own."""
+        size = self._r.hget(SIZES_KEY, uri)
+        if size is None:
+            return
+        pipe = self._r.pipeline()
+        pipe.hdel(SIZES_KEY, uri)
+        pipe.zrem(LRU_KEY, uri)
+        pipe.decrby(BYTES_KEY, int(size))
+        pipe.execute()
+
+    def _evict(self, total):
+        evicted = 0
+        while total > self.max_bytes:
+            popped = self._r.zpopmin(LRU_KEY, 1)
+            if not popped:
+                break
+            uris = [uri for uri, _ in popped]
+            sizes = self._r.hmget(SIZES_KEY, uris)
+            freed = sum(int(s or 0) for s in sizes)
+            pipe = self._r.pipeline()
+            pipe.delete(*[_entry_key(uri) for uri in uris])
+            pipe.hdel(SIZES_KEY, *uris)
+            pipe.decrby(BYTES_KEY, freed)
+            total = pipe.execute()[-1]
+            evicted += len(uris)
+        if evicted:
+            self._r.hincrby(STATS_KEY, 'evictions', evicted)
+            logger.info("Catalog evicted %d entries (now %d bytes)", evicted, total)
+
+    def stats(self):
+        raw = self._r.hgetall(STATS_KEY)
+        misses = int(raw.get('misses', 0))
+        return {
+            'entries': self._r.zcard(LRU_KEY),
+            'bytes': int(self._r.get(BYTES_KEY) or 0),
+            'max_bytes': self.max_bytes,
+            'hits': int(raw.get('lookups', 0)) - misses,
+            'misses': misses,
+            'evictions': int(raw.get('evictions', 0)),
+        }
@@ -1,4 +1,5 @@
 from gevent import monkey;monkey.patch_all()
+import gevent
 import time
 import datetime
 import json
@@ -9,6 +10,8 @@ import uuid
 import logging
 import pickle
 import base64
+import io
+import zlib
 import hashlib
 import os
 import traceback
@@ -22,6 +25,8 @@ from flask import render_template
 from config import CONF
 from history import PlayHistory
 import analytics
+import catalog
+import redis_scripts
 import slack
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
@@ -35,18 +40,91 @@ else:
 
 STOPWORDS = set(['the', 'and', 'for', ])
 
-# Base64-wrapped pickle helpers for storing binary data in decode_responses=True Redis
-def pickle_dump_b64(obj):
-    """Serialize object with pickle and encode as base64 string for Redis storage."""
-    return base64.b64encode(pickle.dumps(obj)).decode('ascii')
+# TTL of a queued song's QUEUE|{id} hash; mirrored in MISC|queue-expiry
+QUEUE_ENTRY_TTL = 24*60*60
 
-def pickle_load_b64(data):
-    """Decode base64 string and deserialize with pickle."""
+# Raw provider responses live outside the queue hashes, once per track URI
+# and shared by all nests (see DB._stash_payload)
+TRACK_PAYLOAD_TTL = 24*60*60
+
+# TTL of a song's QUEUEJAM set, refreshed on every jam
+JAM_TTL = 24*60*60
+
+# MISC|now-playing TTL and the playing song's QUEUE hash TTL
+NOW_PLAYING_TTL = 2*60*60
+PLAYING_ENTRY_TTL = 3*60*60
+
+# Unread player commands (MISC|player-control) are dropped after this long
+PLAYER_CONTROL_TTL = 60
+
+# Seconds between position resyncs while a song plays (POSITION_RESYNC_SECONDS)
+POSITION_RESYNC_SECONDS = 15
+
+# Seconds before a song ends that the player readies the next one (LOOKAHEAD_SECONDS)
+LOOKAHEAD_SECONDS = 10
+
+# Song-to-song gaps kept in MISC|transition-gaps for /api/stats
+TRANSITION_SAMPLES = 100
+
+# Player leadership lease on MISC|master-player (PLAYER_LEASE_SECONDS).  It
+# is renewed PLAYER_LEASE_RENEWALS times per TTL and standbys retry every
+# quarter, so a dead player is replaced in about PLAYER_LEASE_SECONDS, and a
+# live one keeps the lease through a stalled loop of up to 4/5 of it.  A
+# shorter lease fails over faster but is lost to busy event loops: at 1 s,
+# 1,000 per-nest player greenlets lost about 2,500 leases in 10 s.  This is
+# the per-nest greenlets' lease; the scheduler, which renews every lease in
+# one call, holds a shorter one (nest_scheduler.SCHEDULER_LEASE_SECONDS).
+PLAYER_LEASE_SECONDS = 5.0
+PLAYER_LEASE_RENEWALS = 5
+
+# Jams that earn a song's owner a free airhorn when FREE_AIRHORN is unset
+FREE_AIRHORN_JAMS = 99
+
+# Most songs one bulk add may queue (Spotify's multi-track endpoint takes 50 ids)
+BULK_ADD_MAX_SONGS = 50
+SPOTIFY_TRACKS_BATCH = 50
+YOUTUBE_VIDEOS_BATCH = 50
+
+class PlayerLeaseLost(RuntimeError):
+    """A newer player has taken over this nest; the old one must stop writing."""
+
+
+# Times (current-done, bender_streak_start, guest expiry) are stored as epoch
+# seconds so any client or Lua script can read them.  They used to be pickled
+# datetimes; those are still read until migrate_time_values.py has run.
+def epoch_dump(dt):
+    """Encode a naive local datetime as an epoch-seconds string for Redis."""
+    return repr(dt.timestamp())
+
+def epoch_load(data):
+    """Decode an epoch-seconds string (or a legacy pickled datetime) to a datetime."""
     if data is None:
         return None
     if isinstance(data, bytes):
         data = data.decode('ascii')
-    return pickle.loads(base64.b64decode(data))
+    try:
+        return datetime.datetime.fromtimestamp(float(data))
+    except ValueError:
+        return _legacy_datetime_load(data)
+
+
+class _DatetimeUnpickler(pickle.Unpickler):
+    """Unpickler that can only rebuild datetimes (what the old helpers stored)."""
+
+    _ALLOWED = {('datetime', 'datetime'), ('_codecs', 'encode')}
+
+    def find_class(self, module, name):
+        if (module, name) not in self._ALLOWED:
+            raise pickle.UnpicklingError('refusing to load %s.%s' % (module, name))
+        return super().find_class(module, name)
+
+
+def _legacy_datetime_load(data):
+    """Decode a base64-wrapped pickled datetime written before epoch_dump."""
+    value = _DatetimeUnpickler(io.BytesIO(base64.b64decode(data))).load()
+    if not isinstance(value, datetime.datetime):
+        raise ValueError('not a pickled datetime')
+    return value
 
 _client_creds_cache = os.path.join(CONF.OAUTH_CACHE_PATH, '.client_credentials')
 server_tokens = spotipy.oauth2.SpotifyClientCredentials(CONF.SPOTIFY_CLIENT_ID, CONF.SPOTIFY_CLIENT_SECRET,
@@ -150,6 +228,14 @@ def handle_spotify_exception(e):
 def _now():
     return datetime.datetime.now()
 
+
+def _clock_reading(now, start, paused, paused_since=None):
+    """Epoch reading of a player clock started at *start* that has been
+    paused for *paused* seconds, and since *paused_since* if still paused."""
+    if paused_since:
+        paused += max(now - paused_since, 0)
+    return start + (now - start - paused)
+
 def _log_file_for_today():
     return datetime.datetime.strftime(_now(), CONF.LOG_DIR + '/play_log_%Y_%m_%d.json')
 
@@ -161,6 +247,26 @@ def _log_play(song_json):
     except Exception as _e:
         logger.error('failed to log %s' % song_json)
 
+def _pairs(flat):
+    """Turn a flat [member, score, ...] reply (e.g. from a Lua script) into (member, float) pairs."""
+    return [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 2)]
+
+def _track_uri(src, trackid):
+    """URI that identifies a track across providers, e.g. youtube:{video id}."""
+    trackid = str(trackid)
+    if src == 'spotify' or trackid.startswith('{0}:'.format(src)):
+        return trackid
+    return '{0}:{1}'.format(src, trackid)
+
+def _encode_payload(payload):
+    """zlib-compressed JSON, base64-wrapped for decode_responses=True Redis."""
+    return base64.b64encode(zlib.compress(json.dumps(payload).encode('utf-8'))).decode('ascii')
+
+def _decode_payload(blob):
+    if blob is None:
+        return None
+    return json.loads(zlib.decompress(base64.b64decode(blob)).decode('utf-8'))
+
 def _clean_song(song):
     REMOVABLE_FIELDS = ('background_color', 'foreground_color', 'big_img', 'img', 'data')
     for field in REMOVABLE_FIELDS:
@@ -226,6 +332,15 @@ class DB(object):
             self._h = None
         self._oauth_token = None
         self._oauth_token_expires = datetime.datetime(2000,1,1,1)
+        self._scripts = {}
+        self._catalog = catalog.Catalog(self._r)
+        self._preview_refresh = None  # greenlet rebuilding MISC|preview-card
+        self._bender_reset = None  # greenlet clearing Bender caches after a human's song
+        self._lookahead = None  # greenlet readying the next song (prepare_next)
+        self._fence = None  # fencing token while this DB holds the player lease
+        self._lease_lost = False
+        self._wake = None  # list the lease renewer pushes to when the lease is lost
+        self._song = None  # song play_step() is playing
         try:
             os.makedirs(CONF.LOG_DIR)
             logger.info('Created log directory: %s' % CONF.LOG_DIR)
@@ -239,6 +354,14 @@ class DB(object):
         """Prefix a Redis key with the nest namespace."""
         return f"NEST:{self.nest_id}|{key}"
 
+    def _script(self, name):
+        """Return the registered Lua script *name* from redis_scripts (cached per DB)."""
+        script = self._scripts.get(name)
+        if script is None:
+            script = self._r.register_script(getattr(redis_scripts, name))
+            self._scripts[name] = script
+        return script
+
     def _check_nest_active(self):
         """Raise RuntimeError if this nest is being deleted. Skips check for main."""
         if self.nest_id == "main":
@@ -247,27 +370,56 @@ class DB(object):
         if is_nest_deleting(self._r, self.nest_id):
             raise RuntimeError("Nest is being deleted")
 
+    def expire_queue_entries(self):
+        """Drop queue entries whose QUEUE hash has expired; return (removed_ids, queue_size).
+
+        Only ids that are due in the MISC|queue-expiry index are looked at, so
+        the cost is proportional to the number of expired entries rather than
+        the queue depth.
+        """
+        removed, size = self._script('QUEUE_EXPIRE')(
+            keys=[self._key('MISC|priority-queue'), self._key('MISC|queue-expiry')],
+            args=[self._key(''), int(time.time())])
+        if removed:
+            logger.warning("Purging %d stale queue entry/entries: %s", len(removed), removed)
+            self._queue_changed()
+        return removed, size
+
     def _purge_stale_queue_entries(self):
-        """Remove song IDs from the priority queue whose QUEUE hash has expired."""
+        """Remove expired song IDs from the priority queue; return the remaining size."""
+        return self.expire_queue_entries()[1]
+
+    def reindex_queue_expiry(self):
+        """Add queued ids missing from MISC|queue-expiry, using their hash TTL.
+
+        Entries queued before the index existed are otherwise only caught by
+        the snapshot read.  Returns the number of ids indexed.
+        """
         queue_key = self._key('MISC|priority-queue')
+        index_key = self._key('MISC|queue-expiry')
         song_ids = self._r.zrange(queue_key, 0, -1)
-        stale = [sid for sid in song_ids if not self._r.exists(self._key('QUEUE|{0}'.format(sid)))]
-        if stale:
-            logger.warning("Purging %d stale queue entry/entries: %s", len(stale), stale)
-            self._r.zrem(queue_key, *stale)
-        return len(song_ids) - len(stale)
-
-    def _check_queue_depth(self, client=None):
-        """Raise RuntimeError if a non-main nest's queue has reached max depth."""
+        if not song_ids:
+            return 0
+        pipe = self._r.pipeline(transaction=False)
+        for sid in song_ids:
+            pipe.zscore(index_key, sid)
+            pipe.ttl(self._key('QUEUE|{0}'.format(sid)))
+        replies = pipe.execute()
+        now = int(time.time())
+        missing = {}
+        for sid, indexed, ttl in zip(song_ids, replies[0::2], replies[1::2]):
+            if indexed is None and ttl != -1:
+                # ttl == -2: already gone, let the next sweep drop it
+                missing[sid] = now + max(ttl, 0)
+        if missing:
+            self._r.zadd(index_key, missing)
+        return len(missing)
+
+    def _max_queue_depth(self):
+        """Queue depth limit for this nest; 0 means unlimited (always for main)."""
         if self.nest_id == "main":
-            return
-        max_depth = getattr(CONF, 'NEST_MAX_QUEUE_DEPTH', 25)
-        if max_depth <= 0:
-            return
-        client = client or self._r
-        current = client.zcard(self._key('MISC|priority-queue'))
-        if current >= max_depth:
-            raise RuntimeError("Queue is full")
+            return 0
+        return max(getattr(CONF, 'NEST_MAX_QUEUE_DEPTH', 25) or 0, 0)
 
     def big_scrobble(self, email, tid):
         #add played song to FILTER "set"
@@ -346,13 +498,12 @@ class DB(object):
         if cached:
             self._r.delete(self._key('BENDER|seed-info'))
 
-        if is_spotify_rate_limited():
+        if is_spotify_rate_limited() and self._catalog.get(catalog.track_uri(track_id)) is None:
             logger.debug("_get_seed_info: Spotify rate limited")
             return None
 
         try:
-            song_deets = spotify_client.track(track_id)
-            analytics.track(self._r, 'spotify_api_track')
+            song_deets = self._catalog_track(track_id)
             artists = song_deets.get('artists', [])
             if not artists:
                 return None
@@ -361,8 +512,7 @@ class DB(object):
             album_id = song_deets.get('album', {}).get('id', '')
 
             # Fetch genres from artist endpoint
-            artist_data = spotify_client.artist(artist_id)
-            analytics.track(self._r, 'spotify_api_artist')
+            artist_data = self._catalog_artist(artist_id)
             genres = artist_data.get('genres', [])
         except Exception as e:
             if handle_spotify_exception(e):
@@ -384,6 +534,30 @@ class DB(object):
         info['genres'] = genres
         return info
 
+    def _catalog_track(self, track_id):
+        """Spotify track object from the global catalog (fetched once across nests)."""
+        def load():
+            rv = spotify_client.track(track_id.split(':')[-1])
+            analytics.track(self._r, 'spotify_api_track')
+            return rv
+        return self._catalog.fetch(catalog.track_uri(track_id), load)
+
+    def _catalog_artist(self, artist_id):
+        """Spotify artist object (incl. genres) from the global catalog."""
+        def load():
+            rv = spotify_client.artist(artist_id)
+            analytics.track(self._r, 'spotify_api_artist')
+            return rv
+        return self._catalog.fetch(catalog.artist_uri(artist_id), load)
+
+    def _catalog_album_track_uris(self, album_id):
+        """Track URIs of an album, from the global catalog."""
+        def load():
+            result = spotify_client.album_tracks(album_id)
+            analytics.track(self._r, 'spotify_api_album_tracks')
+            return {'id': album_id, 'track_uris': [t['uri'] for t in result.get('items', [])]}
+        return self._catalog.fetch(catalog.album_uri(album_id), load).get('track_uris', [])
+
     def _get_strategy_weights(self):
         """Return strategy weights dict from config or default.
 
@@ -582,9 +756,7 @@ class DB(object):
             all_uris = []
             for aid in album_ids[:3]:
                 try:
-                    result = spotify_client.album_tracks(aid)
-                    analytics.track(self._r, 'spotify_api_album_tracks')
-                    all_uris.extend([t['uri'] for t in result.get('items', [])])
+                    all_uris.extend(self._catalog_album_track_uris(aid))
                 except Exception:
                     continue
             return all_uris
@@ -603,9 +775,7 @@ class DB(object):
         if not album_id:
             return []
         try:
-            result = spotify_client.album_tracks(album_id)
-            analytics.track(self._r, 'spotify_api_album_tracks')
-            return [t['uri'] for t in result.get('items', [])]
+            return list(self._catalog_album_track_uris(album_id))
         except Exception as e:
             if handle_spotify_exception(e):
                 return []
@@ -651,6 +821,7 @@ class DB(object):
         keys = [self._key(k) for k in self._STRATEGY_CACHE_KEYS.values()] + [
             self._key('BENDER|seed-info'), self._key('BENDER|throwback-users'),
             self._key('BENDER|throwback-jam-pending'), self._key('BENDER|next-preview'),
+            self._key('MISC|preview-card'),
         ]
         self._r.delete(*keys)
 
@@ -668,7 +839,7 @@ class DB(object):
                 return track_uri, preview.get('user', 'the@echonest.com'), preview.get('strategy', '')
 
             # Preview is now filtered; clear it
-            self._r.delete(self._key('BENDER|next-preview'))
+            self._clear_preview()
 
         # Use weighted random selection, falling through on failure
         seed_info = None  # lazy-loaded
@@ -727,18 +898,22 @@ class DB(object):
 
         return None, None, None
 
-    def ensure_queue_depth(self):
+    def ensure_queue_depth(self, extra=0):
         """Top up the priority queue to MIN_QUEUE_DEPTH with Bender songs.
 
-        Called after popping a song so there's always something on deck.
-        Respects USE_BENDER and MAX_BENDER_MINUTES settings.
+        Called after popping a song so there's always something on deck, and
+        with extra=1 by prepare_next() ahead of the pop.  Respects USE_BENDER
+        and MAX_BENDER_MINUTES settings.
         """
         min_depth = getattr(CONF, 'MIN_QUEUE_DEPTH', None) or 3
         # Temporary nests keep a smaller buffer to reduce Spotify API pressure
         if self.nest_id != "main":
             min_depth = 1
+        min_depth += extra
         if not CONF.USE_BENDER:
             return
+        # Fill from the caches as reset for the song just popped
+        self._wait_bender_reset()
         queue_size = self._purge_stale_queue_entries()
         if queue_size >= min_depth:
             return
@@ -756,10 +931,8 @@ class DB(object):
                     # Auto-jam throwback songs with the original queuer
                     original = self._r.hget(self._key('BENDER|throwback-jam-pending'), trackid)
                     if original and new_id:
-                        self.add_jam(self._key('QUEUEJAM|{0}'.format(new_id)), original)
-                        tb_key = self._key('QUEUEJAM_TB|{0}'.format(new_id))
-                        self._r.sadd(tb_key, original)
-                        self._r.expire(tb_key, 24*60*60)
+                        self.add_jam(self._key('QUEUEJAM|{0}'.format(new_id)), original,
+                                     throwback=True)
                         self._r.hdel(self._key('BENDER|throwback-jam-pending'), trackid)
                     added += 1
                 else:
@@ -809,7 +982,12 @@ class DB(object):
         song = self._r.lpop(self._key('MISC|backup-queue'))
         if song:
             return self._r.hget(self._key('MISC|backup-queue-data'), 'user'), song
-        self._r.delete(self._key('MISC|backup-queue-data'))
+        if self._r.exists(self._key('MISC|backup-queue-data')):
+            # The snapshot shows the backup card, so clearing it changes the playlist
+            pipe = self._r.pipeline()
+            pipe.delete(self._key('MISC|backup-queue-data'))
+            pipe.incr(self._key('MISC|queue-version'))
+            pipe.execute()
 
         # Consume the preview if one exists — this is the track the UI is showing
         preview = self._r.hgetall(self._key('BENDER|next-preview'))
@@ -824,7 +1002,7 @@ class DB(object):
                 self._r.lpop(cache_key)
             if strategy == 'throwback':
                 self._r.hdel(self._key('BENDER|throwback-users'), track)
-            self._r.delete(self._key('BENDER|next-preview'))
+            self._clear_preview()
 
             # Verify it's not filtered since the preview was created
             if not self._r.get(self._key("FILTER|%s" % track)):
@@ -907,7 +1085,7 @@ class DB(object):
     def bender_streak(self):
         now = self.player_now()
         try:
-            then = pickle_load_b64(self._r.get(self._key('MISC|bender_streak_start')))
+            then = epoch_load(self._r.get(self._key('MISC|bender_streak_start')))
             if then is None:
                 then = _now()
             logger.debug("bender streak is %s seconds, now %s then %s" % ((now - then).total_seconds(), now, then))
@@ -918,164 +1096,408 @@ class DB(object):
         return (now - then).total_seconds()
 
 
-    def master_player(self):
-        id = str(uuid.uuid4())
-        n = self._r.setnx(self._key('MISC|master-player'), id)
-        while not n:
-            time.sleep(5)
-            n = self._r.setnx(self._key('MISC|master-player'), id)
-        self._r.expire(self._key('MISC|master-player'), 5)
-        #I'm the player.
-        logger.info('Grabbing player')
+    def master_player(self, owner=None):
+        """Play this nest while holding its player lease; stand by otherwise.
+
+        The lease on MISC|master-player is renewed by its own greenlet, so
+        slow work in the playback loop can't let it lapse.  Every takeover
+        bumps MISC|player-epoch and the player's state writes are fenced
+        with that token: once a newer player has taken over they fail with
+        PlayerLeaseLost and this one goes back to standing by.  *owner*
+        names the holder in the lease (the player worker id when sharded).
+        """
+        owner = owner or str(uuid.uuid4())
+        ttl = getattr(CONF, 'PLAYER_LEASE_SECONDS', None) or PLAYER_LEASE_SECONDS
         while True:
+            lease = self.acquire_player_lease(owner, ttl)
+            if lease is None:
+                gevent.sleep(ttl / 4)
+                continue
+            self._wake = self._key('MISC|player-wake|{0}'.format(lease))
+            renewer = gevent.spawn(self._renew_lease, lease, ttl)
+            try:
+                self._play(ttl)
+            except PlayerLeaseLost as e:
+                logger.warning('Standing by: %s', e)
+            finally:
+                renewer.kill()
+                self.release_player_lease(lease)
+                self._r.delete(self._wake)
+                self._wake = None
+
+    def acquire_player_lease(self, owner, ttl):
+        """Take the player lease for *ttl* seconds if it is free.
+
+        Returns the lease value ('owner|token') and arms the fencing token,
+        or None if another player holds it.
+        """
+        token = self._script('PLAYER_LEASE_ACQUIRE')(
+            keys=[self._key('MISC|master-player'), self._key('MISC|player-epoch')],
+            args=[owner, int(ttl * 1000)])
+        if token is None:
+            return None
+        logger.info('Grabbing player (token %s)', token)
+        self._fence, self._lease_lost = token, False
+        return '%s|%s' % (owner, token)
 
-            song = self.get_now_playing()
-            finish_on = self._r.get(self._key('MISC|current-done'))
-            if finish_on and pickle_load_b64(finish_on) > self.player_now():
-                done = pickle_load_b64(finish_on)
-            else:
-                if song and song.get('id'):
-                    self.log_finished_song(song)
-
-                song = self.pop_next()
-                if not song:
-                    logger.debug("streak start set %s"%self._r.setnx(self._key('MISC|bender_streak_start'), pickle_dump_b64(self.player_now())))
-                    if (not CONF.USE_BENDER) or (self.bender_streak() <= CONF.MAX_BENDER_MINUTES * 60):
-                        got_song = False
-                        while not got_song:
-                            try:
-                                song = self.get_fill_song()
-                                self.add_spotify_song(*song, scrobble=False)
-                                got_song = True
-                            except Exception:
-                                logger.warn("couldn't add spotify song:" + str(song) )
-                                logger.warn(traceback.format_exc())
-                                continue
-                        continue
-                    else:
-                        time.sleep(0.5)
-                        continue
-                if song['duration'] < 5:
-                    continue
-                done = self.player_now() + \
-                    datetime.timedelta(seconds=song['duration'],
-                                       milliseconds=1000)
+    def release_player_lease(self, lease):
+        """Give up *lease* so a standby can take over at once."""
+        self._fence = None
+        try:
+            self._renew_player_lease(lease, 0)
+        except redis.RedisError:
+            pass
 
-            # Top up queue so there's always something on deck
-            try:
-                self.ensure_queue_depth()
-            except Exception:
-                logger.warning("ensure_queue_depth failed: %s", traceback.format_exc())
+    def _renew_player_lease(self, lease, ttl):
+        """Extend *lease* by *ttl* seconds (0 releases it); False if it was lost."""
+        return bool(self._script('PLAYER_LEASE_RENEW')(
+            keys=[self._key('MISC|master-player')], args=[lease, int(ttl * 1000)]))
 
-            # Pre-warm Bender preview so the next playlist_update has fresh data
+    def _renew_lease(self, lease, ttl):
+        """Keep *lease* alive every ttl/PLAYER_LEASE_RENEWALS seconds until it is lost."""
+        while True:
+            gevent.sleep(ttl / PLAYER_LEASE_RENEWALS)
             try:
-                self._peek_next_fill_song()
-            except Exception:
-                pass
-            self._msg('playlist_update')
-
-            id = song['trackid']
-            expire_on = int((done - self.player_now()).total_seconds())
-
-            self._r.setex(self._key('MISC|current-done'),
-                          expire_on,
-                          pickle_dump_b64(done))
-            self._r.set(self._key('MISC|started-on'),
-                          self.player_now().isoformat())
-            while self.player_now() < done:
-                paused = self._r.get(self._key('MISC|paused'))
-                if paused:
-                    logger.info("paused at %s", self.player_now())
-                    while paused:
-                        time.sleep(1)
-                        self._r.expire(self._key('MISC|master-player'), 10)
-                        paused = self._r.get(self._key('MISC|paused'))
-                    # Recalculate done: player_now didn't advance while paused,
-                    # so the remaining time is still correct, but we need to
-                    # refresh the MISC|current-done TTL since real time passed.
-                    remaining = int((done - self.player_now()).total_seconds())
-                    done = self.player_now() + datetime.timedelta(seconds=remaining, milliseconds=500)
-                    expire_on = max(remaining, 1)
-                    self._r.setex(self._key('MISC|current-done'), expire_on, pickle_dump_b64(done))
-                    logger.info("unpaused, %d seconds remaining", remaining)
-                self._r.expire(self._key('MISC|master-player'), 5)
-                if self._r.get(self._key('MISC|force-jump')):
-                    self._r.delete(self._key('MISC|force-jump'))
-                    break
-                self._add_now(1)
-                time.sleep(1)
-                remaining = int((done-self.player_now()).total_seconds())
-                self._msg('pp|{0}|{1}|{2}'.format(song['src'], id, song['duration'] - remaining))
-            self._r.delete(self._key('MISC|current-done'))
-            self._r.delete(self._key('QUEUE|VOTE|{0}'.format(id)))
-            self._r.delete(self._key('QUEUE|{0}'.format(id)))
+                held = self._renew_player_lease(lease, ttl)
+            except redis.RedisError:
+                logger.warning("player lease renewal failed: %s", traceback.format_exc())
+                continue
+            if not held:
+                logger.warning("player lease %s was taken over", lease)
+                self._lease_lost = True
+                if self._wake is not None:
+                    # Wake the playback loop so it stands by now, not at
+                    # its next deadline
+                    pipe = self._r.pipeline()
+                    pipe.rpush(self._wake, 'lease')
+                    pipe.expire(self._wake, PLAYER_CONTROL_TTL)
+                    pipe.execute()
+                return
 
-    def player_now(self):
-        t = self._r.get(self._key('MISC|player-now'))
-        if t:
+    def _check_lease(self):
+        if self._lease_lost:
+            raise PlayerLeaseLost('player lease token %s expired' % self._fence)
+
+    def _fenced(self, write):
+        """Run *write(pipe)* as a transaction, refused if a newer player took over."""
+        epoch = self._key('MISC|player-epoch')
+        with self._r.pipeline() as pipe:
             try:
-#                logger.debug("player-now %s" % pickle_load_b64(t))
-                return pickle_load_b64(t)
-            except Exception:
-                logger.error("exception loading current player time: %s", traceback.format_exc())
-                logger.debug("at time (not from redis): %s " % _now())
-                return _now()
+                if self._fence is not None:
+                    pipe.watch(epoch)
+                    if pipe.get(epoch) != str(self._fence):
+                        raise PlayerLeaseLost('player lease token %s is stale' % self._fence)
+                    pipe.multi()
+                write(pipe)
+                return pipe.execute()
+            except redis.WatchError:
+                raise PlayerLeaseLost('player lease token %s is stale' % self._fence)
+
+    def _play(self, idle_timeout):
+        """The playback loop; runs until the player lease is lost.
+
+        Between steps it blocks on the control channel until the next
+        deadline play_step() reports, so skip, pause and unpause wake it at
+        once and an idle nest makes no reads in between.  The lease renewer
+        wakes it through self._wake when the lease is lost; while paused it
+        also wakes every *idle_timeout* seconds (the lease TTL).  A command
+        popped after a newer player took over is pushed back for that
+        player.
+        """
+        self.start_playback()
+        command = None
+        while True:
+            try:
+                wait = self.play_step(command)
+            except PlayerLeaseLost:
+                if command is not None:
+                    self._r.lpush(self._key('MISC|player-control'), command)
+                raise
+            command = self._wait_player_command(idle_timeout if wait is None else wait)
+
+    def start_playback(self):
+        """Set up playback for a player that has just taken the lease."""
+        self._start_clock()
+        lookahead = getattr(CONF, 'LOOKAHEAD_SECONDS', None)
+        self._lookahead_window = LOOKAHEAD_SECONDS if lookahead is None else lookahead
+        self._resync = getattr(CONF, 'POSITION_RESYNC_SECONDS', None) or POSITION_RESYNC_SECONDS
+        self._song = None
+        self._ended = None  # monotonic time the last song ended, for the gap
+        self._preview_retry = None  # monotonic time a fallback preview card expires
+
+    def play_step(self, command=None):
+        """Move playback on to now; return the seconds until it next has work.
+
+        Starts a song if none is playing and applies a control *command*
+        ('skip|<id>', 'pause' or 'unpause'); a skip of a song that is no
+        longer playing is dropped, so repeated presses skip one song.  The song ends at its deadline, the
+        next one is readied LOOKAHEAD_SECONDS before that, and position goes
+        out on start, pause and resume and every POSITION_RESYNC_SECONDS in
+        between; clients interpolate.  Returns None while paused, when only
+        a command can move playback on.  Raises PlayerLeaseLost once a newer
+        player has taken over.
+        """
+        self._check_lease()
+        if self._song is None:
+            wait = self._begin_song()
+            if self._song is None:
+                return wait
+        if command and command.split('|')[0] == 'skip':
+            target = command.partition('|')[2]
+            if not target or target == str(self._song.get('id')):
+                return self._end_song()
+            logger.info("dropping skip of %s, which is no longer playing", target)
+        if command in ('pause', 'unpause'):
+            self._toggle_pause()
+        now = time.monotonic()
+        if command == 'preview' or (self._preview_retry is not None and now >= self._preview_retry):
+            self._preview_retry = None
+            self._ensure_preview_card()
+        if not self._paused and now >= self._deadline:
+            return self._end_song()
+        if (self._lookahead_window and self._lookahead is None and not self._paused
+                and self._deadline - now <= self._lookahead_window):
+            self._lookahead = gevent.spawn(self._prepare_next_logged)
+        if not self._paused and now >= self._next_sync:
+            self._publish_position(self._song, self._deadline - now, self._paused)
+            self._next_sync = now + self._resync
+        return self._next_wait()
+
+    def _next_wait(self):
+        if self._paused:
+            return None
+        wake = min(self._deadline, self._next_sync)
+        if self._lookahead_window and self._lookahead is None:
+            wake = min(wake, self._deadline - self._lookahead_window)
+        if self._preview_retry is not None:
+            wake = min(wake, self._preview_retry)
+        return max(wake - time.monotonic(), 0)
+
+    def _begin_song(self):
+        """Start the song that should be playing; the wait until the next step."""
+        song = self.get_now_playing()
+        finish_on = self._r.get(self._key('MISC|current-done'))
+        finished = None
+        if finish_on and epoch_load(finish_on) > self.player_now():
+            done = epoch_load(finish_on)
+        else:
+            # The swap itself: prepare_next() already did the slow part
+            self._wait_lookahead()
+            if song and song.get('id'):
+                finished = song
+            now = self.player_now()
+            song = self.pop_next(now)
+            if not song or song['duration'] < 5:
+                if finished:
+                    self.log_finished_song(finished)
+                if song:
+                    self._fenced(lambda pipe: pipe.delete(self._key('MISC|current-done')))
+                    return 0
+                self._start_bender_streak()
+                if (not CONF.USE_BENDER) or (self.bender_streak() <= CONF.MAX_BENDER_MINUTES * 60):
+                    got_song = False
+                    while not got_song:
+                        try:
+                            song = self.get_fill_song()
+                            self.add_spotify_song(*song, scrobble=False)
+                            got_song = True
+                        except Exception:
+                            logger.warn("couldn't add spotify song:" + str(song) )
+                            logger.warn(traceback.format_exc())
+                            continue
+                    return 0
+                return 0.5
+            done = now + datetime.timedelta(seconds=song['duration'],
+                                            milliseconds=1000)
+
+        self._song, self._done = song, done
+        self._paused = self._r.get(self._key('MISC|paused'))
+        remaining = (done - self.player_now()).total_seconds()
+        self._deadline = time.monotonic() + remaining
+        self._publish_position(song, remaining, self._paused)
+        self._msg('playlist_update')
+        self._next_sync = time.monotonic() + self._resync
+        if self._ended is not None:
+            self._record_transition(time.monotonic() - self._ended)
+            self._ended = None
+
+        # Off the transition path: usually no-ops after prepare_next()
+        if finished:
+            self.log_finished_song(finished)
+        try:
+            self.ensure_queue_depth()
+        except Exception:
+            logger.warning("ensure_queue_depth failed: %s", traceback.format_exc())
+        self._ensure_preview_card()
+        return self._next_wait()
+
+    def _toggle_pause(self):
+        was_paused, self._paused = self._paused, self._r.get(self._key('MISC|paused'))
+        if bool(self._paused) == bool(was_paused):
+            return
+        # player_now doesn't advance while paused, so done still holds,
+        # but MISC|current-done's TTL runs in real time.
+        done = self._done
+        remaining = (done - self.player_now()).total_seconds()
+        if self._paused:
+            logger.info("paused at %s", self.player_now())
         else:
-            logger.debug("now (not from redis): %s" % _now())
+            self._deadline = time.monotonic() + remaining
+            self._fenced(lambda pipe: pipe.set(
+                self._key('MISC|current-done'), epoch_dump(done),
+                ex=max(int(remaining), 1)))
+            logger.info("unpaused, %d seconds remaining", remaining)
+        self._publish_position(self._song, remaining, self._paused)
+        self._next_sync = time.monotonic() + self._resync
+
+    def _end_song(self):
+        """Clear the finished song and start the next; the wait until the next step."""
+        self._ended = time.monotonic()
+        id = self._song['trackid']
+        self._fenced(lambda pipe: pipe.delete(
+            self._key('MISC|current-done'), self._key('QUEUE|VOTE|{0}'.format(id)),
+            self._key('QUEUE|{0}'.format(id))))
+        self._song = None
+        return self._begin_song()
+
+    def prepare_next(self):
+        """Ready the song after the playing one while it still plays.
+
+        The player calls this LOOKAHEAD_SECONDS before the playing song ends
+        so that the transition is a single QUEUE_POP swap.  Expired entries
+        are purged, a fill song is queued if the queue is empty (the player
+        would otherwise call Spotify between songs), the queue is topped up
+        one past MIN_QUEUE_DEPTH to cover the pop, and the Bender preview
+        card is rebuilt if it is missing.  Returns the id of the song that
+        will play next, or None if the queue is still empty.
+        """
+        if not self._purge_stale_queue_entries():
+            self._start_bender_streak()
+            if (not CONF.USE_BENDER) or (self.bender_streak() <= CONF.MAX_BENDER_MINUTES * 60):
+                user, trackid = self.get_fill_song()
+                if user and trackid:
+                    self.add_spotify_song(user, trackid, scrobble=False)
+        self.ensure_queue_depth(extra=1)
+        if not self._r.exists(self._key('MISC|preview-card')):
+            self.refresh_preview_card()
+        head = self._r.zrange(self._key('MISC|priority-queue'), 0, 0)
+        return head[0] if head else None
+
+    def _start_bender_streak(self):
+        """Note when Bender started filling, unless a streak is already running."""
+        started = self._fenced(lambda pipe: pipe.setnx(
+            self._key('MISC|bender_streak_start'), epoch_dump(self.player_now())))[0]
+        logger.debug("streak start set %s", started)
+
+    def _prepare_next_logged(self):
+        try:
+            self.prepare_next()
+        except Exception:
+            logger.warning("prepare_next failed: %s", traceback.format_exc())
+
+    def _wait_lookahead(self):
+        """Block until a running prepare_next() finishes, then allow the next one."""
+        if self._lookahead is not None:
+            self._lookahead.join()
+            self._lookahead = None
+
+    def _record_transition(self, gap):
+        """Log the *gap* in seconds between one song ending and the next starting."""
+        logger.info("song transition took %.1f ms", gap * 1000)
+        key = self._key('MISC|transition-gaps')
+        pipe = self._r.pipeline()
+        pipe.lpush(key, '%.1f' % (gap * 1000))
+        pipe.ltrim(key, 0, TRANSITION_SAMPLES - 1)
+        pipe.execute()
+
+    def transition_stats(self):
+        """Song-to-song gaps over the last TRANSITION_SAMPLES transitions, in ms."""
+        gaps = sorted(float(g) for g in self._r.lrange(self._key('MISC|transition-gaps'), 0, -1))
+        if not gaps:
+            return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+        return {
+            'count': len(gaps),
+            'p50_ms': gaps[len(gaps) // 2],
+            'p95_ms': gaps[min(int(len(gaps) * 0.95), len(gaps) - 1)],
+            'max_ms': gaps[-1],
+        }
+
+    def _publish_position(self, song, remaining, paused):
+        """Send pp|src|trackid|pos|started|paused for the playing *song*.
+
+        *started* is the epoch at which the song would have been at 0s had
+        it not been paused, so listeners can interpolate between frames.
+        """
+        pos = max(song['duration'] - remaining, 0)
+        self._msg('pp|{0}|{1}|{2}|{3:.3f}|{4}'.format(
+            song['src'], song['trackid'], int(pos), time.time() - pos, int(bool(paused))))
+
+    def _player_command(self, command):
+        """Wake this nest's player with *command*: 'skip|<id>', 'pause' or 'unpause'.
+
+        Any other command ('preview') just wakes it to rebuild a missing
+        preview card.
+        """
+        key = self._key('MISC|player-control')
+        pipe = self._r.pipeline()
+        pipe.rpush(key, command)
+        pipe.expire(key, PLAYER_CONTROL_TTL)
+        pipe.execute()
+
+    def _wait_player_command(self, timeout):
+        """Block up to *timeout* seconds for a player command; return it, or None.
+
+        A push to self._wake (the lease was lost) also ends the wait.
+        """
+        control = self._key('MISC|player-control')
+        keys = [control] if self._wake is None else [control, self._wake]
+        popped = self._r.blpop(keys, timeout=max(timeout, 0.01))
+        return popped[1] if popped and popped[0] == control else None
+
+    def player_now(self):
+        """Return the player clock: wall time that stops while paused.
+
+        The clock is the MISC|clock hash: the epoch it started at, the
+        seconds it has spent paused, and the epoch of the current pause (if
+        any).  Its reading is derived on every call, so nothing has to tick
+        it forward.
+        """
+        start, paused, since = self._r.hmget(self._key('MISC|clock'),
+                                             'start', 'paused', 'paused-since')
+        if not start:
             return _now()
+        return datetime.datetime.fromtimestamp(
+            _clock_reading(time.time(), float(start), float(paused or 0),
+                           since and float(since)))
 
-    def _add_now(self, seconds):
-        new_t = self.player_now() + datetime.timedelta(seconds=seconds)
-#        logger.debug("updating time %s", new_t)
-        self._r.setex(self._key('MISC|player-now'), 12*3600, pickle_dump_b64(new_t))
+    def _start_clock(self):
+        """Start the player clock if it isn't running yet.
+
+        A clock left by the old per-second MISC|player-now ticker is carried
+        over: its lag behind wall time becomes paused time, so current-done
+        and the Bender streak start keep their meaning.
+        """
+        clock = self._key('MISC|clock')
+        if self._r.exists(clock):
+            return
+        now = time.time()
+        lag = 0
+        legacy = self._r.get(self._key('MISC|player-now'))
+        if legacy:
+            try:
+                lag = max(now - epoch_load(legacy).timestamp(), 0)
+            except Exception:
+                logger.warning("Ignoring unreadable MISC|player-now")
+        pipe = self._r.pipeline()
+        pipe.hsetnx(clock, 'start', now)
+        pipe.hsetnx(clock, 'paused', lag)
+        pipe.delete(self._key('MISC|player-now'))
+        pipe.execute()
 
     def _song_keywords(self, title):
         return set(x for x in title.lower().split()
                    if len(x) > 2 and x not in STOPWORDS)
 
-    def _score_track(self, userid, force_first, song):
-        if force_first:
-            return 0
-
-        userid = userid.lower()
-        queued = self.get_queued()
-
-        if len(queued) == 1:
-            return 1.0
-
-        # Auto-fill songs (Bender) always go to the end of the queue.
-        # The fair-scheduling interleave is only for human-queued songs.
-        if song.get('auto'):
-            return queued[-2]['score'] + 1.0
-
-        # this counts how many tracks this user will have in the queue including this (so start from 1)
-        this_user_songs_in_queue = 1
-        for i in range(0, len(queued) - 1):
-            x = queued[i]
-            if x.get('user','') == userid:
-                this_user_songs_in_queue += 1
-
-        # loop over all the tracks in the queue and count how many each user has queued
-        user_seen_count = {}
-        for i in range(0, len(queued) - 1):
-            queued_song = queued[i]
-            queuer = queued_song['user']
-
-            # increase the count of tracks in queue for the user who queued this track
-            if queuer in user_seen_count:
-                user_seen_count[queuer] += 1
-            else: # or initialize it to 1 if this is the first time we see them
-                user_seen_count[queuer] = 1
-
-            # if this track is someone's n+1th track and the requesting user is adding
-            # their nth track, add the requesting user's track right before this track
-            # no need to check if i > 0 because this can't be true until the second track in the queue
-            if user_seen_count[queuer] == this_user_songs_in_queue + 1:
-                return (queued[i-1]['score'] + queued_song['score']) / 2.0
-
-        # if we get here it means that the track should be added last to the queue
-        return queued[-2]['score'] + 1.0
-
     def get_user_img(self, userid):
         static = {'the@echonest.com' : '/static/theechonestcom.png',
                     'jambutton@echonest.com' : '/static/button.png', 
@@ -1104,43 +1526,83 @@ class DB(object):
         grav = hashlib.md5(userid.strip().lower().encode('utf-8')).hexdigest()
         return 'http://www.gravatar.com/avatar/{0}?d=monsterid&s=180'.format(grav)
 
+    def _queue_fields(self, userid, song):
+        """Stamp *song* as a fresh entry for *userid*; return its QUEUE hash mapping."""
+        song.update(dict(
+            background_color='222222',
+            foreground_color='F0F0FF',
+            user=userid,
+            vote=0,
+        ))
+        song.pop('id', None)
+        return self._serialize_song(song)
+
+    def _queue_add_keys(self):
+        return [self._key('MISC|priority-queue'), self._key('MISC|playlist-plays'),
+                self._key('MISC|queue-users'), self._key('MISC|queue-version'),
+                self._key('MISC|queue-expiry')]
+
     def _add_song(self, userid, song, force_first, penalty=0):
+        """Queue *song* for *userid* and return its new id.
+
+        One QUEUE_ADD script call does the depth check, assigns the id,
+        computes the fair-interleave score and writes every key, so
+        concurrent adds never retry.  Raises RuntimeError if the nest's
+        queue is full.
+        """
         self._check_nest_active()
 
-        queue_key = self._key('MISC|priority-queue')
-        id_key = self._key('MISC|playlist-plays')
-        id_value = None
+        fields = self._queue_fields(userid, song)
+        args = [self._key(''), userid, userid.lower(),
+                int(bool(force_first)), int(bool(song.get('auto'))), penalty,
+                self._max_queue_depth(), int(time.time()), QUEUE_ENTRY_TTL]
+        for field in fields.items():
+            args.extend(field)
 
-        while True:
-            with self._r.pipeline() as pipe:
-                try:
-                    pipe.watch(queue_key)
-                    self._check_queue_depth(pipe)
+        rv = self._queue_add('QUEUE_ADD', args)
+        if not rv:
+            raise RuntimeError("Queue is full")
+        id_value = rv[0]
+        song['id'] = id_value
 
-                    id_value = self._r.incr(id_key)
+        self._msg('playlist_update')
+        return str(id_value)
 
-                    song.update(dict(
-                        background_color='222222',
-                        foreground_color='F0F0FF',
-                        user=userid,
-                        id=id_value,
-                        vote=0,
-                    ))
-                    score = self._score_track(userid, force_first, song) + penalty
+    def _add_songs(self, userid, songs, penalty=0):
+        """Queue *songs* for *userid* in order; return the new ids.
 
-                    pipe.multi()
-                    self.set_song_in_queue(id_value, song, client=pipe)
-                    vote_key = self._key('QUEUE|VOTE|{0}'.format(id_value))
-                    pipe.sadd(vote_key, userid)
-                    pipe.expire(vote_key, 24*60*60)
-                    pipe.zadd(queue_key, {str(id_value): score})
-                    pipe.execute()
-                    break
-                except redis.WatchError:
-                    continue
+        All songs go in with one QUEUE_ADD_MANY call, each placed as if
+        added on its own, followed by a single playlist_update.  Songs past
+        the nest's depth limit are dropped; RuntimeError if none fit.
+        """
+        self._check_nest_active()
+        if not songs:
+            return []
+
+        args = [self._key(''), userid, userid.lower(), penalty,
+                self._max_queue_depth(), int(time.time()), QUEUE_ENTRY_TTL]
+        for song in songs:
+            fields = self._queue_fields(userid, song)
+            args.extend([int(bool(song.get('auto'))), 2 * len(fields)])
+            for field in fields.items():
+                args.extend(field)
+
+        ids = self._queue_add('QUEUE_ADD_MANY', args)
+        if not ids:
+            raise RuntimeError("Queue is full")
+        for song, id_value in zip(songs, ids):
+            song['id'] = id_value
 
         self._msg('playlist_update')
-        return str(id_value)
+        return [str(i) for i in ids]
+
+    def _queue_add(self, name, args):
+        """Run the QUEUE_ADD / QUEUE_ADD_MANY script; fenced while this DB plays."""
+        script = self._script(name)
+        if self._fence is None:
+            return script(keys=self._queue_add_keys(), args=args)
+        return self._fenced(
+            lambda pipe: script(keys=self._queue_add_keys(), args=args, client=pipe))[0]
 
     def _pluck_youtube_img(self, doc, height):
         for img in doc['snippet']['thumbnails'].values():
@@ -1186,7 +1648,7 @@ class DB(object):
                             track['title']))
             return
 
-        song = dict(data=response, src='soundcloud', trackid=trackid,
+        song = dict(data=track, src='soundcloud', trackid=trackid,
                     title=track['title'],
                     artist=artist,
                     duration=int(track['duration']) // 1000,
@@ -1220,55 +1682,54 @@ class DB(object):
                 logger.warning("YouTube video not found: %s", trackid)
                 return
 
-            response = data['items'][0]
-
-            if 'coldplay' in response['snippet']['title'].lower():
-                logger.info('{0} tried to add "{1}" by Coldplay (YT)'.format(
-                    userid,
-                    response['snippet']['title']))
-                return
-
-            song = dict(data=response, src='youtube', trackid=trackid,
-                        title=response['snippet']['title'],
-                        artist=response['snippet']['channelTitle'] + '@youtube',
-                        duration=parse_yt_duration(response['contentDetails']['duration']),
-                        big_img=self._pluck_youtube_img(response, 360),
-                        auto=False,
-                        img=self._pluck_youtube_img(response, 90))
-            self._add_song(userid, song, False, penalty=penalty)
+            song = self._song_from_youtube_video(userid, trackid, data['items'][0])
+            if song:
+                self._add_song(userid, song, False, penalty=penalty)
 
         except requests.exceptions.Timeout:
             logger.error("YouTube API timeout for video %s", trackid)
         except Exception as e:
             logger.error("Error adding YouTube song %s: %s", trackid, str(e))
 
-    def get_fill_info(self, trackid):
-        key = self._key('FILL-INFO|{0}'.format(trackid))
+    def _song_from_youtube_video(self, userid, trackid, response):
+        """Queue entry for a /youtube/v3/videos item, or None if it's Coldplay."""
+        if 'coldplay' in response['snippet']['title'].lower():
+            logger.info('{0} tried to add "{1}" by Coldplay (YT)'.format(
+                userid,
+                response['snippet']['title']))
+            return None
 
-        raw_song = self._r.hgetall(key)
-        if raw_song:
-            return raw_song
+        return dict(data=response, src='youtube', trackid=trackid,
+                    title=response['snippet']['title'],
+                    artist=response['snippet']['channelTitle'] + '@youtube',
+                    duration=parse_yt_duration(response['contentDetails']['duration']),
+                    big_img=self._pluck_youtube_img(response, 360),
+                    auto=False,
+                    img=self._pluck_youtube_img(response, 90))
 
-        # Don't make Spotify API calls when rate limited
-        if is_spotify_rate_limited():
-            logger.debug("get_fill_info: Spotify rate limited, raising exception")
-            raise Exception("Spotify rate limited")
+    def get_fill_info(self, trackid):
+        """Display info for a Bender track, served from the global catalog.
 
-        song = self.get_spotify_song(trackid, scrobble=False)
-        # Serialize for Redis storage
-        serialized = {}
-        for k, v in song.items():
-            if isinstance(v, (dict, list)):
-                serialized[k] = json.dumps(v)
-            elif v is None:
-                serialized[k] = ''
-            else:
-                serialized[k] = str(v) if not isinstance(v, str) else v
-        self._r.hset(key, mapping=serialized)
-        self._r.expire(key, 20*60) # 20 minutes should be long enough -- if not, no worries, just refetch
+        Only a catalog miss calls Spotify, and not while rate limited.
+        """
+        response = self._catalog.get(catalog.track_uri(trackid))
+        if response is None:
+            # Don't make Spotify API calls when rate limited
+            if is_spotify_rate_limited():
+                logger.debug("get_fill_info: Spotify rate limited, raising exception")
+                raise Exception("Spotify rate limited")
+            response = self._fetch_spotify_track(trackid)
+        song = self._song_from_spotify_track(trackid, response, scrobble=False)
+        song.pop('data', None)
         return song
 
     def get_spotify_song(self, trackid, scrobble):
+        response = self._catalog.fetch(catalog.track_uri(trackid),
+                                       lambda: self._fetch_spotify_track(trackid, cache=False))
+        return self._song_from_spotify_track(trackid, response, scrobble)
+
+    def _fetch_spotify_track(self, trackid, cache=True):
+        """GET /v1/tracks/{id}; the response is added to the catalog unless cache=False."""
         # Handle get_access_token returning dict in newer spotipy versions
         token = auth.get_access_token()
         if isinstance(token, dict):
@@ -1293,6 +1754,11 @@ class DB(object):
             logger.error("Spotify API error fetching track %s: %s", trackid, response.get('error'))
             raise Exception(f"Spotify API error: {response.get('error', {}).get('message', 'Unknown error')}")
 
+        if cache:
+            self._catalog.put(catalog.track_uri(trackid), response)
+        return response
+
+    def _song_from_spotify_track(self, trackid, response, scrobble):
         big_img, img = self._extract_images(response.get('album', {}).get('images', []))
 
         song = dict(data=response, src='spotify', trackid=trackid,
@@ -1402,6 +1868,159 @@ class DB(object):
 
         return new_id
 
+    def add_songs(self, userid, uris, penalty=0, limit=None):
+        """Queue several songs in one transaction; return the new ids in order.
+
+        *uris* may mix Spotify track and episode URIs, ``spotify:album:ID``
+        and ``spotify:playlist:ID`` (expanded to their tracks), YouTube
+        videos as ``youtube:ID`` and playlists as ``youtube:playlist:ID``.
+        At most *limit* songs (BULK_ADD_MAX_SONGS) are taken.  Metadata is
+        fetched in batches, unknown ids are skipped, and everything is
+        queued by one QUEUE_ADD_MANY call with a single playlist_update.
+        """
+        limit = limit or getattr(CONF, 'BULK_ADD_MAX_SONGS', None) or BULK_ADD_MAX_SONGS
+        items = self._expand_bulk_uris(uris, limit)
+
+        spotify_ids = [tid for src, tid in items if src == 'spotify' and ':episode:' not in tid]
+        youtube_ids = [tid for src, tid in items if src == 'youtube']
+        tracks = self._fetch_spotify_tracks(spotify_ids) if spotify_ids else {}
+        videos = self._fetch_youtube_videos(youtube_ids) if youtube_ids else {}
+
+        songs = []
+        for src, tid in items:
+            song = None
+            try:
+                if src == 'youtube':
+                    if tid in videos:
+                        song = self._song_from_youtube_video(userid, tid, videos[tid])
+                elif ':episode:' in tid:
+                    song = self.get_spotify_episode(tid)
+                elif catalog.track_uri(tid) in tracks:
+                    song = self._song_from_spotify_track(tid, tracks[catalog.track_uri(tid)], True)
+            except Exception as e:
+                logger.warning("Skipping %s %s in bulk add: %s", src, tid, e)
+            if song:
+                songs.append(song)
+            else:
+                logger.info("bulk add for %s: no metadata for %s %s", userid, src, tid)
+
+        ids = self._add_songs(userid, songs, penalty=penalty)
+
+        pipe = self._r.pipeline(transaction=False)
+        for song in songs[:len(ids)]:
+            if song['src'] == 'spotify' and song.get('type') != 'episode':
+                pipe.set(self._key('FILTER|spotify:track:%s' % song['trackid'].split(':')[-1]),
+                         1, ex=CONF.BENDER_FILTER_TIME)
+        pipe.execute()
+        return ids
+
+    def _expand_bulk_uris(self, uris, limit):
+        """Turn bulk-add URIs into up to *limit* (src, trackid) pairs, in order."""
+        items = []
+        for uri in uris:
+            if len(items) >= limit:
+                break
+            uri = (uri or '').strip()
+            parts = uri.split(':')
+            try:
+                if uri.startswith('spotify:album:'):
+                    items.extend(('spotify', u) for u in self._catalog_album_track_uris(parts[-1]))
+                elif uri.startswith('spotify:playlist:'):
+                    items.extend(('spotify', u) for u in self._spotify_playlist_track_uris(parts[-1], limit))
+                elif uri.startswith('youtube:playlist:'):
+                    items.extend(('youtube', v) for v in self._youtube_playlist_video_ids(parts[-1], limit))
+                elif uri.startswith('youtube:') and len(parts) == 2:
+                    items.append(('youtube', parts[1]))
+                elif uri.startswith('spotify:track:') or uri.startswith('spotify:episode:'):
+                    items.append(('spotify', uri))
+                else:
+                    logger.warning("Unsupported URI in bulk add: %s", uri)
+            except Exception as e:
+                if handle_spotify_exception(e):
+                    raise
+                logger.warning("Could not expand %s for bulk add: %s", uri, e)
+        return items[:limit]
+
+    def _spotify_playlist_track_uris(self, playlist_id, limit):
+        result = spotify_client.playlist_items(playlist_id, limit=min(limit, 100),
+                                               fields='items(track(uri))',
+                                               additional_types=('track',))
+        analytics.track(self._r, 'spotify_api_playlist_items')
+        return [item['track']['uri'] for item in result.get('items', [])
+                if item.get('track') and (item['track'].get('uri') or '').startswith('spotify:track:')]
+
+    def _fetch_spotify_tracks(self, trackids):
+        """Track objects keyed by track URI: catalog hits, then GET /v1/tracks?ids= 50 at a time."""
+        uris = list(dict.fromkeys(catalog.track_uri(t) for t in trackids))
+        found = self._catalog.get_many(uris)
+        missing = [uri for uri in uris if uri not in found]
+        if not missing:
+            return found
+        if is_spotify_rate_limited():
+            logger.debug("_fetch_spotify_tracks: Spotify rate limited, raising exception")
+            raise Exception("Spotify rate limited")
+
+        token = auth.get_access_token()
+        if isinstance(token, dict):
+            token = token.get('access_token', token)
+        for start in range(0, len(missing), SPOTIFY_TRACKS_BATCH):
+            batch = missing[start:start + SPOTIFY_TRACKS_BATCH]
+            resp = requests.get(
+                'https://api.spotify.com/v1/tracks',
+                params={'ids': ','.join(uri.split(':')[-1] for uri in batch)},
+                headers={'Authorization': 'Bearer ' + str(token)},
+                timeout=10)
+            analytics.track(self._r, 'spotify_api_get_tracks')
+            if resp.status_code != 200:
+                analytics.track(self._r, 'spotify_api_error')
+                logger.error("Spotify API HTTP error %d fetching %d tracks", resp.status_code, len(batch))
+                raise Exception(f"Spotify API error: HTTP {resp.status_code}")
+            for track in resp.json().get('tracks') or []:
+                if track and track.get('uri'):
+                    self._catalog.put(track['uri'], track)
+                    found[track['uri']] = track
+        return found
+
+    def _youtube_configured(self):
+        return CONF.YT_API_KEY and CONF.YT_API_KEY != 'your-youtube-api-key'
+
+    def _youtube_playlist_video_ids(self, playlist_id, limit):
+        if not self._youtube_configured():
+            logger.error("YouTube API key not configured")
+            return []
+        resp = requests.get('https://www.googleapis.com/youtube/v3/playlistItems',
+                            params=dict(playlistId=playlist_id, part='contentDetails',
+                                        maxResults=min(limit, 50), key=CONF.YT_API_KEY),
+                            timeout=10)
+        if resp.status_code != 200:
+            logger.error("YouTube API error %d for playlist %s", resp.status_code, playlist_id)
+            return []
+        return [item['contentDetails']['videoId'] for item in resp.json().get('items', [])]
+
+    def _fetch_youtube_videos(self, video_ids):
+        """Video items keyed by id, from /youtube/v3/videos with 50 ids per call."""
+        if not self._youtube_configured():
+            logger.error("YouTube API key not configured")
+            return {}
+        videos = {}
+        video_ids = list(dict.fromkeys(video_ids))
+        for start in range(0, len(video_ids), YOUTUBE_VIDEOS_BATCH):
+            batch = video_ids[start:start + YOUTUBE_VIDEOS_BATCH]
+            try:
+                resp = requests.get('https://www.googleapis.com/youtube/v3/videos/',
+                                    params=dict(id=','.join(batch), part='snippet,contentDetails',
+                                                key=CONF.YT_API_KEY),
+                                    timeout=10)
+            except requests.exceptions.Timeout:
+                logger.error("YouTube API timeout for %d videos", len(batch))
+                continue
+            if resp.status_code != 200:
+                logger.error("YouTube API error %d for %d videos", resp.status_code, len(batch))
+                continue
+            for item in resp.json().get('items', []):
+                videos[item['id']] = item
+        return videos
+
     def num_jams(self, queued_song_jams_key):
         return self._r.zcard(queued_song_jams_key)
 
@@ -1410,6 +2029,12 @@ class DB(object):
         # Check for throwback markers
         tb_key = queued_song_jams_key.replace('QUEUEJAM|', 'QUEUEJAM_TB|')
         tb_users = self._r.smembers(tb_key)
+        jams = self._decode_jams(jams_raw, tb_users)
+        logger.debug("jams for %s: %s" % (queued_song_jams_key, jams))
+        return jams
+
+    @staticmethod
+    def _decode_jams(jams_raw, tb_users):
         jams = []
         for user, ts in jams_raw:
             jam = {"user": user,
@@ -1417,46 +2042,48 @@ class DB(object):
             if user in tb_users:
                 jam["throwback"] = True
             jams.append(jam)
-        logger.debug("jams for %s: %s" % (queued_song_jams_key, jams))
         return jams
 
-    def add_jam(self, queued_song_jams_key, userid):
-        self._r.zadd(queued_song_jams_key, {userid.lower(): int(time.time())})
-        logger.info("jammed by " +  userid)
+    def add_jam(self, queued_song_jams_key, userid, throwback=False):
+        """Jam *userid* on a queued song, e.g. a throwback's original queuer.
 
-    def remove_jam(self, queued_song_jams_key, userid):
-        self._r.zrem(queued_song_jams_key, userid)
-        logger.info("jam removed for " +  userid)
-
-    def already_jammed(self, queued_song_jams_key, userid):
-        jams_on_queued_song = self.get_jams(queued_song_jams_key)
-        jammed = False
-        for jam in jams_on_queued_song:
-            if jam['user'] == userid:
-                jammed = True
-                logger.info(queued_song_jams_key + " already jammed by " + userid)
-                break
-        return jammed
+        With *throwback* the jam is also flagged as a throwback jam.  The
+        jam and the queue version bump are one MULTI, so cached playlists
+        never serve the song without it.
+        """
+        pipe = self._r.pipeline()
+        pipe.zadd(queued_song_jams_key, {userid.lower(): int(time.time())})
+        if throwback:
+            tb_key = queued_song_jams_key.replace('QUEUEJAM|', 'QUEUEJAM_TB|')
+            pipe.sadd(tb_key, userid)
+            pipe.expire(tb_key, 24*60*60)
+        pipe.incr(self._key('MISC|queue-version'))
+        pipe.execute()
+        logger.info("jammed by " +  userid)
+        self._msg('playlist_update')
 
     def jam(self, id, userid):
+        """Toggle *userid*'s jam on song *id*.
+
+        Returns {'jams': count, 'jammed': bool, 'free_horn': bool}; free_horn
+        is True only for the jam that took the song to FREE_AIRHORN jams,
+        which awards the song's owner a free airhorn.  The toggle, TTL,
+        version bump and award are one QUEUE_JAM script call.
+        """
         self._check_nest_active()
-        queued_song_jams_key = self._key('QUEUEJAM|{0}'.format(id))
         userid = userid.lower()
-        if self.already_jammed(queued_song_jams_key, userid):
-            self.remove_jam(queued_song_jams_key, userid)
-        else:
-            self.add_jam(queued_song_jams_key, userid)
-        self._r.expire(queued_song_jams_key, 24*60*60)
-
-        if self._r.zrank(self._key('MISC|priority-queue'), id) is not None:
-            self._msg('playlist_update')
-        else:
-            self._msg('now_playing_update')
-        if self.num_jams(queued_song_jams_key) >= CONF.FREE_AIRHORN:
-            user = self.get_now_playing()['user']
-            self._r.sadd(self._key('FREEHORN_{0}'.format(user)), id)
+        count, jammed, queued, awarded = self._script('QUEUE_JAM')(
+            keys=[self._key('QUEUEJAM|{0}'.format(id)),
+                  self._key('MISC|priority-queue'),
+                  self._key('MISC|queue-version')],
+            args=[self._key(''), id, userid, int(time.time()), JAM_TTL,
+                  CONF.FREE_AIRHORN or FREE_AIRHORN_JAMS])
+        logger.info("%s by %s", "jammed" if jammed else "jam removed", userid)
+
+        self._msg('playlist_update' if queued else 'now_playing_update')
+        if awarded:
             self._msg('update_freehorn')
-
+        return {'jams': count, 'jammed': bool(jammed), 'free_horn': bool(awarded)}
 
     def add_comment(self, id, userid, text):
         self._check_nest_active()
@@ -1464,18 +2091,23 @@ class DB(object):
         self._r.zadd(comments_key, {"{0}||{1}".format(userid.lower(), text): int(time.time())})
         self._r.expire(comments_key, 24*60*60)
         logger.info('comment by {0} at {1}: "{2}"'.format(userid, time.ctime(), text))
-        self._msg('playlist_update')
+        self._queue_changed()
 
     def get_comments(self, id):
         key = self._key('COMMENTS|{0}'.format(id))
         raw_comments = self._r.zrange(key, 0, self._r.zcard(key), withscores=True)
+        comments = self._decode_comments(raw_comments)
+        logger.debug("comments for %s: %s" % (id, comments))
+        return comments
+
+    @staticmethod
+    def _decode_comments(raw_comments):
         comments = []
         for text, secs in raw_comments:
             parts = text.split('||')
             comments.append({'time': secs,
                              'user': parts[0],
                              'body': parts[1] if len(parts) > 1 else ''})
-        logger.debug("comments for %s: %s" % (id, comments))
         return comments
 
 
@@ -1497,14 +2129,13 @@ class DB(object):
             self._r.hdel(self._key('BENDER|throwback-users'), trackId)
             self._r.hdel(self._key('BENDER|throwback-jam-pending'), trackId)
 
-        self._r.delete(self._key('BENDER|next-preview'))
+        self._clear_preview()
+        self._player_command('preview')
         newId = self.add_spotify_song(userid, trackId)
         if original_user:
             # Throwback: only jam the original queuer, not the person who clicked Queue
-            self.add_jam(self._key('QUEUEJAM|{0}'.format(newId)), original_user)
-            tb_key = self._key('QUEUEJAM_TB|{0}'.format(newId))
-            self._r.sadd(tb_key, original_user)
-            self._r.expire(tb_key, 24*60*60)
+            self.add_jam(self._key('QUEUEJAM|{0}'.format(newId)), original_user,
+                         throwback=True)
         else:
             # Non-throwback: jam the queuer as usual
             self.jam(newId, userid)
@@ -1523,16 +2154,17 @@ class DB(object):
             if strategy == 'throwback':
                 self._r.hdel(self._key('BENDER|throwback-users'), trackId)
 
-        # Always clear the preview so a fresh one is generated on next get_additional_src
-        self._r.delete(self._key('BENDER|next-preview'))
+        # Always clear the preview so master_player builds a fresh card
+        self._clear_preview()
+        self._player_command('preview')
         self._r.setex(self._key('FILTER|%s' % trackId), CONF.BENDER_FILTER_TIME, 1)
-        self._msg('playlist_update')
+        self._queue_changed()
         logger.info("benderfilter %s by %s", trackId, userid)
 
 
-    def get_song_from_queue(self, id):
-        key = self._key('QUEUE|{0}'.format(id))
-        data = self._r.hgetall(key)
+    @staticmethod
+    def _decode_song(data):
+        """Convert the typed fields of a raw QUEUE hash in place."""
         if 'duration' in data:
             try:
                 data['duration'] = int(float(data['duration']))
@@ -1542,12 +2174,26 @@ class DB(object):
             data['auto'] = (data['auto'] == 'True')
         else:
             data['auto'] = False
+        return data
+
+    def get_song_from_queue(self, id):
+        key = self._key('QUEUE|{0}'.format(id))
+        data = self._decode_song(self._r.hgetall(key))
         data['jam'] = self.get_jams(self._key('QUEUEJAM|{0}'.format(id)))
         data['comments'] = self.get_comments(id)
         return data or {}
 
     def set_song_in_queue(self, id, data, client=None):
         key = self._key('QUEUE|{0}'.format(id))
+        client = client or self._r
+        client.hset(key, mapping=self._serialize_song(data, client))
+        client.expire(key, QUEUE_ENTRY_TTL)
+        client.zadd(self._key('MISC|queue-expiry'), {str(id): int(time.time()) + QUEUE_ENTRY_TTL})
+
+    def _serialize_song(self, data, client=None):
+        """Return the QUEUE hash mapping for *data*, stashing its raw payload."""
+        data = dict(data)
+        self._stash_payload(data, client)
         # Redis requires string values - serialize complex types
         serialized_data = {}
         for k, v in data.items():
@@ -1561,125 +2207,282 @@ class DB(object):
                 serialized_data[k] = ''
             else:
                 serialized_data[k] = str(v) if not isinstance(v, str) else v
+        return serialized_data
+
+    @staticmethod
+    def _payload_key(src, trackid):
+        """Global (not nest-scoped) key of a track's raw provider payload."""
+        return 'TRACK-PAYLOAD|' + _track_uri(src, trackid)
+
+    def _stash_payload(self, song, client=None):
+        """Move song['data'] (the raw provider response) to TRACK-PAYLOAD|{uri}.
+
+        Queue entries and caches keep only the fields the UI and player use;
+        the payload is written once per track URI and refreshed on re-add.
+        """
+        payload = song.pop('data', None)
+        if not isinstance(payload, (dict, list)) or not song.get('trackid'):
+            return
         client = client or self._r
-        client.hset(key, mapping=serialized_data)
-        client.expire(key, 24*60*60)
+        client.set(self._payload_key(song.get('src', ''), song['trackid']),
+                   _encode_payload(payload), ex=TRACK_PAYLOAD_TTL)
+
+    def get_track_payload(self, src, trackid):
+        """Return the raw provider response stored for a track, or None.
+
+        A Spotify track whose payload has expired is looked up in the
+        global catalog.
+        """
+        try:
+            payload = _decode_payload(self._r.get(self._payload_key(src, trackid)))
+        except (ValueError, zlib.error):
+            logger.warning("unreadable payload for %s", _track_uri(src, trackid))
+            payload = None
+        if payload is None and src == 'spotify':
+            payload = self._catalog.get(catalog.track_uri(trackid))
+        return payload
 
     def nuke_queue(self, email):
         self._check_nest_active()
-        self._r.zremrangebyrank(self._key('MISC|priority-queue'), 0, -1)
-        self._msg('playlist_update')
+        self._script('QUEUE_CLEAR')(
+            keys=[self._key('MISC|priority-queue'), self._key('MISC|queue-expiry')],
+            args=[self._key('')])
+        self._queue_changed()
 
     def kill_song(self, id, email):
         self._check_nest_active()
-        self._r.zrem(self._key('MISC|priority-queue'), id)
-        self._msg('playlist_update')
+        self._remove_from_queue(id)
+        self._queue_changed()
+
+    def _remove_from_queue(self, *ids):
+        """Drop ids from the priority queue and its expiry and per-user indexes."""
+        return self._script('QUEUE_REMOVE')(
+            keys=[self._key('MISC|priority-queue'), self._key('MISC|queue-expiry')],
+            args=[self._key('')] + [str(i) for i in ids])
 
     def get_additional_src(self):
-        raw = self._r.hgetall(self._key('MISC|backup-queue-data'))
-        if not raw:
-            # Use _peek_next_fill_song to find the next preview
-            for _ in range(5):
-                try:
-                    self.ensure_fill_songs()
-                except Exception as e:
-                    logger.warning("Failed to ensure fill songs: %s", e)
-                    break
+        """Return the card shown after the queue: backup playlist or Bender preview.
 
-                track_uri, user, strategy = self._peek_next_fill_song()
-                if not track_uri:
-                    break
+        Only reads Redis; the Bender preview card is built off the read path
+        by refresh_preview_card().  Until it exists a placeholder is served.
+        """
+        pipe = self._r.pipeline(transaction=False)
+        pipe.hgetall(self._key('MISC|backup-queue-data'))
+        pipe.get(self._key('MISC|preview-card'))
+        raw, card = pipe.execute()
+        if raw:
+            raw['playlist_src'] = True
+            return raw
+        if card:
+            try:
+                return json.loads(card)
+            except ValueError:
+                logger.warning("Discarding unreadable preview card: %r", card)
+        return self._preview_placeholder('Finding the next song')
 
-                try:
-                    fillInfo = self.get_fill_info(track_uri)
-                    title = fillInfo['title']
-                    fillInfo['title'] = fillInfo['artist'] + " : " + title
+    @staticmethod
+    def _preview_placeholder(title):
+        return {'playlist_src': True, 'name': 'Benderbot', 'user': 'the@echonest.com',
+                'title': title, 'img': '', 'jam': [], 'dm_buttons': False}
 
-                    fillInfo['name'] = 'Benderbot'
-                    fillInfo['user'] = 'the@echonest.com'
+    def build_preview_card(self):
+        """Resolve the Bender preview and its track info; may call Spotify.
 
-                    if strategy == 'throwback':
-                        fillInfo['name'] = 'Benderbot (throwback)'
+        Returns (card, track_uri); track_uri is None for the fallback card
+        shown when no fill songs are available.
+        """
+        for _ in range(5):
+            try:
+                self.ensure_fill_songs()
+            except Exception as e:
+                logger.warning("Failed to ensure fill songs: %s", e)
+                break
 
-                    fillInfo['playlist_src'] = True
-                    fillInfo['dm_buttons'] = False
+            track_uri, user, strategy = self._peek_next_fill_song()
+            if not track_uri:
+                break
 
-                    # Show original queuer as a throwback jam in the preview
-                    preview = self._r.hgetall(self._key('BENDER|next-preview'))
-                    original_user = preview.get('original_user', '') if preview else ''
-                    if original_user:
-                        fillInfo['jam'] = [{'user': original_user, 'throwback': True}]
-                    else:
-                        fillInfo['jam'] = []
-                    return fillInfo
-                except Exception:
-                    logger.error('song not available: %s', track_uri)
-                    logger.error('backtrace: %s', traceback.format_exc())
-                    # Clear preview and pop from cache so we move to next
-                    preview = self._r.hgetall(self._key('BENDER|next-preview'))
-                    if preview:
-                        strat = preview.get('strategy', '')
-                        ck = self._cache_key(strat)
-                        if ck:
-                            self._r.lpop(ck)
-                        if strat == 'throwback':
-                            self._r.hdel(self._key('BENDER|throwback-users'), track_uri)
-                        self._r.delete(self._key('BENDER|next-preview'))
-                    continue
+            try:
+                fillInfo = self.get_fill_info(track_uri)
+                title = fillInfo['title']
+                fillInfo['title'] = fillInfo['artist'] + " : " + title
 
-            # Fallback when fill songs are unavailable
-            return {'playlist_src': True, 'name': 'Benderbot', 'user': 'the@echonest.com',
-                    'title': 'No songs available', 'img': '', 'jam': [], 'dm_buttons': False}
+                fillInfo['name'] = 'Benderbot'
+                fillInfo['user'] = 'the@echonest.com'
 
-        raw['playlist_src'] = True
-        return raw
+                if strategy == 'throwback':
+                    fillInfo['name'] = 'Benderbot (throwback)'
 
-    def get_queued(self):
-        self._purge_stale_queue_entries()
-        songs = self._r.zrange(self._key('MISC|priority-queue'), 0, -1, withscores=True)
+                fillInfo['playlist_src'] = True
+                fillInfo['dm_buttons'] = False
+
+                # Show original queuer as a throwback jam in the preview
+                preview = self._r.hgetall(self._key('BENDER|next-preview'))
+                original_user = preview.get('original_user', '') if preview else ''
+                if original_user:
+                    fillInfo['jam'] = [{'user': original_user, 'throwback': True}]
+                else:
+                    fillInfo['jam'] = []
+                return fillInfo, track_uri
+            except Exception:
+                logger.error('song not available: %s', track_uri)
+                logger.error('backtrace: %s', traceback.format_exc())
+                # Clear preview and pop from cache so we move to next
+                preview = self._r.hgetall(self._key('BENDER|next-preview'))
+                if preview:
+                    strat = preview.get('strategy', '')
+                    ck = self._cache_key(strat)
+                    if ck:
+                        self._r.lpop(ck)
+                    if strat == 'throwback':
+                        self._r.hdel(self._key('BENDER|throwback-users'), track_uri)
+                    self._clear_preview()
+                continue
+
+        # Fallback when fill songs are unavailable
+        return self._preview_placeholder('No songs available'), None
+
+    def refresh_preview_card(self):
+        """Build the Bender preview card and store it at MISC|preview-card.
+
+        The card is only stored if BENDER|next-preview still names the same
+        track once the build finishes; otherwise the next refresh picks up
+        the new preview.  The fallback card expires after
+        PREVIEW_CARD_RETRY_SECONDS so an empty Bender is retried.  Returns
+        the stored card, or None if the preview changed mid-build.  While
+        this DB holds the player lease the write is fenced like the player's
+        own: it raises PlayerLeaseLost once a newer player has taken over.
+        """
+        card, track_uri = self.build_preview_card()
+        preview_key = self._key('BENDER|next-preview')
+        epoch = self._key('MISC|player-epoch')
+        fence = self._fence
+        with self._r.pipeline() as pipe:
+            try:
+                if fence is not None:
+                    pipe.watch(preview_key, epoch)
+                    if pipe.get(epoch) != str(fence):
+                        raise PlayerLeaseLost('player lease token %s is stale' % fence)
+                else:
+                    pipe.watch(preview_key)
+                if pipe.hget(preview_key, 'trackid') != track_uri:
+                    return None
+                pipe.multi()
+                ttl = None if track_uri else (getattr(CONF, 'PREVIEW_CARD_RETRY_SECONDS', None) or 60)
+                pipe.set(self._key('MISC|preview-card'), json.dumps(card, default=str), ex=ttl)
+                pipe.incr(self._key('MISC|queue-version'))
+                pipe.execute()
+            except redis.WatchError:
+                if fence is not None and self._r.get(epoch) != str(fence):
+                    raise PlayerLeaseLost('player lease token %s is stale' % fence)
+                return None
+        self._msg('playlist_update')
+        return card
+
+    def _ensure_preview_card(self):
+        """Start a background refresh if the preview card is missing."""
+        if self._preview_refresh is not None and not self._preview_refresh.dead:
+            return
+        if self._r.exists(self._key('MISC|preview-card')):
+            return
+        self._preview_refresh = gevent.spawn(self._refresh_preview_card_logged)
+
+    def _refresh_preview_card_logged(self):
+        try:
+            card = self.refresh_preview_card()
+        except Exception:
+            logger.warning("preview card refresh failed: %s", traceback.format_exc())
+            return
+        if card is not None and not card.get('trackid'):
+            # The fallback card expires so an empty Bender is retried; look
+            # again once it has
+            retry = getattr(CONF, 'PREVIEW_CARD_RETRY_SECONDS', None) or 60
+            self._preview_retry = time.monotonic() + retry + 1
+
+    def _clear_preview(self):
+        """Drop the Bender preview and the card built from it."""
+        self._r.delete(self._key('BENDER|next-preview'), self._key('MISC|preview-card'))
+
+    def get_queue_snapshot(self):
+        """Return the queued songs, in order, with jams, comments and score.
+
+        Everything is read by one Lua script, so the cost is a single round
+        trip regardless of queue depth.  Entries whose QUEUE hash expired are
+        purged from the priority queue by the same script.  Unlike
+        get_queued() the Bender preview card is not appended.
+        """
+        entries, stale = self._script('QUEUE_SNAPSHOT')(
+            keys=[self._key('MISC|priority-queue')], args=[self._key('')])
+        if stale:
+            logger.warning("Purging %d stale queue entry/entries: %s", len(stale), stale)
         rv = []
-        for k in songs:
-            data = self.get_song_from_queue(k[0])
-            if not data or 'src' not in data:
+        for id, score, song_flat, jams_flat, tb_users, comments_flat in entries:
+            data = self._decode_song(dict(zip(song_flat[::2], song_flat[1::2])))
+            if 'src' not in data:
                 continue
-            data["score"] = k[1]
+            data['jam'] = self._decode_jams(_pairs(jams_flat), set(tb_users))
+            data['comments'] = self._decode_comments(_pairs(comments_flat))
+            data['score'] = float(score)
             rv.append(data)
+        return rv
+
+    def get_queued(self):
+        rv = self.get_queue_snapshot()
         rv.append(self.get_additional_src())
         return rv
 
-    def pop_next(self):
-        while True:
-            song = self._r.zrange(self._key('MISC|priority-queue'), 0, 0)
-            if not song:
-                self._r.delete(self._key('MISC|now-playing'))
-                return {}
-            song = song[0]
-            self._r.zrem(self._key('MISC|priority-queue'), song)
-            data = self.get_song_from_queue(song)
-
-            if (data and data.get('src') == 'spotify'
-                    and data.get('user') != 'the@echonest.com'):
-                #got something from a human, set last-queued and clear bender caches
-                self._r.set(self._key('MISC|last-queued'), data['trackid'])
-                self._clear_all_bender_caches()
-                try:
-                    self.ensure_fill_songs()
-                except Exception as e:
-                    logger.warning("Failed to ensure fill songs: %s", e)
-                self._r.delete(self._key('MISC|bender_streak_start'))
+    def pop_next(self, now=None):
+        """Pop the head of the queue and make it the playing song.
+
+        Returns the song's queue hash (without jams or comments), or {} if
+        the queue is empty.  Removing the head, setting MISC|now-playing and
+        MISC|now-playing-done and bumping the version are one QUEUE_POP
+        script call, so overlapping players can't both play the same song.
+        Given the player clock *now*, the same call sets MISC|current-done
+        and MISC|started-on for the song.  When the song came from a human,
+        the Bender caches are reset in the background.  While this DB holds
+        the player lease the pop is fenced: it raises PlayerLeaseLost, and
+        pops nothing, once a newer player has taken over.
+        """
+        try:
+            popped = self._script('QUEUE_POP')(
+                keys=[self._key('MISC|priority-queue'), self._key('MISC|queue-expiry'),
+                      self._key('MISC|now-playing'), self._key('MISC|now-playing-done'),
+                      self._key('MISC|queue-version'), self._key('MISC|last-queued'),
+                      self._key('MISC|bender_streak_start'), self._key('MISC|current-done'),
+                      self._key('MISC|started-on'), self._key('MISC|player-epoch')],
+                args=[self._key(''), 'the@echonest.com', NOW_PLAYING_TTL, PLAYING_ENTRY_TTL,
+                      epoch_dump(now) if now else '', now.isoformat() if now else '',
+                      self._fence or ''])
+        except redis.exceptions.ResponseError as e:
+            if str(e).startswith('FENCED'):
+                raise PlayerLeaseLost(str(e))
+            raise
+        if not popped:
+            return {}
+        _, song_flat, human = popped
+        data = self._decode_song(dict(zip(song_flat[::2], song_flat[1::2])))
+        if human:
+            self._bender_reset = gevent.spawn(self._reset_bender_logged)
+        self._msg('now_playing_update')
+        if self.nest_id == "main":
+            slack.notify_now_playing(data, get_payload=lambda: self.get_track_payload(
+                data.get('src', ''), data.get('trackid', '')))
+        return data
 
-            if 'src' not in data:
-                # Song hash expired or is corrupt — skip it
-                logger.warning("Skipping song %s with missing data (keys: %s)", song, list(data.keys()))
-                continue
+    def _reset_bender_logged(self):
+        """Drop the Bender caches after a human's song and pre-warm one strategy."""
+        self._clear_all_bender_caches()
+        try:
+            self.ensure_fill_songs()
+        except Exception as e:
+            logger.warning("Failed to ensure fill songs: %s", e)
 
-            self._r.expire(self._key('QUEUE|{0}'.format(song)), 3*60*60)
-            self._r.setex(self._key('MISC|now-playing'), 2*60*60, song)
-            self._r.setex(self._key('MISC|now-playing-done'), data['duration'], song)
-            self._msg('now_playing_update')
-            if self.nest_id == "main":
-                slack.notify_now_playing(data)
-            return data
+    def _wait_bender_reset(self):
+        """Block until a pending Bender cache reset from pop_next() finishes."""
+        if self._bender_reset is not None:
+            self._bender_reset.join()
+            self._bender_reset = None
 
     def song_end_time(self, use_estimate=True):
         '''
@@ -1692,7 +2495,7 @@ class DB(object):
         if use_estimate:
             end_time = self._r.get(self._key('MISC|current-done'))
             if end_time:
-                end_time = pickle_load_b64(end_time).isoformat()
+                end_time = epoch_load(end_time).isoformat()
 
         if not end_time:
             end_time = self.player_now().isoformat()
@@ -1713,7 +2516,7 @@ class DB(object):
                 rv['endtime'] = self.song_end_time(use_estimate=True)
                 rv['pos'] = 0
                 if p_endtime:
-                    remaining = (pickle_load_b64(p_endtime) - self.player_now()).total_seconds()
+                    remaining = (epoch_load(p_endtime) - self.player_now()).total_seconds()
                     rv['pos'] = int(max(0,rv['duration'] - remaining))
 
         paused = self._r.get(self._key('MISC|paused'))
@@ -1729,105 +2532,46 @@ class DB(object):
         return self._r.lrange(self._key('AIRHORNS'), 0, -1)
 
     def vote(self, userid, id, up):
-        self._check_nest_active()
-        norm_color = [34, 34, 34]
-        base_hot = [34, 34, 34]
-        hot_color = [68, 68, 68]
-        cold_color = [0, 0, 0]
-        user = self.get_song_from_queue(id).get('user', '')
-        self_down = user == userid and not up
-        s_id = self._key('QUEUE|VOTE|{0}'.format(id))
-        if (not self_down and
-                (self._r.sismember(s_id, userid)
-                 and userid.lower() not in CONF.SPECIAL_PEOPLE)):
-            logger.info("not special, not self down, already voted")
-            return
-
-        self._r.sadd(s_id, userid)
-        exist_rank = self._r.zrank(self._key('MISC|priority-queue'), id)
-        logger.info("existing rank is:" + str(exist_rank))
-        if up:
-            low_rank = exist_rank - 2
-        else:
-            low_rank = exist_rank + 1
-
-        high_rank = low_rank + 1
-        logger.info("low_rank:" + str(low_rank))
-        logger.info("high_rank:" + str(high_rank))
-        ids = self._r.zrange(self._key('MISC|priority-queue'), max(low_rank, 0), high_rank)
-        logger.info("ids:" + str(ids))
-        if len(ids) == 0:
-            return #nothing to do here
-        low_id = ids[0]
-        current_score = self._r.zscore(self._key('MISC|priority-queue'), id)
-        logger.info("current_score:" + str(current_score))
-        low_score = self._r.zscore(self._key('MISC|priority-queue'), low_id)
-        logger.info("low_score:" + str(low_score))
-        if len(ids) == 1:
-            if low_rank == -1:
-                #before first
-                new_score = low_score - 120.0
-            else:
-                #after last
-                new_score = low_score + 120.0
-        else:
-            high_id = ids[1]
-            high_score = self._r.zscore(self._key('MISC|priority-queue'), high_id)
-            logger.info("high_score:" + str(high_score))
-            new_score = (low_score + high_score) / 2
+        """Vote song *id* up or down; return its new rank, or None if it didn't move.
 
-        queue_key = self._key('QUEUE|{0}'.format(id))
-
-        if up:
-            self._r.hincrby(queue_key, "vote", 1)
-        elif not self_down:
-            self._r.hincrby(queue_key, "vote", -1)
-
-        votes = int(self._r.hget(queue_key, "vote"))
-
-        steps = 5
-        if votes > 0:
-            other_color = hot_color
-            base_color = base_hot
-        else:
-            # 0 goes here
-            other_color = cold_color
-            base_color = norm_color
-
-        votes = abs(votes)
-        votes = min(votes, 5)
-
-        color_string = ""
-        color_sum = 0
-        for i in range(3):
-            new_color = ((votes * other_color[i]) + ((steps - votes) * base_color[i])) // steps
-            color_sum += new_color
-            color_string += "{:02x}".format(int(new_color))
-
-
-
-        # set background color
-        self._r.hset(queue_key, "background_color", color_string)
-        if color_sum > (130 * 3):
-            self._r.hset(queue_key, "foreground_color", "0f0f0f")
-        else:
-            self._r.hset(queue_key, "foreground_color", "f0f0ff")
-
-        size = new_score - current_score
-        logger.info("size:" + str(size))
-        self._r.zincrby(self._key('MISC|priority-queue'), size, id)
+        The dedupe check, the move between neighbors, the vote counter, the
+        background color and the version bump all happen in one QUEUE_VOTE
+        script call, so concurrent votes on the same song can't interleave.
+        An up vote on the head of the queue still counts (and updates the
+        playlist) but returns None.
+        """
+        self._check_nest_active()
+        repeat_ok = userid.lower() in (CONF.SPECIAL_PEOPLE or ())
+        counted = self._script('QUEUE_VOTE')(
+            keys=[self._key('MISC|priority-queue'), self._key('MISC|queue-version')],
+            args=[self._key(''), id, userid, int(bool(up)), int(repeat_ok)])
+        if counted is None:
+            logger.info("vote from %s on %s changed nothing", userid, id)
+            return None
         self._msg('playlist_update')
+        rank, moved = counted
+        return rank if moved else None
 
     def kill_playing(self, email):
         self._check_nest_active()
         if self.nest_id == "main":
             playing = self.get_now_playing()
             slack.notify_skip(email, playing.get('title', ''), playing.get('artist', '') if playing else '')
-        self._r.set(self._key('MISC|force-jump'), 1)
+        # Name the song, so a second press (or a stale command after a
+        # failover) doesn't skip the one after it
+        playing_id = self._r.get(self._key('MISC|now-playing'))
+        self._player_command('skip|{0}'.format(playing_id) if playing_id else 'skip')
 
     def pause(self, email):
         self._check_nest_active()
-        self._r.set(self._key('MISC|paused'), 1)
+        clock = self._key('MISC|clock')
+        now = time.time()
+        pipe = self._r.pipeline()
+        pipe.set(self._key('MISC|paused'), 1)
+        pipe.hsetnx(clock, 'start', now)
+        pipe.hsetnx(clock, 'paused-since', now)
+        pipe.execute()
+        self._player_command('pause')
         self._msg('now_playing_update')
         if self.nest_id == "main":
             slack.notify_pause(email)
@@ -1835,6 +2579,8 @@ class DB(object):
     def unpause(self, email):
         self._check_nest_active()
         self._r.delete(self._key('MISC|paused'))
+        self._script('CLOCK_RESUME')(keys=[self._key('MISC|clock')], args=[time.time()])
+        self._player_command('unpause')
         # If the song timer expired while paused, clear stale now-playing
         # so the player loop advances to the next track immediately.
         now_playing_id = self._r.get(self._key('MISC|now-playing'))
@@ -1931,11 +2677,24 @@ class DB(object):
     def _msg(self, msg):
         self._r.publish(self._key('MISC|update-pubsub'), msg)
 
+    def get_queue_version(self):
+        """Return the nest's queue version; it changes whenever the playlist does."""
+        return int(self._r.get(self._key('MISC|queue-version')) or 0)
+
+    def _queue_changed(self, msg='playlist_update'):
+        """Bump the queue version, then notify listeners.
+
+        Listeners rebuild through playlist_cache, which keys snapshots on the
+        version, so the bump must land before the message goes out.
+        """
+        self._r.incr(self._key('MISC|queue-version'))
+        self._msg(msg)
+
     def try_login(self, email, passwd):
         from werkzeug.security import check_password_hash
         email = email.lower()
         d = self._r.hget(self._key('MISC|guest-login-expire'), email)
-        if not d or pickle_load_b64(d) < _now():
+        if not d or epoch_load(d) < _now():
             self._r.hdel(self._key('MISC|guest-login'), email)
             return False
         full_pass = self._r.hget(self._key('MISC|guest-login'), email)
@@ -1960,7 +2719,7 @@ class DB(object):
         email = email.lower()
         expires = _now() + datetime.timedelta(days=days)
         hashed = generate_password_hash(password)
-        self._r.hset(self._key('MISC|guest-login-expire'), email, pickle_dump_b64(expires))
+        self._r.hset(self._key('MISC|guest-login-expire'), email, epoch_dump(expires))
         self._r.hset(self._key('MISC|guest-login'), email, hashed)
 
     def _airhorners_for_song_log(self, id):
@@ -1,5 +1,6 @@
 """SSE subscription loop + state machine for syncing local Spotify."""
 
+import collections
 import json
 import logging
 import threading
@@ -13,6 +14,9 @@ from .audio import download_audio, play_audio
 
 log = logging.getLogger(__name__)
 
+# Recent player_position frames used to estimate the server clock offset
+CLOCK_SAMPLES = 8
+
 
 def _elapsed_seconds(starttime_str, now_str):
     """Seconds elapsed between two server timestamps (same clock, no TZ needed)."""
@@ -21,6 +25,34 @@ def _elapsed_seconds(starttime_str, now_str):
     return max(0, (now - start).total_seconds())
 
 
+def _queue_item_key(item):
+    """Identity of a queue item in diff ops (the preview card has no id)."""
+    return str(item.get("id") or "") or "__preview__"
+
+
+def _apply_queue_diff(items, ops):
+    """Apply server diff ops to a queue list; None if an op doesn't fit."""
+    items = list(items)
+    for op in ops:
+        kind = op.get("op")
+        if kind == "insert":
+            items.insert(op["index"], op["item"])
+            continue
+        keys = [_queue_item_key(x) for x in items]
+        if op.get("id") not in keys:
+            return None
+        idx = keys.index(op["id"])
+        if kind == "remove":
+            del items[idx]
+        elif kind == "patch":
+            items[idx] = {**items[idx], **op.get("fields", {})}
+        elif kind == "move":
+            items.insert(op["index"], items.pop(idx))
+        else:
+            return None
+    return items
+
+
 class SyncAgent:
     def __init__(self, server, token, player, drift_threshold=3, channel=None):
         self.server = server.rstrip("/")
@@ -45,6 +77,16 @@ class SyncAgent:
         # Airhorn state
         self.airhorn_enabled = True
 
+        # Queue state for applying queue_diff events (seq = server queue version)
+        self._queue = []
+        self._queue_seq = None
+
+        # Last player_position frame as (pos, monotonic receive time, paused,
+        # started); frames only come on start/pause/resume and periodic resyncs
+        self._position = None
+        # Local wall clock minus server clock, one sample per frame
+        self._clock_samples = collections.deque(maxlen=CLOCK_SAMPLES)
+
     # ------------------------------------------------------------------
     # IPC helpers (no-ops when channel is None)
     # ------------------------------------------------------------------
@@ -146,6 +188,7 @@ class SyncAgent:
             while not stop.is_set():
                 self._process_commands()
                 self._check_user_override()
+                self._tick_position()
                 stop.wait(1)
 
         t = threading.Thread(target=_poll, daemon=True)
@@ -208,6 +251,7 @@ class SyncAgent:
                 self.player.play_track(uri)
             self.current_track_uri = uri
             self.paused = is_paused
+            self._position = None
             self._override_count = 0  # Reset on server track change
             # Grace period after track change to let Spotify load
             self._override_grace_until = time.time() + 15
@@ -262,34 +306,95 @@ class SyncAgent:
                 if elapsed > 0:
                     self.player.seek_to(elapsed)
 
+    def server_position(self):
+        """Interpolated server position in seconds, or None before any frame.
+
+        Frames carry *started*, the server epoch at which the song was at
+        0s, so the position is read off the server clock rather than
+        counted from when the frame happened to arrive.  Frames from a
+        server without it fall back to the receive time.
+        """
+        if self._position is None:
+            return None
+        pos, received, paused, started = self._position
+        if paused or self.paused:
+            return pos
+        if started is not None and self._clock_samples:
+            return max(time.time() - min(self._clock_samples) - started, 0)
+        return pos + (time.monotonic() - received)
+
+    def _sample_clock(self, pos, started):
+        """Record how far the local clock is ahead of the server's.
+
+        The frame left the server at started + pos (plus the fraction of a
+        second *pos* was floored by) and took some time to arrive, so each
+        sample overestimates the offset; the smallest recent one is the
+        closest.
+        """
+        self._clock_samples.append(time.time() - (started + pos))
+
+    def _tick_position(self):
+        """Emit the interpolated position so the tray advances between frames."""
+        if self._position is None or self._position[2] or self.paused:
+            return
+        self._emit("player_position", pos=int(self.server_position()))
+
     def _handle_player_position(self, data):
         """Process a player_position event for drift correction."""
         src = data.get("src", "")
         if src != "spotify" or self.current_track_uri is None:
             return
+        started = data.get("started")
+        if started is not None:
+            self._sample_clock(data.get("pos", 0), started)
+        self._position = (data.get("pos", 0), time.monotonic(), bool(data.get("paused")), started)
 
         if not self._is_sync_active():
             return
 
-        server_pos = data.get("pos", 0)
+        server_pos = self.server_position() if started is not None else data.get("pos", 0)
         local_pos = self.player.get_position()
         if local_pos is None:
             return
 
-        self._emit("player_position", pos=server_pos)
+        self._emit("player_position", pos=int(server_pos))
 
         drift = abs(local_pos - server_pos)
         if drift > self.drift_threshold:
-            log.info("Drift correction: local=%.1fs server=%ds (drift=%.1fs)",
+            log.info("Drift correction: local=%.1fs server=%.1fs (drift=%.1fs)",
                      local_pos, server_pos, drift)
             self.player.seek_to(server_pos)
 
     def _handle_queue_update(self, data):
-        """Process a queue_update event (list of queued tracks)."""
-        if not isinstance(data, list):
+        """Process a queue update.
+
+        Accepts a full list (legacy queue_update), a {seq, queue} snapshot
+        (queue_snapshot, /api/queue) or a {base, seq, ops} diff (queue_diff).
+        A diff that doesn't start from our seq triggers a full refetch.
+        """
+        seq = None
+        if isinstance(data, dict) and "ops" in data:
+            queue = None
+            if self._queue_seq is not None and data.get("base") == self._queue_seq:
+                queue = _apply_queue_diff(self._queue, data.get("ops") or [])
+            if queue is None:
+                log.debug("Queue diff gap (have %s, diff base %s) — refetching",
+                          self._queue_seq, data.get("base"))
+                self._queue_seq = None
+                self._fetch_queue()
+                return
+            seq = data.get("seq")
+        elif isinstance(data, dict):
+            queue = data.get("queue")
+            seq = data.get("seq")
+        else:
+            queue = data
+        if not isinstance(queue, list):
             return
+        self._queue = queue
+        self._queue_seq = seq
         tracks = []
-        for item in data:
+        for item in queue:
             title = item.get("title", "")
             artist = item.get("artist", "")
             if title and artist:
@@ -353,7 +458,8 @@ class SyncAgent:
             )
             resp.raise_for_status()
             data = resp.json()
-            self._handle_queue_update(data.get("queue", []))
+            self._handle_queue_update({"queue": data.get("queue", []),
+                                       "seq": data.get("seq")})
         except Exception as e:
             log.debug("Queue fetch failed: %s", e)
 
@@ -385,6 +491,7 @@ class SyncAgent:
                 log.info("Connecting to %s/api/events ...", self.server)
                 resp = requests.get(
                     f"{self.server}/api/events",
+                    params={"diffs": "1"},
                     headers=self._headers(),
                     stream=True,
                     timeout=(10, None),  # 10s connect, no read timeout
@@ -423,7 +530,7 @@ class SyncAgent:
                         self._handle_now_playing(data)
                     elif event.event == "player_position":
                         self._handle_player_position(data)
-                    elif event.event == "queue_update":
+                    elif event.event in ("queue_update", "queue_snapshot", "queue_diff"):
                         self._handle_queue_update(data)
                     elif event.event == "airhorn":
                         self._handle_airhorn(data)
@@ -10,8 +10,9 @@ from click.testing import CliRunner
 
 from echonest_sync.cli import main
 from echonest_sync.config import load_config
+from echonest_sync.ipc import SyncChannel
 from echonest_sync.player import SpotifyPlayer
-from echonest_sync.sync import SyncAgent, _elapsed_seconds
+from echonest_sync.sync import SyncAgent, _apply_queue_diff, _elapsed_seconds
 
 
 # ---------------------------------------------------------------------------
@@ -354,6 +355,121 @@ class TestHandlePlayerPosition:
         agent._handle_player_position({"src": "spotify", "trackid": "abc123", "pos": 20})
         assert ("seek_to", 20) in player.calls
 
+    def test_server_position_interpolates_between_frames(self):
+        """Frames arrive every few seconds; the agent advances from the last one."""
+        player = MockPlayer(position=20.0)
+        agent = SyncAgent("https://test", "tok", player, drift_threshold=3)
+        agent.current_track_uri = "spotify:track:abc123"
+        assert agent.server_position() is None
+
+        with patch("echonest_sync.sync.time.monotonic", return_value=100.0):
+            agent._handle_player_position({"src": "spotify", "trackid": "abc123", "pos": 20})
+        with patch("echonest_sync.sync.time.monotonic", return_value=107.5):
+            assert agent.server_position() == pytest.approx(27.5)
+
+    def test_server_position_holds_while_paused(self):
+        player = MockPlayer(position=20.0)
+        agent = SyncAgent("https://test", "tok", player, drift_threshold=3)
+        agent.current_track_uri = "spotify:track:abc123"
+
+        with patch("echonest_sync.sync.time.monotonic", return_value=100.0):
+            agent._handle_player_position(
+                {"src": "spotify", "trackid": "abc123", "pos": 20, "paused": True})
+        with patch("echonest_sync.sync.time.monotonic", return_value=130.0):
+            assert agent.server_position() == 20
+
+    def test_server_position_anchors_to_started(self):
+        """A late frame doesn't drag the position back: it is read off started."""
+        player = MockPlayer(position=20.0)
+        agent = SyncAgent("https://test", "tok", player, drift_threshold=3)
+        agent.current_track_uri = "spotify:track:abc123"
+        # Local clock 5 s ahead of the server's; the song started at server 1000
+        with patch("echonest_sync.sync.time.time", return_value=1025.2):
+            agent._handle_player_position(
+                {"src": "spotify", "trackid": "abc123", "pos": 20, "started": 1000.0})
+        # This frame sat in a buffer for 2 s
+        with patch("echonest_sync.sync.time.time", return_value=1037.0):
+            agent._handle_player_position(
+                {"src": "spotify", "trackid": "abc123", "pos": 30, "started": 1000.0})
+        with patch("echonest_sync.sync.time.time", return_value=1040.2):
+            assert agent.server_position() == pytest.approx(35.0)
+
+    def test_drift_measured_against_started(self):
+        player = MockPlayer(position=20.0)
+        agent = SyncAgent("https://test", "tok", player, drift_threshold=3)
+        agent.current_track_uri = "spotify:track:abc123"
+        with patch("echonest_sync.sync.time.time", return_value=1020.0):
+            agent._handle_player_position(
+                {"src": "spotify", "trackid": "abc123", "pos": 20, "started": 1000.0})
+        # Arrives 5 s late: the server is at 35 s by now, not 30
+        with patch("echonest_sync.sync.time.time", return_value=1035.0):
+            agent._handle_player_position(
+                {"src": "spotify", "trackid": "abc123", "pos": 30, "started": 1000.0})
+        assert ("seek_to", pytest.approx(35.0)) in player.calls
+
+    def test_tick_emits_interpolated_position(self):
+        player = MockPlayer(position=20.0)
+        channel = SyncChannel()
+        agent = SyncAgent("https://test", "tok", player, drift_threshold=3, channel=channel)
+        agent.current_track_uri = "spotify:track:abc123"
+
+        with patch("echonest_sync.sync.time.monotonic", return_value=100.0):
+            agent._handle_player_position({"src": "spotify", "trackid": "abc123", "pos": 20})
+        channel.get_events()
+        with patch("echonest_sync.sync.time.monotonic", return_value=104.2):
+            agent._tick_position()
+        assert [(e.type, e.kwargs) for e in channel.get_events()] == [("player_position", {"pos": 24})]
+
+
+# ---------------------------------------------------------------------------
+# SyncAgent — queue snapshots and diffs
+# ---------------------------------------------------------------------------
+
+class TestHandleQueueUpdate:
+    QUEUE = [
+        {"id": "1", "title": "One", "artist": "A"},
+        {"id": "2", "title": "Two", "artist": "B"},
+    ]
+
+    def test_legacy_list(self):
+        agent = SyncAgent("https://test", "tok", MockPlayer())
+        agent._handle_queue_update(list(self.QUEUE))
+        assert agent._queue == self.QUEUE
+        assert agent._queue_seq is None
+
+    def test_snapshot_sets_seq(self):
+        agent = SyncAgent("https://test", "tok", MockPlayer())
+        agent._handle_queue_update({"seq": 7, "queue": list(self.QUEUE)})
+        assert agent._queue_seq == 7
+
+    def test_diff_applied_on_matching_base(self):
+        agent = SyncAgent("https://test", "tok", MockPlayer())
+        agent._handle_queue_update({"seq": 7, "queue": list(self.QUEUE)})
+        agent._handle_queue_update({"base": 7, "seq": 8, "ops": [
+            {"op": "remove", "id": "1"},
+            {"op": "patch", "id": "2", "fields": {"vote": 1}},
+            {"op": "insert", "id": "3", "index": 0,
+             "item": {"id": "3", "title": "Three", "artist": "C"}},
+        ]})
+        assert [x["id"] for x in agent._queue] == ["3", "2"]
+        assert agent._queue[1]["vote"] == 1
+        assert agent._queue_seq == 8
+
+    def test_diff_gap_refetches(self):
+        agent = SyncAgent("https://test", "tok", MockPlayer())
+        agent._handle_queue_update({"seq": 7, "queue": list(self.QUEUE)})
+        with patch.object(agent, "_fetch_queue") as fetch:
+            agent._handle_queue_update({"base": 9, "seq": 10, "ops": []})
+        fetch.assert_called_once()
+        assert agent._queue_seq is None
+
+    def test_apply_diff_rejects_unknown_id(self):
+        assert _apply_queue_diff(self.QUEUE, [{"op": "remove", "id": "nope"}]) is None
+
+    def test_apply_diff_move(self):
+        moved = _apply_queue_diff(self.QUEUE, [{"op": "move", "id": "2", "index": 0}])
+        assert [x["id"] for x in moved] == ["2", "1"]
+
 
 # ---------------------------------------------------------------------------
 # CLI
@@ -0,0 +1,46 @@
+"""Per-process meter of position frames forwarded to listeners.
+
+Every WebSocket listener and /api/events stream forwards each ``pp|...``
+message the player publishes.  The meter counts the frames forwarded and
+how long listeners were connected, so /api/stats can report frames per
+listener per hour and compare POSITION_RESYNC_SECONDS settings.
+"""
+
+import time
+
+
+class FrameMeter(object):
+    """Count frames sent and listener-connected time."""
+
+    def __init__(self):
+        self.frames = 0
+        self._open = {}          # token -> monotonic connect time
+        self._closed_seconds = 0.0
+
+    def connect(self):
+        """Record a listener connecting; returns a token for disconnect()."""
+        token = object()
+        self._open[token] = time.monotonic()
+        return token
+
+    def disconnect(self, token):
+        start = self._open.pop(token, None)
+        if start is not None:
+            self._closed_seconds += time.monotonic() - start
+
+    def sent(self, count=1):
+        self.frames += count
+
+    def stats(self):
+        now = time.monotonic()
+        seconds = self._closed_seconds + sum(now - start for start in self._open.values())
+        hours = seconds / 3600.0
+        return {
+            'frames': self.frames,
+            'listeners': len(self._open),
+            'listener_hours': round(hours, 4),
+            'frames_per_listener_hour': round(self.frames / hours, 1) if hours else 0.0,
+        }
+
+
+position_frames = FrameMeter()
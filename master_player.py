@@ -1,5 +1,9 @@
 #!/usr/bin/env python
-"""Master player worker: drives playback for all active nests and cleans up inactive ones."""
+"""Master player worker: drives playback for its share of nests and cleans up inactive ones.
+
+Run several (on one host or many) to spread nests across processes; see
+player_pool for how nests are assigned.
+"""
 
 import datetime
 import logging
@@ -7,79 +11,123 @@ import time
 
 import gevent
 
+from config import CONF
 from db import DB
-from nests import NestManager, should_delete_nest, count_active_members
+from nests import (NestManager, archive_after_minutes, archive_retention_days,
+                   should_archive_nest, should_delete_nest, should_drop_archive,
+                   sweep_nests)
+from nest_scheduler import NestScheduler
+from player_pool import PlayerWorker
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def master_player_tick_all(nest_manager=None, poll_interval=5):
+def master_player_tick_all(nest_manager=None, poll_interval=5, worker=None, scheduler=None):
     """Supervisor loop: discover nests and keep a player greenlet per nest.
 
     Every *poll_interval* seconds the loop re-fetches the nest list, spawns
     greenlets for newly discovered nests, kills greenlets for removed nests,
     and cleans up dead greenlets.
 
+    With a *worker*, only the nests the player pool's hash ring assigns to
+    it are played.  The worker heartbeats and rechecks ownership every
+    ``worker.heartbeat_seconds``, so a dead worker's nests are picked up
+    within its timeout and nests that moved elsewhere are released.
+
+    With a *scheduler*, the nests are handed to it instead of getting a
+    greenlet each; the scheduler itself must be running.
+
+    Hibernating nests are left out, and picked up again within a heartbeat
+    (or *poll_interval*) of being resumed.
+
     Args:
         nest_manager: Optional NestManager instance. If None, creates one.
         poll_interval: Seconds between nest-list refreshes (default 5).
+        worker: Optional player_pool.PlayerWorker for sharded players.
+        scheduler: Optional nest_scheduler.NestScheduler that plays the nests.
     """
     if nest_manager is None:
         nest_manager = NestManager()
 
     active_greenlets = {}  # nest_id -> gevent.Greenlet
+    current_nests = set()
+    next_refresh = 0
 
     while True:
         try:
-            current_nests = {nid for nid, _ in nest_manager.list_nests()}
-
-            # Spawn for new nests
-            for nid in current_nests - set(active_greenlets):
-                logger.info("Discovered new nest %s — spawning player", nid)
-                active_greenlets[nid] = gevent.spawn(_run_nest_player, nid)
-
-            # Kill greenlets for removed nests
-            for nid in set(active_greenlets) - current_nests:
-                logger.info("Nest %s removed — killing player greenlet", nid)
-                active_greenlets.pop(nid).kill()
-
-            # Clean up dead greenlets so they can be re-spawned next cycle
-            for nid in list(active_greenlets):
-                g = active_greenlets[nid]
-                if g.dead:
-                    if g.exception:
-                        logger.error("Player greenlet for nest %s died with: %s", nid, g.exception)
+            if time.monotonic() >= next_refresh:
+                current_nests = {nid for nid, _ in nest_manager.list_nests()}
+                next_refresh = time.monotonic() + poll_interval
+            # Hibernating nests (no listeners) are not played until someone joins
+            hibernating = nest_manager.hibernating_nests()
+            wanted = current_nests - hibernating
+            if worker is not None:
+                worker.beat()
+                wanted = worker.owned(wanted)
+
+            if scheduler is not None:
+                scheduler.set_nests(wanted)
+            else:
+                # Spawn for new nests
+                for nid in wanted - set(active_greenlets):
+                    logger.info("Discovered new nest %s — spawning player", nid)
+                    owner = worker.worker_id if worker is not None else None
+                    active_greenlets[nid] = gevent.spawn(_run_nest_player, nid, owner)
+
+                # Kill greenlets for removed nests (or nests now owned elsewhere)
+                for nid in set(active_greenlets) - wanted:
+                    if nid in hibernating:
+                        logger.info("Nest %s is hibernating — releasing player", nid)
+                    elif nid in current_nests:
+                        logger.info("Nest %s moved to another worker — releasing player", nid)
                     else:
-                        logger.warning("Player greenlet for nest %s exited — will respawn", nid)
-                    del active_greenlets[nid]
+                        logger.info("Nest %s removed — killing player greenlet", nid)
+                    active_greenlets.pop(nid).kill()
+
+                # Clean up dead greenlets so they can be re-spawned next cycle
+                for nid in list(active_greenlets):
+                    g = active_greenlets[nid]
+                    if g.dead:
+                        if g.exception:
+                            logger.error("Player greenlet for nest %s died with: %s", nid, g.exception)
+                        else:
+                            logger.warning("Player greenlet for nest %s exited — will respawn", nid)
+                        del active_greenlets[nid]
 
         except Exception:
             logger.exception("Error in master_player supervisor loop")
 
-        gevent.sleep(poll_interval)
+        gevent.sleep(worker.heartbeat_seconds if worker is not None else poll_interval)
 
 
-def _run_nest_player(nest_id):
+def _run_nest_player(nest_id, owner=None):
     """Run the master_player loop for a single nest."""
     logger.info("Starting master player for nest: %s", nest_id)
     try:
         d = DB(nest_id=nest_id)
-        d.master_player()
+        d.master_player(owner)
     except Exception:
         logger.exception("master_player crashed for nest %s", nest_id)
 
 
-def nest_cleanup_loop(nest_manager=None, interval_seconds=60):
+def nest_cleanup_loop(nest_manager=None, interval_seconds=60, worker=None):
     """Periodically check for inactive nests and delete them.
 
     Runs in a loop, checking every `interval_seconds`. Uses the
     `should_delete_nest()` predicate from nests.py to decide which
-    nests to clean up. The main nest is never deleted.
+    nests to clean up. The main nest is never deleted. Nests with no
+    live members that are kept are put into hibernation, hibernating
+    nests with live members again are resumed, and hibernating nests
+    parked past `should_archive_nest()` are archived to disk. While
+    archival is on, a hibernating nest that outlives its TTL is archived
+    instead of deleted, and deleted once `should_drop_archive()` says its
+    archive has been kept long enough.
 
     Args:
         nest_manager: Optional NestManager instance. If None, creates one.
         interval_seconds: How often to run cleanup (default 60s).
+        worker: Optional PlayerWorker; only the nests it owns are checked.
     """
     if nest_manager is None:
         nest_manager = NestManager()
@@ -89,26 +137,50 @@ def nest_cleanup_loop(nest_manager=None, interval_seconds=60):
             nests = nest_manager.list_nests()
             now = datetime.datetime.now()
 
-            for nest_id, metadata in nests:
-                # Never delete the main nest (also handled by should_delete_nest,
-                # but skip early to avoid unnecessary work)
-                if metadata.get('is_main'):
-                    continue
-
-                # Count active members (prunes stale entries from MEMBERS set)
-                member_count = count_active_members(nest_manager._r, nest_id)
-
-                # Count queue size
-                queue_key = f"NEST:{nest_id}|MISC|priority-queue"
-                queue_size = nest_manager._r.zcard(queue_key)
-
-                if should_delete_nest(metadata, member_count, queue_size, now):
+            owned = worker.owned(nid for nid, _ in nests) if worker is not None else None
+
+            # Never delete the main nest (also handled by should_delete_nest,
+            # but skip early to avoid unnecessary work)
+            candidates = [(nest_id, metadata) for nest_id, metadata in nests
+                          if (owned is None or nest_id in owned) and not metadata.get('is_main')]
+
+            # Prune stale members and count members and queue sizes for
+            # every candidate in one pipeline
+            counts = sweep_nests(nest_manager._r, [nest_id for nest_id, _ in candidates])
+            hibernating = nest_manager.hibernating_nests()
+            # A hibernating nest past its TTL is archived, and deleted when
+            # its archive's retention runs out, unless archival is off
+            archiving = archive_after_minutes() > 0 and archive_retention_days() > 0
+
+            for nest_id, metadata in candidates:
+                member_count, queue_size = counts[nest_id]
+                expired = should_delete_nest(metadata, member_count, queue_size, now)
+                if metadata.get('archived'):
+                    if expired and (not archiving or should_drop_archive(metadata, now)):
+                        logger.info("Deleting archived nest %s (archived %s)", nest_id,
+                                    metadata['archived'].get('archived_at', 'unknown'))
+                        nest_manager.delete_nest(nest_id)
+                elif expired and archiving and nest_id in hibernating:
+                    logger.info("Archiving expired nest %s (last_activity=%s)", nest_id,
+                                metadata.get('last_activity', 'unknown'))
+                    nest_manager.archive_nest(nest_id)
+                elif expired:
                     logger.info(
                         "Cleaning up nest %s (members=%d, queue=%d, last_activity=%s)",
                         nest_id, member_count, queue_size,
                         metadata.get('last_activity', 'unknown')
                     )
                     nest_manager.delete_nest(nest_id)
+                elif member_count > 0 and nest_id in hibernating:
+                    # A member is back (e.g. another tab's heartbeat after
+                    # one tab disconnected) but nothing resumed the nest
+                    nest_manager.resume_nest(nest_id)
+                elif member_count == 0 and nest_id not in hibernating:
+                    # Heartbeats ran out without a disconnect (leave_nest
+                    # hibernates the nest otherwise)
+                    nest_manager.hibernate_nest(nest_id)
+                elif nest_id in hibernating and should_archive_nest(metadata, now):
+                    nest_manager.archive_nest(nest_id)
 
         except Exception:
             logger.exception("Error during nest cleanup loop")
@@ -116,8 +188,67 @@ def nest_cleanup_loop(nest_manager=None, interval_seconds=60):
         time.sleep(interval_seconds)
 
 
+def queue_expiry_sweep_loop(nest_manager=None, interval_seconds=None, worker=None):
+    """Periodically drop expired queue entries for every nest.
+
+    Reads already skip entries whose QUEUE hash has expired; this sweep
+    removes them from the priority queue (via the MISC|queue-expiry index)
+    so they stop counting toward queue depth, and logs how many it
+    reclaimed. Each nest's index is backfilled once, the first time the
+    sweep sees it, so entries queued before the index existed are covered.
+
+    Args:
+        nest_manager: Optional NestManager instance. If None, creates one.
+        interval_seconds: Seconds between sweeps (default
+            CONF.QUEUE_EXPIRY_SWEEP_SECONDS or 300).
+        worker: Optional PlayerWorker; only the nests it owns are swept.
+    """
+    if nest_manager is None:
+        nest_manager = NestManager()
+    if interval_seconds is None:
+        interval_seconds = getattr(CONF, 'QUEUE_EXPIRY_SWEEP_SECONDS', None) or 300
+
+    dbs = {}  # nest_id -> DB
+    while True:
+        try:
+            sweep_expired_queue_entries(nest_manager, dbs, worker=worker)
+        except Exception:
+            logger.exception("Error during queue expiry sweep")
+        gevent.sleep(interval_seconds)
+
+
+def sweep_expired_queue_entries(nest_manager, dbs=None, worker=None):
+    """Run one expiry sweep over all nests; return the number of entries reclaimed.
+
+    *dbs* caches DB handles between sweeps (nest_id -> DB); nests missing
+    from it get their expiry index backfilled first.  With a *worker*,
+    only the nests it owns are swept.
+    """
+    dbs = {} if dbs is None else dbs
+    current = {nid for nid, _ in nest_manager.list_nests()}
+    if worker is not None:
+        current = worker.owned(current)
+    for nid in set(dbs) - current:
+        del dbs[nid]
+
+    reclaimed = 0
+    for nid in current:
+        d = dbs.get(nid)
+        if d is None:
+            d = dbs[nid] = DB(nest_id=nid, init_history_to_redis=False,
+                              redis_client=nest_manager._r)
+            indexed = d.reindex_queue_expiry()
+            if indexed:
+                logger.info("Indexed %d queue entries for nest %s", indexed, nid)
+        removed, _ = d.expire_queue_entries()
+        reclaimed += len(removed)
+    logger.info("Queue expiry sweep reclaimed %d entries across %d nests",
+                reclaimed, len(current))
+    return reclaimed
+
+
 def main():
-    """Start the master player for all nests with a cleanup worker."""
+    """Join the player pool and run this worker's share of nests with a cleanup worker."""
     try:
         nm = NestManager()
     except Exception:
@@ -126,12 +257,27 @@ def main():
         d.master_player()
         return
 
-    # Both loops run forever — run them as concurrent greenlets
+    # Nests are sharded over every running master_player.py (see player_pool)
+    worker = PlayerWorker(nm._r)
+    logger.info("Joining the player pool as %s", worker.worker_id)
+
+    # All loops run forever — run them as concurrent greenlets
     greenlets = [
-        gevent.spawn(master_player_tick_all, nest_manager=nm),
-        gevent.spawn(nest_cleanup_loop, nest_manager=nm, interval_seconds=60),
+        gevent.spawn(nest_cleanup_loop, nest_manager=nm, interval_seconds=60, worker=worker),
+        gevent.spawn(queue_expiry_sweep_loop, nest_manager=nm, worker=worker),
     ]
-    gevent.joinall(greenlets)
+    # One scheduler loop plays every nest unless PLAYER_SCHEDULER is false,
+    # which falls back to a player greenlet per nest
+    scheduler = None
+    if getattr(CONF, 'PLAYER_SCHEDULER', None) is not False:
+        scheduler = NestScheduler(nm._r, owner=worker.worker_id)
+        greenlets.append(gevent.spawn(scheduler.run))
+    greenlets.append(gevent.spawn(master_player_tick_all, nest_manager=nm,
+                                  worker=worker, scheduler=scheduler))
+    try:
+        gevent.joinall(greenlets)
+    finally:
+        worker.leave()
 
 
 if __name__ == '__main__':
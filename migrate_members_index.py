@@ -0,0 +1,118 @@
+"""One-time migration: rebuild nest MEMBERS sets as heartbeat-expiry sorted sets.
+
+NEST:{id}|MEMBERS used to be a plain set of emails, with liveness kept in a
+separate NEST:{id}|MEMBER:{email} key (SET ... EX 90) per member. It is now
+a sorted set scored by each member's heartbeat expiry (epoch seconds), and
+the per-member keys are no longer written. This script rebuilds every
+MEMBERS set it finds as a sorted set, scoring each member by now plus the
+remaining TTL of their MEMBER key; members whose key has already expired
+are dropped. The per-member keys are then deleted.
+
+Membership is short-lived (heartbeats expire after 90 s), so this only has
+to run once, right after deploying.
+
+Usage:
+    python migrate_members_index.py              # Dry-run (default)
+    python migrate_members_index.py --execute    # Actually perform migration
+"""
+import argparse
+import logging
+import os
+import time
+
+import redis
+
+from nests import member_key
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+MEMBERS_PATTERN = 'NEST:*|MEMBERS'
+MEMBER_PATTERN = 'NEST:*|MEMBER:*'
+
+
+def migrate(redis_client=None, dry_run=True):
+    """Rebuild legacy MEMBERS sets as sorted sets and drop per-member TTL keys.
+
+    Args:
+        redis_client: Optional Redis connection (decode_responses=True). If
+                      None, connects using environment variables or defaults.
+        dry_run: If True, log what would be done without making changes.
+
+    Returns:
+        dict with counts: {'converted': N, 'current': N, 'members': N,
+        'stale': N, 'ttl_keys': N}. members/stale count individual emails.
+    """
+    if redis_client is None:
+        host = os.environ.get('REDIS_HOST', 'localhost')
+        port = int(os.environ.get('REDIS_PORT', 6379))
+        password = os.environ.get('REDIS_PASSWORD') or None
+        redis_client = redis.StrictRedis(
+            host=host, port=port, password=password, decode_responses=True
+        )
+
+    stats = {'converted': 0, 'current': 0, 'members': 0, 'stale': 0, 'ttl_keys': 0}
+
+    for key in redis_client.scan_iter(match=MEMBERS_PATTERN, count=200):
+        if redis_client.type(key) != 'set':
+            stats['current'] += 1
+            continue
+        nest_id = key[len('NEST:'):-len('|MEMBERS')]
+        now = time.time()
+        scores = {}
+        for email in redis_client.smembers(key):
+            ttl = redis_client.ttl(member_key(nest_id, email))
+            if ttl > 0:
+                scores[email] = now + ttl
+            else:
+                stats['stale'] += 1
+        stats['converted'] += 1
+        stats['members'] += len(scores)
+        logger.info("%s: %s (%d live members)",
+                    "DRY-RUN: would convert" if dry_run else "CONVERTED", key, len(scores))
+        if not dry_run:
+            pipe = redis_client.pipeline()
+            pipe.delete(key)
+            if scores:
+                pipe.zadd(key, scores)
+            pipe.execute()
+
+    for key in redis_client.scan_iter(match=MEMBER_PATTERN, count=200):
+        stats['ttl_keys'] += 1
+        if not dry_run:
+            redis_client.delete(key)
+
+    logger.info(
+        "Migration complete: converted=%d, already sorted=%d, members=%d, stale=%d, ttl keys=%d",
+        stats['converted'], stats['current'], stats['members'], stats['stale'], stats['ttl_keys']
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild nest MEMBERS sets as heartbeat-expiry sorted sets')
+    parser.add_argument('--execute', action='store_true',
+                        help='Actually perform migration (default is dry-run)')
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--redis-port', type=int, default=int(os.environ.get('REDIS_PORT', 6379)))
+    parser.add_argument('--redis-password', default=os.environ.get('REDIS_PASSWORD'))
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(
+        host=args.redis_host,
+        port=args.redis_port,
+        password=args.redis_password or None,
+        decode_responses=True
+    )
+
+    dry_run = not args.execute
+    if dry_run:
+        logger.info("DRY-RUN mode (use --execute to actually migrate)")
+    else:
+        logger.info("EXECUTE mode -- MEMBERS sets will be rebuilt!")
+
+    migrate(redis_client=r, dry_run=dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""One-time migration: move raw provider payloads out of queue hashes.
+
+Queue entries (NEST:*|QUEUE|{id}) and fill-info caches (NEST:*|FILL-INFO|*)
+used to carry the whole upstream API response as a JSON ``data`` field. This
+script moves each payload to the shared TRACK-PAYLOAD|{uri} key (one copy
+per track, compressed) and deletes the field, reporting bytes per entry
+before and after.
+
+Usage:
+    python migrate_queue_payloads.py              # Dry-run (default)
+    python migrate_queue_payloads.py --execute    # Actually perform migration
+"""
+import argparse
+import json
+import logging
+import os
+
+import redis
+
+os.environ.setdefault('SKIP_SPOTIFY_PREFETCH', '1')
+from db import TRACK_PAYLOAD_TTL, _encode_payload, _track_uri
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+SCAN_PATTERNS = [
+    'NEST:*|QUEUE|*',
+    'NEST:*|FILL-INFO|*',
+]
+
+
+def key_bytes(redis_client, key):
+    """Bytes used by a key: MEMORY USAGE if the server supports it, else payload length."""
+    try:
+        usage = redis_client.memory_usage(key)
+        if usage is not None:
+            return usage
+    except redis.exceptions.ResponseError:
+        pass
+    if redis_client.type(key) == 'hash':
+        return sum(len(k) + len(v) for k, v in redis_client.hgetall(key).items())
+    return redis_client.strlen(key)
+
+
+def _per_entry(total, count):
+    return total // count if count else 0
+
+
+def migrate(redis_client=None, dry_run=True):
+    """Move ``data`` fields to TRACK-PAYLOAD|{uri} keys.
+
+    Args:
+        redis_client: Optional Redis connection (decode_responses=True). If
+                      None, connects using environment variables or defaults.
+        dry_run: If True, log what would be done without making changes.
+
+    Returns:
+        dict with counts: {'compacted': N, 'payloads': N, 'skipped': N,
+        'bytes_before': N, 'bytes_after': N}. bytes_after includes the
+        shared payload keys; in dry-run mode it is an estimate.
+    """
+    if redis_client is None:
+        host = os.environ.get('REDIS_HOST', 'localhost')
+        port = int(os.environ.get('REDIS_PORT', 6379))
+        password = os.environ.get('REDIS_PASSWORD') or None
+        redis_client = redis.StrictRedis(
+            host=host, port=port, password=password, decode_responses=True
+        )
+
+    stats = {'compacted': 0, 'payloads': 0, 'skipped': 0,
+             'bytes_before': 0, 'bytes_after': 0}
+    payload_keys = set()
+
+    for pattern in SCAN_PATTERNS:
+        for key in redis_client.scan_iter(match=pattern, count=200):
+            if '|QUEUE|VOTE|' in key or redis_client.type(key) != 'hash':
+                continue
+            raw, src, trackid = redis_client.hmget(key, 'data', 'src', 'trackid')
+            if raw is None:
+                continue
+            try:
+                payload = json.loads(raw) if raw else None
+            except ValueError:
+                payload = None
+
+            before = key_bytes(redis_client, key)
+            stats['bytes_before'] += before
+            payload_key = None
+            if isinstance(payload, (dict, list)) and trackid:
+                payload_key = 'TRACK-PAYLOAD|' + _track_uri(src or 'spotify', trackid)
+            else:
+                # Not a provider response (e.g. '<Response [200]>'): just drop it
+                stats['skipped'] += 1
+
+            if dry_run:
+                logger.info("DRY-RUN: would compact %s -> %s", key, payload_key or '(dropped)')
+                stats['bytes_after'] += before - len('data') - len(raw)
+                if payload_key and payload_key not in payload_keys:
+                    stats['bytes_after'] += len(_encode_payload(payload))
+            else:
+                pipe = redis_client.pipeline()
+                if payload_key and payload_key not in payload_keys:
+                    pipe.set(payload_key, _encode_payload(payload), ex=TRACK_PAYLOAD_TTL)
+                pipe.hdel(key, 'data')
+                pipe.execute()
+                stats['bytes_after'] += key_bytes(redis_client, key)
+                if payload_key and payload_key not in payload_keys:
+                    stats['bytes_after'] += key_bytes(redis_client, payload_key)
+                logger.info("COMPACTED: %s", key)
+
+            if payload_key and payload_key not in payload_keys:
+                payload_keys.add(payload_key)
+                stats['payloads'] += 1
+            stats['compacted'] += 1
+
+    logger.info(
+        "Migration complete: compacted=%d, payloads=%d, skipped=%d, "
+        "bytes/entry before=%d after=%d",
+        stats['compacted'], stats['payloads'], stats['skipped'],
+        _per_entry(stats['bytes_before'], stats['compacted']),
+        _per_entry(stats['bytes_after'], stats['compacted'])
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move raw provider payloads out of queue hashes')
+    parser.add_argument('--execute', action='store_true',
+                        help='Actually perform migration (default is dry-run)')
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--redis-port', type=int, default=int(os.environ.get('REDIS_PORT', 6379)))
+    parser.add_argument('--redis-password', default=os.environ.get('REDIS_PASSWORD'))
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(
+        host=args.redis_host,
+        port=args.redis_port,
+        password=args.redis_password or None,
+        decode_responses=True
+    )
+
+    dry_run = not args.execute
+    if dry_run:
+        logger.info("DRY-RUN mode (use --execute to actually migrate)")
+    else:
+        logger.info("EXECUTE mode -- queue hashes will be rewritten!")
+
+    migrate(redis_client=r, dry_run=dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""One-time migration: rewrite pickled datetimes in Redis as epoch seconds.
+
+MISC|current-done, MISC|bender_streak_start and MISC|player-now (strings)
+and the MISC|guest-login-expire hash used to hold base64-wrapped pickled
+datetimes. db.epoch_load() still reads those during the changeover; this
+script rewrites every one it finds with db.epoch_dump(), keeping key TTLs.
+Values that are already numeric are left alone.
+
+Usage:
+    python migrate_time_values.py              # Dry-run (default)
+    python migrate_time_values.py --execute    # Actually perform migration
+"""
+import argparse
+import logging
+import os
+
+import redis
+
+os.environ.setdefault('SKIP_SPOTIFY_PREFETCH', '1')
+from db import _legacy_datetime_load, epoch_dump
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+STRING_PATTERNS = [
+    'NEST:*|MISC|current-done',
+    'NEST:*|MISC|bender_streak_start',
+    'NEST:*|MISC|player-now',
+]
+HASH_PATTERNS = [
+    'NEST:*|MISC|guest-login-expire',
+]
+
+
+def _convert(raw):
+    """Return the epoch form of a legacy value, or None if it needs no rewrite."""
+    try:
+        float(raw)
+        return None
+    except ValueError:
+        return epoch_dump(_legacy_datetime_load(raw))
+
+
+def migrate(redis_client=None, dry_run=True):
+    """Rewrite pickled datetimes as epoch-seconds strings.
+
+    Args:
+        redis_client: Optional Redis connection (decode_responses=True). If
+                      None, connects using environment variables or defaults.
+        dry_run: If True, log what would be done without making changes.
+
+    Returns:
+        dict with counts: {'converted': N, 'current': N, 'unreadable': N}.
+        Hash fields count individually.
+    """
+    if redis_client is None:
+        host = os.environ.get('REDIS_HOST', 'localhost')
+        port = int(os.environ.get('REDIS_PORT', 6379))
+        password = os.environ.get('REDIS_PASSWORD') or None
+        redis_client = redis.StrictRedis(
+            host=host, port=port, password=password, decode_responses=True
+        )
+
+    stats = {'converted': 0, 'current': 0, 'unreadable': 0}
+
+    def convert(name, raw):
+        try:
+            value = _convert(raw)
+        except Exception as e:
+            logger.warning("UNREADABLE: %s (%s)", name, e)
+            stats['unreadable'] += 1
+            return None
+        if value is None:
+            stats['current'] += 1
+            return None
+        stats['converted'] += 1
+        logger.info("%s: %s -> %s", "DRY-RUN: would convert" if dry_run else "CONVERTED", name, value)
+        return value
+
+    for pattern in STRING_PATTERNS:
+        for key in redis_client.scan_iter(match=pattern, count=200):
+            raw = redis_client.get(key)
+            if raw is None:
+                continue
+            value = convert(key, raw)
+            if value is not None and not dry_run:
+                redis_client.set(key, value, keepttl=True)
+
+    for pattern in HASH_PATTERNS:
+        for key in redis_client.scan_iter(match=pattern, count=200):
+            updates = {}
+            for field, raw in redis_client.hgetall(key).items():
+                value = convert('%s[%s]' % (key, field), raw)
+                if value is not None:
+                    updates[field] = value
+            if updates and not dry_run:
+                redis_client.hset(key, mapping=updates)
+
+    logger.info(
+        "Migration complete: converted=%d, already epoch=%d, unreadable=%d",
+        stats['converted'], stats['current'], stats['unreadable']
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite pickled datetimes in Redis as epoch seconds')
+    parser.add_argument('--execute', action='store_true',
+                        help='Actually perform migration (default is dry-run)')
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'localhost'))
+    parser.add_argument('--redis-port', type=int, default=int(os.environ.get('REDIS_PORT', 6379)))
+    parser.add_argument('--redis-password', default=os.environ.get('REDIS_PASSWORD'))
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(
+        host=args.redis_host,
+        port=args.redis_port,
+        password=args.redis_password or None,
+        decode_responses=True
+    )
+
+    dry_run = not args.execute
+    if dry_run:
+        logger.info("DRY-RUN mode (use --execute to actually migrate)")
+    else:
+        logger.info("EXECUTE mode -- time values will be rewritten!")
+
+    migrate(redis_client=r, dry_run=dry_run)
+
+
+if __name__ == '__main__':
+    main()
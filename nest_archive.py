@@ -0,0 +1,142 @@
+"""Serialize a nest's Redis keyspace to a compressed file and load it back.
+
+A dormant nest still holds every NEST:{id}|* key in Redis: queue hashes,
+jams, comments, Bender caches.  NestManager.archive_nest() moves
+them to one zlib-compressed JSON file under NEST_ARCHIVE_DIR and
+NestManager.get_nest() loads them back on the next visit.
+
+Each key is stored as [suffix, type, value, expire_at_ms] where suffix is
+the key without the nest prefix and expire_at_ms is the absolute expiry
+(None for persistent keys), so TTLs keep running while a nest is archived
+and keys that expired in the meantime are not restored.  Reads are two
+pipelined round trips after the SCAN; a restore is one MULTI.
+"""
+
+import json
+import os
+import time
+import zlib
+
+from config import CONF
+
+ARCHIVE_VERSION = 1
+DEFAULT_ARCHIVE_DIR = './nest_archive'
+
+
+def archive_dir():
+    """Directory holding nest archives (CONF.NEST_ARCHIVE_DIR)."""
+    return getattr(CONF, 'NEST_ARCHIVE_DIR', None) or DEFAULT_ARCHIVE_DIR
+
+
+def archive_path(nest_id):
+    """Path of the archive file for *nest_id*."""
+    return os.path.join(archive_dir(), '%s.json.z' % nest_id)
+
+
+def dump_keys(redis_client, prefix, skip=()):
+    """Read every key under *prefix* (except *skip*) as archive entries."""
+    keys = [key for key in redis_client.scan_iter(match=prefix + '*', count=500)
+            if key not in skip]
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+        pipe.pttl(key)
+    info = pipe.execute()
+    now_ms = int(time.time() * 1000)
+
+    kinds = []
+    pipe = redis_client.pipeline(transaction=False)
+    for key, kind in zip(keys, info[::2]):
+        if kind == 'string':
+            pipe.get(key)
+        elif kind == 'hash':
+            pipe.hgetall(key)
+        elif kind == 'list':
+            pipe.lrange(key, 0, -1)
+        elif kind == 'set':
+            pipe.smembers(key)
+        elif kind == 'zset':
+            pipe.zrange(key, 0, -1, withscores=True)
+        else:
+            # Gone since the SCAN (or a type nothing in a nest uses)
+            kind = None
+        kinds.append(kind)
+    values = iter(pipe.execute())
+
+    entries = []
+    for key, kind, pttl in zip(keys, kinds, info[1::2]):
+        if kind is None:
+            continue
+        value = next(values)
+        if not value:
+            continue
+        if kind == 'set':
+            value = sorted(value)
+        elif kind == 'zset':
+            value = [list(pair) for pair in value]
+        expire_at = now_ms + pttl if pttl > 0 else None
+        entries.append([key[len(prefix):], kind, value, expire_at])
+    return entries
+
+
+def restore_keys(pipe, prefix, entries, now_ms=None):
+    """Queue writes that recreate *entries* under *prefix*; the number of keys.
+
+    Keys whose expiry has passed are left out.
+    """
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+    restored = 0
+    for suffix, kind, value, expire_at in entries:
+        if expire_at is not None and expire_at <= now_ms:
+            continue
+        key = prefix + suffix
+        pipe.delete(key)
+        if kind == 'string':
+            pipe.set(key, value)
+        elif kind == 'hash':
+            pipe.hset(key, mapping=value)
+        elif kind == 'list':
+            pipe.rpush(key, *value)
+        elif kind == 'set':
+            pipe.sadd(key, *value)
+        elif kind == 'zset':
+            pipe.zadd(key, dict(value))
+        else:
+            continue
+        if expire_at is not None:
+            pipe.pexpireat(key, expire_at)
+        restored += 1
+    return restored
+
+
+def write_archive(path, nest_id, entries):
+    """Write *entries* to *path* (atomically); return the file size in bytes."""
+    data = zlib.compress(json.dumps({
+        'version': ARCHIVE_VERSION,
+        'nest_id': nest_id,
+        'archived_at': time.time(),
+        'keys': entries,
+    }, separators=(',', ':')).encode('utf-8'))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+def read_archive(path):
+    """Return the entries stored in the archive at *path*.
+
+    Raises OSError if it can't be read and ValueError if it isn't a nest
+    archive this version understands.
+    """
+    with open(path, 'rb') as f:
+        try:
+            archive = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except zlib.error as e:
+            raise ValueError('corrupt nest archive %s: %s' % (path, e))
+    if archive.get('version') != ARCHIVE_VERSION:
+        raise ValueError('unsupported nest archive version %r' % archive.get('version'))
+    return archive['keys']
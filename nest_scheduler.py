@@ -0,0 +1,220 @@
+"""Drive every nest a worker plays from one scheduler loop.
+
+A per-nest player greenlet (DB.master_player) blocks on its own BLPOP and
+renews its own lease PLAYER_LEASE_RENEWALS times per TTL, so a nest costs a
+connection, Redis round trips and CPU even when nothing is happening in
+it.  NestScheduler keeps a heap of each nest's next deadline -- song end,
+lookahead, position resync -- and runs the nest's DB.play_step() only when
+that deadline comes due or a control command arrives.  One BLPOP across
+every played nest's MISC|player-control list delivers the commands and one
+PLAYER_LEASE_RENEW_ALL call renews every lease, so a nest between events
+costs nothing and the leases can be short enough for a standby to take over
+within about a second.
+
+Steps run in their own greenlets (at most MAX_STEPS at once), so a slow
+one (a Spotify fill) never holds up the other nests; a nest never has two
+steps running at once.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+import traceback
+import uuid
+
+import gevent
+import gevent.event
+import gevent.pool
+import redis
+
+import redis_scripts
+from config import CONF
+from db import DB, PlayerLeaseLost, PLAYER_LEASE_RENEWALS
+
+logger = logging.getLogger(__name__)
+
+CONTROL_POLL_SECONDS = 1  # BLPOP timeout; newly played nests are listened to after this
+RETRY_SECONDS = 1         # Back-off after a step fails
+MAX_STEPS = 50            # Steps running at once (each may hold a Redis connection)
+
+# Player lease while the scheduler plays a nest (PLAYER_SCHEDULER_LEASE_SECONDS).
+# One call renews them all, so unlike per-nest greenlets (PLAYER_LEASE_SECONDS)
+# a busy worker doesn't let them lapse: bench.py scheduler lost none at 1 s.
+SCHEDULER_LEASE_SECONDS = 1.0
+
+
+class _Nest(object):
+    """Scheduler bookkeeping for one nest."""
+
+    def __init__(self, db):
+        self.db = db
+        self.lease = None   # 'owner|token' while this scheduler plays the nest
+        self.commands = []  # control commands waiting for the next step
+        self.step = None    # greenlet running a step
+        self.due = None     # monotonic time of the live heap entry
+
+
+class NestScheduler(object):
+    """Play many nests from one loop, each only when it has something to do.
+
+    Args:
+        redis_client: Redis connection for the control BLPOP and lease renewals.
+        owner: Lease holder name (the player worker id when sharded).
+        db_factory: Optional callable nest_id -> DB (default ``DB(nest_id=...)``).
+    """
+
+    def __init__(self, redis_client, owner=None, db_factory=None):
+        self._r = redis_client
+        self.owner = owner or str(uuid.uuid4())
+        self.lease_seconds = (getattr(CONF, 'PLAYER_SCHEDULER_LEASE_SECONDS', None)
+                              or SCHEDULER_LEASE_SECONDS)
+        self._db_factory = db_factory or (lambda nest_id: DB(nest_id=nest_id))
+        self._renew = redis_client.register_script(redis_scripts.PLAYER_LEASE_RENEW_ALL)
+        self._nests = {}     # nest_id -> _Nest
+        self._heap = []      # (due, seq, nest_id); stale entries are skipped
+        self._seq = itertools.count()
+        self._ready = set()  # nest ids to step as soon as they are free
+        self._wake = gevent.event.Event()
+        self._pool = gevent.pool.Pool(MAX_STEPS)
+        self.steps = 0
+
+    def set_nests(self, nest_ids):
+        """Play exactly *nest_ids*: pick up new nests and release the others."""
+        nest_ids = set(nest_ids)
+        for nid in nest_ids - set(self._nests):
+            logger.info("Scheduling player for nest %s", nid)
+            self._nests[nid] = _Nest(self._db_factory(nid))
+            self._ready.add(nid)
+        for nid in set(self._nests) - nest_ids:
+            logger.info("Releasing player for nest %s", nid)
+            nest = self._nests.pop(nid)
+            if nest.step is not None:
+                nest.step.kill()
+            self._release(nest)
+        self._wake.set()
+
+    def run(self):
+        """Run the scheduler until killed; spawn it as a greenlet."""
+        listener = gevent.spawn(self._listen)
+        renewer = gevent.spawn(self._renew_leases)
+        try:
+            while True:
+                timeout = max(self._heap[0][0] - time.monotonic(), 0) if self._heap else None
+                self._wake.wait(timeout)
+                self._wake.clear()
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, nid = heapq.heappop(self._heap)
+                    nest = self._nests.get(nid)
+                    if nest is not None and nest.due == due:
+                        self._ready.add(nid)
+                ready, self._ready = self._ready, set()
+                for nid in ready:
+                    nest = self._nests.get(nid)
+                    # A busy nest is rescheduled when its step finishes
+                    if nest is None or nest.step is not None:
+                        continue
+                    if self._pool.full():
+                        self._pool.wait_available()
+                        if self._nests.get(nid) is not nest:
+                            continue
+                    nest.due = None
+                    nest.step = self._pool.spawn(self._step, nid, nest)
+        finally:
+            listener.kill()
+            renewer.kill()
+            for nest in self._nests.values():
+                if nest.step is not None:
+                    nest.step.kill()
+                self._release(nest)
+
+    def _step(self, nest_id, nest):
+        wait = RETRY_SECONDS
+        try:
+            wait = self._advance(nest)
+        except PlayerLeaseLost as e:
+            logger.warning('Standing by in nest %s: %s', nest_id, e)
+            self._release(nest)
+            wait = self.lease_seconds / 4
+        except Exception:
+            logger.exception("Player step failed for nest %s", nest_id)
+            self._release(nest)
+        finally:
+            nest.step = None
+        self.steps += 1
+        if self._nests.get(nest_id) is not nest:
+            return
+        if nest.commands:
+            self._ready.add(nest_id)
+        elif wait is not None:
+            nest.due = time.monotonic() + wait
+            heapq.heappush(self._heap, (nest.due, next(self._seq), nest_id))
+        self._wake.set()
+
+    def _advance(self, nest):
+        """Take the lease if needed and run one play_step(); the wait it returns."""
+        d = nest.db
+        if nest.lease is None:
+            nest.lease = d.acquire_player_lease(self.owner, self.lease_seconds)
+            if nest.lease is None:
+                return self.lease_seconds / 4
+            d.start_playback()
+        command = nest.commands.pop(0) if nest.commands else None
+        return d.play_step(command)
+
+    def _release(self, nest):
+        nest.commands = []
+        if nest.lease is not None:
+            lease, nest.lease = nest.lease, None
+            nest.db.release_player_lease(lease)
+
+    def _listen(self):
+        """Pop control commands for every nest this scheduler plays, in one BLPOP."""
+        while True:
+            keys = {nest.db._key('MISC|player-control'): nid
+                    for nid, nest in self._nests.items() if nest.lease is not None}
+            if not keys:
+                gevent.sleep(CONTROL_POLL_SECONDS)
+                continue
+            try:
+                popped = self._r.blpop(list(keys), timeout=CONTROL_POLL_SECONDS)
+            except redis.RedisError:
+                logger.warning("player control BLPOP failed: %s", traceback.format_exc())
+                gevent.sleep(CONTROL_POLL_SECONDS)
+                continue
+            if not popped:
+                continue
+            nid = keys[popped[0]]
+            nest = self._nests.get(nid)
+            if nest is not None:
+                nest.commands.append(popped[1])
+                self._ready.add(nid)
+                self._wake.set()
+
+    def _renew_leases(self):
+        """Renew every held lease PLAYER_LEASE_RENEWALS times per TTL, in one script call."""
+        while True:
+            gevent.sleep(self.lease_seconds / PLAYER_LEASE_RENEWALS)
+            held = [(nid, nest, nest.lease) for nid, nest in self._nests.items()
+                    if nest.lease is not None]
+            if not held:
+                continue
+            try:
+                keys = []
+                for _, nest, _ in held:
+                    keys += [nest.db._key('MISC|master-player'), nest.db._key('MISC|player-epoch')]
+                kept = self._renew(
+                    keys=keys, args=[int(self.lease_seconds * 1000)] + [lease for _, _, lease in held])
+            except redis.RedisError:
+                logger.warning("player lease renewal failed: %s", traceback.format_exc())
+                continue
+            for (nid, nest, lease), ok in zip(held, kept):
+                if not ok and nest.lease == lease:
+                    logger.warning("player lease %s was taken over", lease)
+                    # Stop taking its commands; a running step raises
+                    # PlayerLeaseLost and the next one stands by
+                    nest.db._lease_lost = True
+                    nest.lease, nest.commands = None, []
+                    self._ready.add(nid)
+            self._wake.set()
@@ -8,9 +8,12 @@ import json
 import logging
 import os
 import random
+import time
 
 import redis
 
+import nest_archive
+import redis_scripts
 from config import CONF
 
 logger = logging.getLogger(__name__)
@@ -151,12 +154,12 @@ def pubsub_channel(nest_id):
 
 
 def members_key(nest_id):
-    """Return the Redis key for the set of members in a nest."""
+    """Return the Redis key for a nest's members (sorted set scored by heartbeat expiry)."""
     return f"NEST:{nest_id}|MEMBERS"
 
 
 def member_key(nest_id, email):
-    """Return the Redis key for an individual member's heartbeat TTL."""
+    """Return the legacy per-member heartbeat TTL key (read only by migrate_members_index.py)."""
     return f"NEST:{nest_id}|MEMBER:{email}"
 
 
@@ -170,8 +173,12 @@ def is_nest_deleting(redis_client, nest_id):
     return redis_client.exists(deleting_key(nest_id)) == 1
 
 
-def refresh_member_ttl(redis_client, nest_id, email, ttl_seconds=90):
-    """Set/refresh a member's heartbeat TTL key.
+# Seconds a member stays counted after their last heartbeat
+MEMBER_TTL_SECONDS = 90
+
+
+def refresh_member_ttl(redis_client, nest_id, email, ttl_seconds=MEMBER_TTL_SECONDS):
+    """Set/refresh a member's heartbeat: their score in MEMBERS becomes now + ttl.
 
     Args:
         redis_client: Redis connection (caller provides, e.g. db._r)
@@ -179,14 +186,20 @@ def refresh_member_ttl(redis_client, nest_id, email, ttl_seconds=90):
         email: Member's email address
         ttl_seconds: TTL in seconds (default 90)
     """
-    key = member_key(nest_id, email)
-    redis_client.setex(key, ttl_seconds, "1")
+    redis_client.zadd(members_key(nest_id), {email: time.time() + ttl_seconds})
+
+
+def active_member_count(redis_client, nest_id, now=None):
+    """Count members whose heartbeat has not expired, without pruning."""
+    if now is None:
+        now = time.time()
+    return redis_client.zcount(members_key(nest_id), f"({now}", "+inf")
 
 
 def count_active_members(redis_client, nest_id):
-    """Count active members by checking heartbeat TTL keys, pruning stale ones.
+    """Count active members, pruning those whose heartbeat has expired.
 
-    Members in the MEMBERS set whose TTL key has expired are removed
+    Members whose MEMBERS score (heartbeat expiry) has passed are removed
     from the set. Returns the count of still-active members.
 
     Args:
@@ -196,17 +209,32 @@ def count_active_members(redis_client, nest_id):
     Returns:
         int: Number of active members
     """
-    mkey = members_key(nest_id)
-    emails = redis_client.smembers(mkey)
-    stale = []
-    for email in emails:
-        mk = member_key(nest_id, email)
-        # Use ttl() instead of exists(): a key with TTL <= 0 or missing is stale
-        if redis_client.ttl(mk) <= 0:
-            stale.append(email)
-    for email in stale:
-        redis_client.srem(mkey, email)
-    return len(emails) - len(stale)
+    return sweep_nests(redis_client, [nest_id])[nest_id][0]
+
+
+def sweep_nests(redis_client, nest_ids, now=None):
+    """Prune expired members and count members and queued songs, in one pipeline.
+
+    Args:
+        redis_client: Redis connection
+        nest_ids: Nests to sweep
+        now: Epoch seconds to prune against (default: current time)
+
+    Returns:
+        dict: nest_id -> (active member count, priority queue size)
+    """
+    if now is None:
+        now = time.time()
+    nest_ids = list(nest_ids)
+    pipe = redis_client.pipeline(transaction=False)
+    for nest_id in nest_ids:
+        mkey = members_key(nest_id)
+        pipe.zremrangebyscore(mkey, "-inf", now)
+        pipe.zcard(mkey)
+        pipe.zcard(f"NEST:{nest_id}|MISC|priority-queue")
+    replies = pipe.execute()
+    return {nest_id: (replies[3 * i + 1], replies[3 * i + 2])
+            for i, nest_id in enumerate(nest_ids)}
 
 
 def should_delete_nest(metadata, members, queue_size, now):
@@ -243,6 +271,74 @@ def should_delete_nest(metadata, members, queue_size, now):
     return False
 
 
+# Minutes a hibernating nest waits before it is archived to disk
+NEST_ARCHIVE_AFTER_MINUTES = 60
+
+
+def archive_after_minutes():
+    """Minutes a nest hibernates before it is archived; 0 when archival is off."""
+    minutes = getattr(CONF, 'NEST_ARCHIVE_AFTER_MINUTES', None)
+    if minutes is None:
+        minutes = NEST_ARCHIVE_AFTER_MINUTES
+    return minutes
+
+
+def should_archive_nest(metadata, now):
+    """Determine whether a hibernating nest has been parked long enough to archive.
+
+    Args:
+        metadata: dict with keys 'is_main', 'hibernated_at' (ISO string,
+                  set by NestManager.hibernate_nest), 'last_activity'
+                  (ISO string, used for nests hibernated before
+                  'hibernated_at' was recorded)
+        now: datetime.datetime representing current time
+
+    Returns:
+        True if the nest should be archived, False otherwise.
+    """
+    if metadata.get("is_main") or metadata.get("archived"):
+        return False
+    minutes = archive_after_minutes()
+    since_str = metadata.get("hibernated_at") or metadata.get("last_activity")
+    if not minutes or not since_str:
+        return False
+    since = datetime.datetime.fromisoformat(since_str)
+    return (now - since).total_seconds() / 60.0 >= minutes
+
+
+# Days an archived nest stays on disk before it is deleted
+NEST_ARCHIVE_RETENTION_DAYS = 7
+
+
+def archive_retention_days():
+    """Days archives are kept; 0 means nests are deleted at their TTL instead."""
+    days = getattr(CONF, 'NEST_ARCHIVE_RETENTION_DAYS', None)
+    if days is None:
+        days = NEST_ARCHIVE_RETENTION_DAYS
+    return days
+
+
+def should_drop_archive(metadata, now):
+    """Determine whether an archived nest has been kept long enough to delete.
+
+    Args:
+        metadata: dict with keys 'is_main', 'archived' (dict with
+                  'archived_at', an ISO string)
+        now: datetime.datetime representing current time
+
+    Returns:
+        True if the nest should be deleted, False otherwise.
+    """
+    archived = metadata.get("archived")
+    if metadata.get("is_main") or not archived:
+        return False
+    archived_at_str = archived.get("archived_at")
+    if not archived_at_str:
+        return True
+    archived_at = datetime.datetime.fromisoformat(archived_at_str)
+    return (now - archived_at).total_seconds() / 86400.0 >= archive_retention_days()
+
+
 # ---------------------------------------------------------------------------
 # NestManager class
 # ---------------------------------------------------------------------------
@@ -250,6 +346,12 @@ def should_delete_nest(metadata, members, queue_size, now):
 # Global registry key (NOT nest-scoped)
 _REGISTRY_KEY = 'NESTS|registry'
 
+# Global set of nest ids that are hibernating (NOT nest-scoped)
+HIBERNATING_KEY = 'NESTS|hibernating'
+
+# Seconds a restore may hold its lock (and other readers wait for it)
+RESTORE_LOCK_SECONDS = 10
+
 
 def _code_key(code):
     """Return the Redis key for a nest code lookup (global, NOT nest-scoped)."""
@@ -291,6 +393,9 @@ class NestManager:
                 host=redis_host, port=redis_port,
                 password=redis_password, decode_responses=True
             )
+        self._hibernate = self._r.register_script(redis_scripts.NEST_HIBERNATE)
+        self._resume = self._r.register_script(redis_scripts.NEST_RESUME)
+        self._archive = self._r.register_script(redis_scripts.NEST_ARCHIVE)
         # Ensure main nest exists in registry
         self._ensure_main_nest()
 
@@ -350,19 +455,23 @@ class NestManager:
     def _resolve_track_seed(self, seed_track):
         """Resolve a Spotify track URI to (seed_uri, genre_hint).
 
-        Fetches track and artist metadata from Spotify to extract the
-        primary genre. Returns (seed_track, genre) or (seed_track, None)
+        Fetches track and artist metadata through the global catalog to
+        extract the primary genre. Returns (seed_track, genre) or (seed_track, None)
         if no genres found or on API error.
         """
+        import catalog
         from db import spotify_client
         try:
             track_id = seed_track.split(':')[-1]
-            track_data = spotify_client.track(track_id)
+            cat = catalog.Catalog(self._r)
+            track_data = cat.fetch(catalog.track_uri(track_id),
+                                   lambda: spotify_client.track(track_id))
             artists = track_data.get('artists', [])
             if not artists:
                 return (seed_track, None)
             artist_id = artists[0]['id']
-            artist_data = spotify_client.artist(artist_id)
+            artist_data = cat.fetch(catalog.artist_uri(artist_id),
+                                    lambda: spotify_client.artist(artist_id))
             genres = artist_data.get('genres', [])
             return (seed_track, genres[0]) if genres else (seed_track, None)
         except Exception:
@@ -427,28 +536,35 @@ class NestManager:
     def get_nest(self, nest_id):
         """Get nest metadata by nest_id, code, or slug.
 
-        Returns dict or None if not found.
+        An archived nest is restored from disk first.  Returns dict or None
+        if not found.
         """
         raw = self._r.hget(_REGISTRY_KEY, nest_id)
         if raw:
-            return json.loads(raw)
+            return self._live(nest_id, json.loads(raw))
 
         # Try looking up by code
         looked_up_id = self._r.get(_code_key(nest_id))
         if looked_up_id:
             raw = self._r.hget(_REGISTRY_KEY, looked_up_id)
             if raw:
-                return json.loads(raw)
+                return self._live(looked_up_id, json.loads(raw))
 
         # Try looking up by slug
         looked_up_id = self._r.get(_slug_key(nest_id))
         if looked_up_id:
             raw = self._r.hget(_REGISTRY_KEY, looked_up_id)
             if raw:
-                return json.loads(raw)
+                return self._live(looked_up_id, json.loads(raw))
 
         return None
 
+    def _live(self, nest_id, meta):
+        """Return *meta*, restoring the nest from its archive first if it has one."""
+        if meta.get('archived'):
+            return self.restore_nest(nest_id, meta)
+        return meta
+
     def list_nests(self):
         """List all registered nests.
 
@@ -458,14 +574,17 @@ class NestManager:
         result = []
         for nest_id, raw_meta in all_data.items():
             try:
-                meta = json.loads(raw_meta)
-                # Add member count
-                mkey = members_key(nest_id)
-                meta['member_count'] = self._r.scard(mkey)
-                result.append((nest_id, meta))
+                result.append((nest_id, json.loads(raw_meta)))
             except (json.JSONDecodeError, TypeError):
                 logger.warning("Invalid metadata for nest %s", nest_id)
                 continue
+        # Add member counts, one pipeline for every nest
+        now = time.time()
+        pipe = self._r.pipeline(transaction=False)
+        for nest_id, _ in result:
+            pipe.zcount(members_key(nest_id), f"({now}", "+inf")
+        for (_, meta), count in zip(result, pipe.execute()):
+            meta['member_count'] = count
         return result
 
     def delete_nest(self, nest_id):
@@ -484,7 +603,7 @@ class NestManager:
         # Set DELETING flag with 30s TTL (auto-expires on crash)
         self._r.setex(deleting_key(nest_id), 30, "1")
 
-        # Get metadata to find the code and slug
+        # Get metadata to find the code, slug and archive file
         raw = self._r.hget(_REGISTRY_KEY, nest_id)
         if raw:
             try:
@@ -494,11 +613,14 @@ class NestManager:
                 slug = meta.get('slug')
                 if slug:
                     self._r.delete(_slug_key(slug))
-            except (json.JSONDecodeError, TypeError):
+                if meta.get('archived'):
+                    os.remove(nest_archive.archive_path(nest_id))
+            except (json.JSONDecodeError, TypeError, OSError):
                 pass
 
         # Remove from registry
         self._r.hdel(_REGISTRY_KEY, nest_id)
+        self._r.srem(HIBERNATING_KEY, nest_id)
 
         # SCAN and unlink all NEST:{nest_id}|* keys (non-blocking)
         prefix = _nest_prefix(nest_id)
@@ -515,36 +637,195 @@ class NestManager:
 
     def touch_nest(self, nest_id):
         """Update the last_activity timestamp for a nest."""
+        self._stamp_nest(nest_id, 'last_activity', datetime.datetime.now().isoformat())
+
+    def _stamp_nest(self, nest_id, field, value):
+        """Set (or, for None, remove) one field of a nest's registry metadata."""
         raw = self._r.hget(_REGISTRY_KEY, nest_id)
         if raw:
             try:
                 meta = json.loads(raw)
-                meta['last_activity'] = datetime.datetime.now().isoformat()
+                if value is None:
+                    meta.pop(field, None)
+                else:
+                    meta[field] = value
                 self._r.hset(_REGISTRY_KEY, nest_id, json.dumps(meta))
             except (json.JSONDecodeError, TypeError):
                 pass
 
     def join_nest(self, nest_id, email):
-        """Add a member to a nest's MEMBERS set and broadcast update."""
-        mkey = members_key(nest_id)
-        self._r.sadd(mkey, email)
+        """Add a member to a nest's MEMBERS set, wake the nest and broadcast update."""
+        self.restore_nest(nest_id)
+        refresh_member_ttl(self._r, nest_id, email)
+        self.resume_nest(nest_id)
         self.touch_nest(nest_id)
         self._broadcast_member_update(nest_id)
 
+    def heartbeat(self, nest_id, email):
+        """Refresh a connected member's heartbeat and wake the nest if needed.
+
+        Another connection for the same member leaving can hibernate the
+        nest while this one is still listening; the next heartbeat puts
+        the member back and resumes it.
+        """
+        refresh_member_ttl(self._r, nest_id, email)
+        self.resume_nest(nest_id)
+
     def leave_nest(self, nest_id, email):
-        """Remove a member from a nest's MEMBERS set and delete TTL key."""
-        mkey = members_key(nest_id)
-        self._r.srem(mkey, email)
-        # Also delete the member TTL key
-        mk = member_key(nest_id, email)
-        self._r.delete(mk)
+        """Remove a member from a nest's MEMBERS set and broadcast update.
+
+        The last member out puts the nest into hibernation.
+        """
+        self._r.zrem(members_key(nest_id), email)
         self._broadcast_member_update(nest_id)
+        self.hibernate_nest(nest_id)
+
+    def hibernate_nest(self, nest_id):
+        """Park a nest nobody is listening to; True if it went into hibernation.
+
+        Player workers stop playing hibernating nests, so nothing fills
+        its queue from Spotify or publishes to it, and its player clock
+        stops so the playing song resumes where it was.  The time it went
+        in is kept as 'hibernated_at' in the registry, for archival.  Does
+        nothing for the main nest, for a nest with live members, or when
+        CONF.NEST_HIBERNATION is false.
+        """
+        if nest_id == "main" or getattr(CONF, 'NEST_HIBERNATION', None) is False:
+            return False
+        prefix = _nest_prefix(nest_id)
+        hibernated = self._hibernate(
+            keys=[HIBERNATING_KEY, members_key(nest_id),
+                  f"{prefix}MISC|clock", f"{prefix}MISC|current-done"],
+            args=[nest_id, time.time()])
+        if hibernated:
+            self._stamp_nest(nest_id, 'hibernated_at', datetime.datetime.now().isoformat())
+            logger.info("Nest %s has no listeners — hibernating", nest_id)
+        return bool(hibernated)
+
+    def resume_nest(self, nest_id):
+        """Wake a hibernating nest; True if it was hibernating.
+
+        The queue is untouched while a nest hibernates; the player picks it
+        up again on its worker's next check and finishes the song that was
+        playing.
+        """
+        prefix = _nest_prefix(nest_id)
+        resumed = self._resume(
+            keys=[HIBERNATING_KEY, f"{prefix}MISC|clock",
+                  f"{prefix}MISC|current-done", f"{prefix}MISC|paused"],
+            args=[nest_id, time.time()])
+        if resumed:
+            self._stamp_nest(nest_id, 'hibernated_at', None)
+            logger.info("Nest %s has a listener — resuming", nest_id)
+        return bool(resumed)
+
+    def hibernating_nests(self):
+        """Return the set of hibernating nest ids."""
+        return self._r.smembers(HIBERNATING_KEY)
+
+    def archive_nest(self, nest_id):
+        """Move a hibernating nest's keys to a compressed file on disk.
+
+        The keys are written to nest_archive.archive_path(nest_id) and
+        dropped from Redis; the registry entry stays, marked 'archived', so
+        the next get_nest() restores them.  Writes are refused while the
+        keys are copied out, as during deletion.  Returns the archive size
+        in bytes, or None if the nest was not archived (the main nest, not
+        hibernating, already archived, or someone joined meanwhile).
+        """
+        if nest_id == "main" or not self._r.sismember(HIBERNATING_KEY, nest_id):
+            return None
+        raw = self._r.hget(_REGISTRY_KEY, nest_id)
+        if not raw:
+            return None
+        meta = json.loads(raw)
+        if meta.get('archived'):
+            return None
+
+        prefix = _nest_prefix(nest_id)
+        path = nest_archive.archive_path(nest_id)
+        self._r.set(deleting_key(nest_id), "1", ex=30)
+        try:
+            entries = nest_archive.dump_keys(
+                self._r, prefix, skip={deleting_key(nest_id), f"{prefix}RESTORING"})
+            size = nest_archive.write_archive(path, nest_id, entries)
+            meta['archived'] = {
+                'bytes': size,
+                'keys': len(entries),
+                'archived_at': datetime.datetime.now().isoformat(),
+            }
+            dropped = self._archive(
+                keys=[HIBERNATING_KEY, members_key(nest_id), _REGISTRY_KEY] +
+                     [prefix + entry[0] for entry in entries],
+                args=[nest_id, time.time(), json.dumps(meta)])
+            if not dropped:
+                os.remove(path)
+                return None
+        finally:
+            self._r.delete(deleting_key(nest_id))
+        logger.info("Archived nest %s: %d keys, %d bytes in %s", nest_id, len(entries), size, path)
+        return size
+
+    def restore_nest(self, nest_id, meta=None):
+        """Load an archived nest back into Redis; return its metadata.
+
+        Only one caller restores a nest; others wait up to
+        RESTORE_LOCK_SECONDS for it.  The nest stays hibernating until
+        someone joins, and its archive timer starts over.  An unreadable
+        archive is logged and the nest comes back empty rather than
+        staying unreachable.
+        """
+        if meta is None:
+            raw = self._r.hget(_REGISTRY_KEY, nest_id)
+            if not raw:
+                return None
+            meta = json.loads(raw)
+        if not meta.get('archived'):
+            return meta
+
+        prefix = _nest_prefix(nest_id)
+        lock = f"{prefix}RESTORING"
+        if not self._r.set(lock, "1", nx=True, ex=RESTORE_LOCK_SECONDS):
+            # Someone else is restoring it
+            deadline = time.monotonic() + RESTORE_LOCK_SECONDS
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                raw = self._r.hget(_REGISTRY_KEY, nest_id)
+                if not raw:
+                    return None
+                current = json.loads(raw)
+                if not current.get('archived'):
+                    return current
+            logger.warning("Gave up waiting for nest %s to be restored", nest_id)
+            return meta
+
+        started = time.monotonic()
+        path = nest_archive.archive_path(nest_id)
+        try:
+            entries = nest_archive.read_archive(path)
+        except (OSError, ValueError):
+            logger.exception("Couldn't read the archive of nest %s; restoring it empty", nest_id)
+            entries = []
+        meta = dict(meta)
+        del meta['archived']
+        meta['last_activity'] = meta['hibernated_at'] = datetime.datetime.now().isoformat()
+        pipe = self._r.pipeline()
+        restored = nest_archive.restore_keys(pipe, prefix, entries)
+        pipe.hset(_REGISTRY_KEY, nest_id, json.dumps(meta))
+        pipe.delete(lock)
+        pipe.execute()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        logger.info("Restored nest %s: %d keys in %.1f ms", nest_id, restored,
+                    (time.monotonic() - started) * 1000)
+        return meta
 
     def _broadcast_member_update(self, nest_id):
         """Publish member_update event with current count on the nest's pubsub channel."""
         try:
-            mkey = members_key(nest_id)
-            count = self._r.scard(mkey)
+            count = active_member_count(self._r, nest_id)
             channel = pubsub_channel(nest_id)
             self._r.publish(channel, f"member_update|{count}")
         except Exception:
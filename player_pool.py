@@ -0,0 +1,129 @@
+"""Consistent-hash sharding of nest players across worker processes.
+
+Every master_player.py process is a PlayerWorker.  Workers heartbeat into
+``PLAYERS|workers`` (worker id -> last beat epoch) and each one builds the
+same HashRing from the workers that beat within PLAYER_WORKER_TIMEOUT_SECONDS,
+then plays only the nests the ring assigns to it.  When a worker stops
+beating, its nests move to the survivors on their next beat; a worker
+joining or leaving moves only about 1/N of the nests.
+
+Handover is safe without coordination because each nest player holds a
+fenced lease (see DB.master_player): the new owner starts playing once the
+old owner's lease is released or expires.  Heartbeats use each host's
+clock, so hosts need to be NTP-synced to well within the timeout.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+
+from config import CONF
+
+logger = logging.getLogger(__name__)
+
+WORKERS_KEY = 'PLAYERS|workers'   # ZSET worker id -> last heartbeat epoch
+
+DEFAULT_HEARTBEAT_SECONDS = 1
+DEFAULT_TIMEOUT_SECONDS = 3
+DEFAULT_REPLICAS = 64
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _lease_key(nest_id):
+    return 'NEST:{0}|MISC|master-player'.format(nest_id)
+
+
+class HashRing(object):
+    """Consistent-hash ring with *replicas* virtual points per worker."""
+
+    def __init__(self, workers=(), replicas=DEFAULT_REPLICAS):
+        self.workers = frozenset(workers)
+        points = sorted((_hash('%s#%d' % (worker, i)), worker)
+                        for worker in self.workers for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [worker for _, worker in points]
+
+    def owner(self, key):
+        """Return the worker that owns *key*, or None for an empty ring."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class PlayerWorker(object):
+    """This process's membership in the player pool."""
+
+    def __init__(self, redis_client, worker_id=None, timeout=None, replicas=None):
+        self._r = redis_client
+        self.worker_id = worker_id or '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.heartbeat_seconds = (getattr(CONF, 'PLAYER_WORKER_HEARTBEAT_SECONDS', None)
+                                  or DEFAULT_HEARTBEAT_SECONDS)
+        self.timeout = (timeout or getattr(CONF, 'PLAYER_WORKER_TIMEOUT_SECONDS', None)
+                        or DEFAULT_TIMEOUT_SECONDS)
+        self.replicas = replicas or DEFAULT_REPLICAS
+        self.ring = HashRing((), self.replicas)
+
+    def beat(self):
+        """Record a heartbeat, drop workers past the timeout and refresh the ring.
+
+        Returns the live worker ids.  One pipelined round trip.
+        """
+        now = time.time()
+        pipe = self._r.pipeline(transaction=False)
+        pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+        pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - self.timeout)
+        pipe.zrange(WORKERS_KEY, 0, -1)
+        live = pipe.execute()[-1]
+        if set(live) != self.ring.workers:
+            logger.info("Player workers changed: %s", ', '.join(sorted(live)))
+            self.ring = HashRing(live, self.replicas)
+        return live
+
+    def owned(self, nest_ids):
+        """The subset of *nest_ids* this worker should play."""
+        return {nid for nid in nest_ids if self.ring.owner(nid) == self.worker_id}
+
+    def leave(self):
+        """Drop out of the pool so the other workers take over at once."""
+        self._r.zrem(WORKERS_KEY, self.worker_id)
+
+
+def player_assignments(redis_client, nest_ids, timeout=None, replicas=None):
+    """Admin view of the pool: live workers and who plays each nest.
+
+    Each nest lists the worker the ring assigns it to and the worker that
+    holds its player lease right now (they differ briefly during a
+    handover).
+    """
+    timeout = timeout or getattr(CONF, 'PLAYER_WORKER_TIMEOUT_SECONDS', None) or DEFAULT_TIMEOUT_SECONDS
+    now = time.time()
+    beats = dict(redis_client.zrangebyscore(WORKERS_KEY, now - timeout, '+inf', withscores=True))
+    ring = HashRing(beats, replicas or DEFAULT_REPLICAS)
+    nest_ids = sorted(nest_ids)
+    pipe = redis_client.pipeline(transaction=False)
+    for nid in nest_ids:
+        pipe.get(_lease_key(nid))
+    nests = []
+    for nid, lease in zip(nest_ids, pipe.execute()):
+        holder, _, token = (lease or '').rpartition('|')
+        nests.append({
+            'nest_id': nid,
+            'assigned': ring.owner(nid),
+            'playing': holder or None,
+            'token': int(token) if lease else None,
+        })
+    workers = [{
+        'worker_id': worker,
+        'heartbeat_age': round(now - beats[worker], 2),
+        'nests': [n['nest_id'] for n in nests if n['assigned'] == worker],
+    } for worker in sorted(beats)]
+    return {'workers': workers, 'nests': nests}
@@ -0,0 +1,177 @@
+"""Per-process cache of serialized playlists, keyed by nest and queue version.
+
+Every queue mutation bumps ``MISC|queue-version`` (see DB._queue_changed), so
+a (nest, version) pair identifies one playlist state.  When a
+``playlist_update`` fans out to every WebSocket listener and SSE stream in a
+worker, the first caller builds the snapshot and everyone else reuses it;
+callers that arrive while the build is still running wait for it instead of
+building their own.
+
+Each snapshot also remembers the previous one built in this process, so it
+can describe itself as a diff (insert / move / remove / patch ops) from that
+base version; clients holding the base version apply the ops, anyone else
+asks for a full snapshot.
+"""
+
+import logging
+
+from gevent.event import AsyncResult
+
+logger = logging.getLogger(__name__)
+
+# Key of the Bender preview card, the only playlist item without a song id
+PREVIEW_KEY = '__preview__'
+
+
+def item_key(item):
+    """Stable identity of a playlist item for diffing."""
+    return str(item.get('id') or '') or PREVIEW_KEY
+
+
+def queue_diff(old, new):
+    """Return the ops that turn playlist *old* into *new*.
+
+    Ops are applied in order: removes, then field patches, then inserts and
+    moves whose indexes refer to the list as rebuilt so far.  Returns None
+    when items can't be told apart or the diff wouldn't be smaller than
+    resending *new*.
+    """
+    old_keys = [item_key(x) for x in old]
+    new_keys = [item_key(x) for x in new]
+    if len(set(old_keys)) != len(old_keys) or len(set(new_keys)) != len(new_keys):
+        return None
+    old_by_key = dict(zip(old_keys, old))
+    new_by_key = dict(zip(new_keys, new))
+
+    ops = []
+    for key in old_keys:
+        if key not in new_by_key:
+            ops.append({'op': 'remove', 'id': key})
+    for key in new_keys:
+        before = old_by_key.get(key)
+        if before is None:
+            continue
+        after = new_by_key[key]
+        fields = {k: v for k, v in after.items() if before.get(k) != v}
+        fields.update((k, None) for k in before if k not in after)
+        if fields:
+            ops.append({'op': 'patch', 'id': key, 'fields': fields})
+
+    order = [key for key in old_keys if key in new_by_key]
+    for index, key in enumerate(new_keys):
+        if key not in old_by_key:
+            ops.append({'op': 'insert', 'id': key, 'index': index, 'item': new_by_key[key]})
+            order.insert(index, key)
+        elif order[index] != key:
+            ops.append({'op': 'move', 'id': key, 'index': index})
+            order.remove(key)
+            order.insert(index, key)
+
+    if len(ops) > max(len(new), 1):
+        return None
+    return ops
+
+
+class PlaylistSnapshot(object):
+    """One built playlist plus lazily encoded forms of it (WS frame, SSE payload)."""
+
+    __slots__ = ('nest_id', 'version', 'queue', 'base_version', 'base_queue', '_encoded')
+
+    def __init__(self, nest_id, version, queue, base_version=None, base_queue=None):
+        self.nest_id = nest_id
+        self.version = version
+        self.queue = queue
+        self.base_version = base_version
+        self.base_queue = base_queue
+        self._encoded = {}
+
+    def encoded(self, name, encode):
+        """Return encode(queue), computed once per snapshot and memoized under *name*."""
+        rv = self._encoded.get(name)
+        if rv is None:
+            rv = self._encoded[name] = encode(self.queue)
+        return rv
+
+    def diff(self, name='raw', transform=None):
+        """Return {'base', 'seq', 'ops'} relative to the previous snapshot, or None.
+
+        *transform* maps a raw playlist to the form the client holds (e.g.
+        the trimmed API items); the result is memoized under *name*.
+        """
+        if self.base_queue is None:
+            return None
+
+        def build(queue):
+            old = self.base_queue
+            if transform is not None:
+                old, queue = transform(old), transform(queue)
+            ops = queue_diff(old, queue)
+            if ops is None:
+                return False
+            return {'base': self.base_version, 'seq': self.version, 'ops': ops}
+
+        return self.encoded('diff:' + name, build) or None
+
+
+class PlaylistCache(object):
+    """Cache of the latest PlaylistSnapshot per nest.
+
+    Snapshots are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._latest = {}    # nest_id -> PlaylistSnapshot
+        self._building = {}  # (nest_id, version) -> AsyncResult
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, db):
+        """Return the PlaylistSnapshot for *db*'s nest at its current queue version."""
+        version = db.get_queue_version()
+        snapshot = self._latest.get(db.nest_id)
+        if snapshot is not None and snapshot.version == version:
+            self.hits += 1
+            return snapshot
+
+        key = (db.nest_id, version)
+        pending = self._building.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.get()
+
+        self.misses += 1
+        pending = self._building[key] = AsyncResult()
+        try:
+            base = snapshot if snapshot is not None and snapshot.version < version else None
+            snapshot = PlaylistSnapshot(db.nest_id, version, db.get_queued(),
+                                        base_version=base and base.version,
+                                        base_queue=base and base.queue)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            self._building.pop(key, None)
+        pending.set(snapshot)
+
+        current = self._latest.get(db.nest_id)
+        if current is None or current.version <= version:
+            self._latest[db.nest_id] = snapshot
+        return snapshot
+
+    def forget(self, nest_id):
+        """Drop the cached snapshot for a deleted nest."""
+        self._latest.pop(nest_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            'nests': len(self._latest),
+        }
+
+
+playlist_cache = PlaylistCache()
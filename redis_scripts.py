@@ -0,0 +1,827 @@
+"""Server-side Lua scripts for the queue and player.
+
+Each script is a module-level source string; DB registers them lazily via
+``DB._script(name)`` so they run with a single EVALSHA round trip.  Scripts
+take the nest key prefix (``NEST:{id}|``) as ARGV so they can address the
+per-song keys (``QUEUE|{id}``, ``QUEUEJAM|{id}``, ...) of that nest.
+"""
+
+# Shared Lua helpers prepended to every script that adds, removes or moves
+# queue entries: the per-user queue indexes and slot scoring.
+#
+# Alongside the queue-users hash (id -> user) each nest keeps:
+#
+#   MISC|queue-user|{user}    ZSET id -> score of that user's queued songs
+#   MISC|queue-ordinal|{n}    ZSET id -> score of every song that is its
+#                             owner's nth in queue order
+#
+# so "the first song that is anyone's nth" is one ZRANGE instead of a scan.
+# Adding or removing a song only renumbers its owner's later songs.
+#
+# Priority queue scores are integers spaced RANK_GAP apart.  A song placed
+# between two others takes the integer midpoint; once neighbors are less
+# than 2 apart, a window around the slot (doubled until its songs can sit
+# at least MIN_STEP apart) is respaced evenly, so scores never run out of
+# float precision and a move costs O(log n) plus the occasional local
+# renumbering.
+_QUEUE_LIB = """
+local function user_key(prefix, user)
+    return prefix .. 'MISC|queue-user|' .. user
+end
+
+local function ordinal_key(prefix, n)
+    return prefix .. 'MISC|queue-ordinal|' .. n
+end
+
+-- move a user's songs (flat id/score list) from ordinal first.. by delta
+local function shift_ordinals(prefix, flat, first, delta)
+    local n = first
+    for i = 1, #flat, 2 do
+        redis.call('ZREM', ordinal_key(prefix, n), flat[i])
+        redis.call('ZADD', ordinal_key(prefix, n + delta), flat[i + 1], flat[i])
+        n = n + 1
+    end
+end
+
+local function index_add(prefix, id, user, score)
+    local ukey = user_key(prefix, user)
+    redis.call('HSET', prefix .. 'MISC|queue-users', id, user)
+    redis.call('ZADD', ukey, score, id)
+    local rank = redis.call('ZRANK', ukey, id)
+    shift_ordinals(prefix, redis.call('ZRANGE', ukey, rank + 1, -1, 'WITHSCORES'), rank + 1, 1)
+    redis.call('ZADD', ordinal_key(prefix, rank + 1), score, id)
+end
+
+local function index_remove(prefix, id)
+    local users_key = prefix .. 'MISC|queue-users'
+    local user = redis.call('HGET', users_key, id)
+    if not user then
+        return
+    end
+    redis.call('HDEL', users_key, id)
+    local ukey = user_key(prefix, user)
+    local rank = redis.call('ZRANK', ukey, id)
+    if not rank then
+        return
+    end
+    redis.call('ZREM', ordinal_key(prefix, rank + 1), id)
+    local later = redis.call('ZRANGE', ukey, rank + 1, -1, 'WITHSCORES')
+    redis.call('ZREM', ukey, id)
+    shift_ordinals(prefix, later, rank + 2, -1)
+end
+
+-- re-score a song its owner already has at index rank old_rank (taken
+-- before any respacing); only the owner's songs it passes change ordinal
+local function index_move(prefix, id, user, old_rank, score)
+    local ukey = user_key(prefix, user)
+    redis.call('ZREM', ordinal_key(prefix, old_rank + 1), id)
+    redis.call('ZADD', ukey, score, id)
+    local rank = redis.call('ZRANK', ukey, id)
+    if rank > old_rank then
+        shift_ordinals(prefix, redis.call('ZRANGE', ukey, old_rank, rank - 1, 'WITHSCORES'),
+                       old_rank + 2, -1)
+    elseif rank < old_rank then
+        shift_ordinals(prefix, redis.call('ZRANGE', ukey, rank + 1, old_rank, 'WITHSCORES'),
+                       rank + 1, 1)
+    end
+    redis.call('ZADD', ordinal_key(prefix, rank + 1), score, id)
+end
+
+-- delete every per-user and ordinal ZSET plus the queue-users hash
+local function index_clear(prefix)
+    local users_key = prefix .. 'MISC|queue-users'
+    local depth, done = 0, {}
+    for _, user in ipairs(redis.call('HVALS', users_key)) do
+        if not done[user] then
+            done[user] = true
+            local ukey = user_key(prefix, user)
+            depth = math.max(depth, redis.call('ZCARD', ukey))
+            redis.call('DEL', ukey)
+        end
+    end
+    for n = 1, depth do
+        redis.call('DEL', ordinal_key(prefix, n))
+    end
+    redis.call('DEL', users_key)
+end
+
+-- rebuild the indexes from the priority queue; owners missing from the
+-- queue-users hash are read from the QUEUE hash, ids with neither expired
+-- and are dropped.  Returns the number of ids dropped.
+local function index_rebuild(prefix, queue_key)
+    local users_key = prefix .. 'MISC|queue-users'
+    local ranked = redis.call('ZRANGE', queue_key, 0, -1, 'WITHSCORES')
+    local owners = {}
+    for i = 1, #ranked, 2 do
+        local id = ranked[i]
+        owners[id] = redis.call('HGET', users_key, id)
+            or redis.call('HGET', prefix .. 'QUEUE|' .. id, 'user')
+    end
+    index_clear(prefix)
+    local counts, dropped = {}, 0
+    for i = 1, #ranked, 2 do
+        local id, score = ranked[i], ranked[i + 1]
+        local owner = owners[id]
+        if owner then
+            local n = (counts[owner] or 0) + 1
+            counts[owner] = n
+            redis.call('HSET', users_key, id, owner)
+            redis.call('ZADD', user_key(prefix, owner), score, id)
+            redis.call('ZADD', ordinal_key(prefix, n), score, id)
+        else
+            redis.call('ZREM', queue_key, id)
+            dropped = dropped + 1
+        end
+    end
+    return dropped
+end
+
+local RANK_GAP = 1024
+local MIN_STEP = 16
+
+-- give queued ids (flat id/score list, queue order) new scores, keeping the
+-- per-user index scores in step; order is unchanged, so ordinals stay put
+local function respace(prefix, queue_key, flat, scores)
+    local users_key = prefix .. 'MISC|queue-users'
+    local ordinals = {}
+    for i = 1, #flat, 2 do
+        local user = redis.call('HGET', users_key, flat[i])
+        if user then
+            ordinals[i] = {user, redis.call('ZRANK', user_key(prefix, user), flat[i])}
+        end
+    end
+    local n = 0
+    for i = 1, #flat, 2 do
+        n = n + 1
+        local id, score = flat[i], scores[n]
+        redis.call('ZADD', queue_key, score, id)
+        local owner = ordinals[i]
+        if owner and owner[2] then
+            redis.call('ZADD', user_key(prefix, owner[1]), score, id)
+            redis.call('ZADD', ordinal_key(prefix, owner[2] + 1), score, id)
+        end
+    end
+    redis.call('INCRBY', prefix .. 'MISC|queue-renumbers', n)
+end
+
+local function score_at(queue_key, rank)
+    return tonumber(redis.call('ZRANGE', queue_key, rank, rank, 'WITHSCORES')[2])
+end
+
+-- integer score for a song inserted at index pos (0-based) of the queue,
+-- which must not contain the song itself
+local function slot_score(prefix, queue_key, pos)
+    local size = redis.call('ZCARD', queue_key)
+    local prev = pos > 0 and score_at(queue_key, pos - 1)
+    local next = pos < size and score_at(queue_key, pos)
+    if not prev and not next then
+        return RANK_GAP
+    elseif not next then
+        return math.floor(prev) + RANK_GAP
+    elseif not prev then
+        return math.ceil(next) - RANK_GAP
+    elseif next - prev >= 2 then
+        return math.floor((prev + next) / 2)
+    end
+
+    local half = 1
+    while true do
+        local lo, hi = math.max(pos - half, 0), math.min(pos + half, size) - 1
+        local lower = lo > 0 and score_at(queue_key, lo - 1)
+        local upper = hi < size - 1 and score_at(queue_key, hi + 1)
+        local count = hi - lo + 2  -- window songs plus the new one
+        local step, base = RANK_GAP, 0
+        if lower and upper then
+            step = math.floor((upper - lower) / (count + 1))
+            base = math.floor(lower)
+        elseif lower then
+            base = math.floor(lower)
+        elseif upper then
+            base = math.ceil(upper) - (count + 1) * RANK_GAP
+        end
+        if step >= MIN_STEP then
+            local flat = redis.call('ZRANGE', queue_key, lo, hi, 'WITHSCORES')
+            local scores, k = {}, 0
+            for i = 1, count - 1 do
+                k = k + 1
+                if lo + i - 1 == pos then
+                    k = k + 1  -- leave the new song's slot free
+                end
+                scores[i] = base + k * step
+            end
+            respace(prefix, queue_key, flat, scores)
+            return base + (pos - lo + 1) * step
+        end
+        half = half * 2
+    end
+end
+"""
+
+# Read the whole queue in one round trip: ordered ids + scores, each song's
+# hash, jams (with timestamps), throwback jam markers and comments.  Entries
+# whose QUEUE hash has expired are dropped from the priority queue (and the
+# per-user indexes) on the way.
+#
+# KEYS[1] = priority queue ZSET
+# ARGV[1] = nest key prefix
+#
+# Returns {entries, stale_ids} where each entry is
+# {id, score, hash_flat, jams_flat, throwback_users, comments_flat}.
+QUEUE_SNAPSHOT = _QUEUE_LIB + """
+local prefix = ARGV[1]
+local ranked = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local entries = {}
+local stale = {}
+for i = 1, #ranked, 2 do
+    local id = ranked[i]
+    local song = redis.call('HGETALL', prefix .. 'QUEUE|' .. id)
+    if #song == 0 then
+        redis.call('ZREM', KEYS[1], id)
+        index_remove(prefix, id)
+        stale[#stale + 1] = id
+    else
+        entries[#entries + 1] = {
+            id, ranked[i + 1], song,
+            redis.call('ZRANGE', prefix .. 'QUEUEJAM|' .. id, 0, -1, 'WITHSCORES'),
+            redis.call('SMEMBERS', prefix .. 'QUEUEJAM_TB|' .. id),
+            redis.call('ZRANGE', prefix .. 'COMMENTS|' .. id, 0, -1, 'WITHSCORES'),
+        }
+    end
+end
+return {entries, stale}
+"""
+
+# Drop queue entries whose QUEUE hash has passed its TTL, using the expiry
+# index (a ZSET of id -> expiry epoch) instead of an EXISTS per queued id.
+# An id whose hash is still alive (TTL was extended) is re-indexed at its
+# real expiry rather than dropped.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = expiry index ZSET
+# ARGV[1] = nest key prefix
+# ARGV[2] = now (epoch seconds)
+#
+# Returns {removed_ids, remaining_queue_size}.
+QUEUE_EXPIRE = _QUEUE_LIB + """
+local prefix = ARGV[1]
+local now = tonumber(ARGV[2])
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+local removed = {}
+for _, id in ipairs(due) do
+    local ttl = redis.call('TTL', prefix .. 'QUEUE|' .. id)
+    if ttl > 0 then
+        redis.call('ZADD', KEYS[2], now + ttl, id)
+    else
+        redis.call('ZREM', KEYS[2], id)
+        if ttl == -2 then
+            index_remove(prefix, id)
+            if redis.call('ZREM', KEYS[1], id) == 1 then
+                removed[#removed + 1] = id
+            end
+        end
+    end
+end
+return {removed, redis.call('ZCARD', KEYS[1])}
+"""
+
+# Queue insert shared by QUEUE_ADD and QUEUE_ADD_MANY (KEYS as documented
+# there): depth check, id assignment, fair interleave position, QUEUE hash,
+# vote set, expiry index and per-user indexes.  *song* carries force_first,
+# auto, penalty and a flat field/value list.
+#
+# A user's nth song goes right before the first song that is anyone's
+# (n+1)th; auto (Bender) songs and anything without such a slot go last.
+# n comes from the user's index ZCARD and the slot from the (n+1)th ordinal
+# ZSET, so placement costs a few O(log n) lookups at any queue depth.
+# force_first puts the song at the front; a penalty pushes it that many
+# places further back.
+#
+# Returns id, score or nil when the queue is full.
+_QUEUE_ADD_LIB = _QUEUE_LIB + """
+local function add_song(prefix, user, user_lc, song, max_depth, now, ttl)
+    local size = redis.call('ZCARD', KEYS[1])
+    if max_depth > 0 and size >= max_depth then
+        return nil
+    end
+
+    local pos = size
+    if song.force_first then
+        pos = 0
+    elseif not song.auto then
+        local mine = redis.call('ZCARD', user_key(prefix, user_lc)) + 1
+        -- the first song that is someone's (mine + 1)th can't be first
+        local slot = redis.call('ZRANGE', ordinal_key(prefix, mine + 1), 0, 0)
+        if #slot > 0 then
+            pos = redis.call('ZRANK', KEYS[1], slot[1])
+        end
+    end
+    pos = math.min(pos + math.max(math.floor(song.penalty), 0), size)
+    local score = slot_score(prefix, KEYS[1], pos)
+
+    local id = redis.call('INCR', KEYS[2])
+    local key = prefix .. 'QUEUE|' .. id
+    local fields = {key}
+    for _, v in ipairs(song.fields) do
+        fields[#fields + 1] = v
+    end
+    fields[#fields + 1] = 'id'
+    fields[#fields + 1] = id
+    redis.call('HSET', unpack(fields))
+    redis.call('EXPIRE', key, ttl)
+    redis.call('ZADD', KEYS[5], now + ttl, id)
+
+    local vote_key = prefix .. 'QUEUE|VOTE|' .. id
+    redis.call('SADD', vote_key, user)
+    redis.call('EXPIRE', vote_key, ttl)
+
+    redis.call('ZADD', KEYS[1], score, id)
+    score = redis.call('ZSCORE', KEYS[1], id)
+    index_add(prefix, id, user, score)
+    return id, score
+end
+
+-- the indexes must cover the queue before placing anything: entries queued
+-- before they existed get indexed, ids whose QUEUE hash expired are dropped
+local function ensure_indexed(prefix)
+    if redis.call('HLEN', KEYS[3]) ~= redis.call('ZCARD', KEYS[1]) then
+        index_rebuild(prefix, KEYS[1])
+    end
+end
+"""
+
+# Add a song to the queue atomically (see add_song above) and bump the
+# queue version.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = song id counter
+# KEYS[3] = queue-users HASH (id -> user)
+# KEYS[4] = queue version counter
+# KEYS[5] = expiry index ZSET
+# ARGV[1] = nest key prefix
+# ARGV[2] = user, ARGV[3] = lowercased user
+# ARGV[4] = force_first ('1'/'0'), ARGV[5] = auto ('1'/'0')
+# ARGV[6] = penalty (places), ARGV[7] = max depth (0 = unlimited)
+# ARGV[8] = now (epoch seconds), ARGV[9] = QUEUE hash TTL
+# ARGV[10..] = song hash field/value pairs
+#
+# Returns {id, score} or an empty table when the queue is full.
+QUEUE_ADD = _QUEUE_ADD_LIB + """
+local prefix = ARGV[1]
+local fields = {}
+for i = 10, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+local song = {force_first = ARGV[4] == '1', auto = ARGV[5] == '1',
+              penalty = tonumber(ARGV[6]), fields = fields}
+
+ensure_indexed(prefix)
+local id, score = add_song(prefix, ARGV[2], ARGV[3], song, tonumber(ARGV[7]),
+                           tonumber(ARGV[8]), tonumber(ARGV[9]))
+if not id then
+    return {}
+end
+redis.call('INCR', KEYS[4])
+return {id, score}
+"""
+
+# Add several songs for one user in order, each placed as if added on its
+# own, with a single version bump.  Songs past the depth limit are skipped.
+#
+# KEYS as QUEUE_ADD
+# ARGV[1] = nest key prefix
+# ARGV[2] = user, ARGV[3] = lowercased user
+# ARGV[4] = penalty (places), ARGV[5] = max depth (0 = unlimited)
+# ARGV[6] = now (epoch seconds), ARGV[7] = QUEUE hash TTL
+# ARGV[8..] = per song: auto ('1'/'0'), item count n, then n field/value items
+#
+# Returns the ids added, in order.
+QUEUE_ADD_MANY = _QUEUE_ADD_LIB + """
+local prefix = ARGV[1]
+local max_depth, now, ttl = tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+ensure_indexed(prefix)
+
+local ids = {}
+local i = 8
+while i <= #ARGV do
+    local n = tonumber(ARGV[i + 1])
+    local fields = {}
+    for j = i + 2, i + 1 + n do
+        fields[#fields + 1] = ARGV[j]
+    end
+    local song = {force_first = false, auto = ARGV[i] == '1',
+                  penalty = tonumber(ARGV[4]), fields = fields}
+    local id = add_song(prefix, ARGV[2], ARGV[3], song, max_depth, now, ttl)
+    if not id then
+        break
+    end
+    ids[#ids + 1] = id
+    i = i + 2 + n
+end
+if #ids > 0 then
+    redis.call('INCR', KEYS[4])
+end
+return ids
+"""
+
+# Remove songs from the queue and from the expiry and per-user indexes.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = expiry index ZSET
+# ARGV[1] = nest key prefix
+# ARGV[2..] = song ids
+#
+# Returns the number of ids that were in the priority queue.
+QUEUE_REMOVE = _QUEUE_LIB + """
+local prefix = ARGV[1]
+local removed = 0
+for i = 2, #ARGV do
+    local id = ARGV[i]
+    index_remove(prefix, id)
+    redis.call('ZREM', KEYS[2], id)
+    removed = removed + redis.call('ZREM', KEYS[1], id)
+end
+return removed
+"""
+
+# Pop the head of the queue for the player and make it the playing song.
+#
+# Heads whose QUEUE hash has no 'src' (expired or corrupt) are dropped and
+# the next one is tried.  The popped song's hash gets the playing TTL,
+# MISC|now-playing and MISC|now-playing-done are set and the version is
+# bumped.  A song queued by a human (not Bender) becomes MISC|last-queued
+# and ends the Bender streak.  Two players popping at once always get
+# different songs.  Given the player clock, the song's MISC|current-done
+# and MISC|started-on are written too, so listeners woken by the swap
+# never see the previous song's times.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = expiry index ZSET
+# KEYS[3] = MISC|now-playing
+# KEYS[4] = MISC|now-playing-done
+# KEYS[5] = queue version counter
+# KEYS[6] = MISC|last-queued
+# KEYS[7] = MISC|bender_streak_start
+# KEYS[8] = MISC|current-done
+# KEYS[9] = MISC|started-on
+# KEYS[10] = MISC|player-epoch
+# ARGV[1] = nest key prefix, ARGV[2] = Bender's user id
+# ARGV[3] = now-playing TTL, ARGV[4] = playing song hash TTL
+# ARGV[5] = player clock as epoch seconds ('' to leave the times alone)
+# ARGV[6] = player clock as an ISO string, for MISC|started-on
+# ARGV[7] = the player's fencing token ('' for an unfenced pop)
+#
+# Returns {id, flat song hash, 1 if queued by a human}, or nil (with
+# MISC|now-playing cleared) when the queue is empty.  Fails with a FENCED
+# error, changing nothing, if a newer player has taken over.
+QUEUE_POP = _QUEUE_LIB + """
+local prefix = ARGV[1]
+if ARGV[7] ~= '' and redis.call('GET', KEYS[10]) ~= ARGV[7] then
+    return redis.error_reply('FENCED stale player token ' .. ARGV[7])
+end
+while true do
+    local head = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    if not head then
+        redis.call('DEL', KEYS[3])
+        return nil
+    end
+    index_remove(prefix, head)
+    redis.call('ZREM', KEYS[1], head)
+    redis.call('ZREM', KEYS[2], head)
+
+    local song_key = prefix .. 'QUEUE|' .. head
+    local flat = redis.call('HGETALL', song_key)
+    local song = {}
+    for i = 1, #flat, 2 do
+        song[flat[i]] = flat[i + 1]
+    end
+    if song['src'] then
+        local human = 0
+        if song['src'] == 'spotify' and song['user'] ~= ARGV[2] then
+            human = 1
+            redis.call('SET', KEYS[6], song['trackid'] or '')
+            redis.call('DEL', KEYS[7])
+        end
+        local duration = math.floor(tonumber(song['duration']) or 0)
+        redis.call('EXPIRE', song_key, ARGV[4])
+        redis.call('SET', KEYS[3], head, 'EX', ARGV[3])
+        redis.call('SET', KEYS[4], head, 'EX', math.max(duration, 1))
+        if ARGV[5] ~= '' then
+            redis.call('SET', KEYS[8], tostring(tonumber(ARGV[5]) + duration + 1),
+                       'EX', math.max(duration + 1, 1))
+            redis.call('SET', KEYS[9], ARGV[6])
+        end
+        redis.call('INCR', KEYS[5])
+        return {head, flat, human}
+    end
+end
+"""
+
+# Vote on a queued song: dedupe, one-place move, vote counter, background
+# color, per-user index update and version bump in one call.
+#
+# An up vote moves the song ahead of the one before it; a down vote behind
+# the one after it (a vote on the last song changes nothing).  Each voter
+# counts once per song unless special; a song's owner can always vote it
+# down, which moves it without changing the counter.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = queue version counter
+# ARGV[1] = nest key prefix, ARGV[2] = song id, ARGV[3] = voter
+# ARGV[4] = up ('1'/'0'), ARGV[5] = voter may repeat votes ('1'/'0')
+#
+# Returns nil if the vote was not counted (repeat vote, unknown song, down
+# vote on the last song), else {rank, 1 if the song moved / 0 if it was
+# already at the head}.
+QUEUE_VOTE = _QUEUE_LIB + """
+local prefix, id, voter = ARGV[1], ARGV[2], ARGV[3]
+local up = ARGV[4] == '1'
+local rank = redis.call('ZRANK', KEYS[1], id)
+if not rank then
+    return nil
+end
+
+local song_key = prefix .. 'QUEUE|' .. id
+local vote_key = prefix .. 'QUEUE|VOTE|' .. id
+local self_down = not up and redis.call('HGET', song_key, 'user') == voter
+if not self_down and ARGV[5] ~= '1' and redis.call('SISMEMBER', vote_key, voter) == 1 then
+    return nil
+end
+redis.call('SADD', vote_key, voter)
+
+local target = math.max(rank - 1, 0)
+if not up then
+    if rank == redis.call('ZCARD', KEYS[1]) - 1 then
+        return nil
+    end
+    target = rank + 1
+end
+
+if redis.call('EXISTS', song_key) == 1 then
+    local votes
+    if up then
+        votes = redis.call('HINCRBY', song_key, 'vote', 1)
+    elseif not self_down then
+        votes = redis.call('HINCRBY', song_key, 'vote', -1)
+    else
+        votes = tonumber(redis.call('HGET', song_key, 'vote')) or 0
+    end
+    -- grey that shades from 222222 toward 444444 (hot) or 000000 (cold)
+    local steps, base, other = 5, 34, 0
+    if votes > 0 then
+        other = 68
+    end
+    local n = math.min(math.abs(votes), steps)
+    local channel = math.floor((n * other + (steps - n) * base) / steps)
+    local foreground = 'f0f0ff'
+    if channel * 3 > 130 * 3 then
+        foreground = '0f0f0f'
+    end
+    redis.call('HSET', song_key,
+               'background_color', string.format('%02x%02x%02x', channel, channel, channel),
+               'foreground_color', foreground)
+end
+
+if target ~= rank then
+    local user = redis.call('HGET', prefix .. 'MISC|queue-users', id)
+    local old_rank = user and redis.call('ZRANK', user_key(prefix, user), id)
+    redis.call('ZREM', KEYS[1], id)
+    local score = slot_score(prefix, KEYS[1], target)
+    redis.call('ZADD', KEYS[1], score, id)
+    if old_rank then
+        index_move(prefix, id, user, old_rank, score)
+    elseif user then
+        index_add(prefix, id, user, score)
+    end
+end
+redis.call('INCR', KEYS[2])
+return {target, target ~= rank and 1 or 0}
+"""
+
+# Toggle one user's jam on a song, refresh the jam TTL, bump the queue
+# version if the song is still queued and award its owner a free airhorn
+# the first time the jam count reaches the threshold.
+#
+# KEYS[1] = song's QUEUEJAM ZSET
+# KEYS[2] = priority queue ZSET
+# KEYS[3] = queue version counter
+# ARGV[1] = nest key prefix, ARGV[2] = song id, ARGV[3] = user (lowercase)
+# ARGV[4] = now (epoch seconds), ARGV[5] = jam TTL, ARGV[6] = free airhorn threshold
+#
+# Returns {jam count, 1 if jammed / 0 if unjammed, 1 if queued, 1 if a free
+# airhorn was awarded}.  The award is a SADD of the song id, so concurrent
+# jams past the threshold award it once.
+QUEUE_JAM = """
+local prefix, id, user = ARGV[1], ARGV[2], ARGV[3]
+local jammed = 1
+if redis.call('ZSCORE', KEYS[1], user) then
+    redis.call('ZREM', KEYS[1], user)
+    jammed = 0
+else
+    redis.call('ZADD', KEYS[1], ARGV[4], user)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+local count = redis.call('ZCARD', KEYS[1])
+
+local queued = 0
+if redis.call('ZSCORE', KEYS[2], id) then
+    queued = 1
+    redis.call('INCR', KEYS[3])
+end
+
+local awarded = 0
+if jammed == 1 and count >= tonumber(ARGV[6]) then
+    local owner = redis.call('HGET', prefix .. 'QUEUE|' .. id, 'user')
+    if owner then
+        awarded = redis.call('SADD', prefix .. 'FREEHORN_' .. owner, id)
+    end
+end
+return {count, jammed, queued, awarded}
+"""
+
+# End a pause on the player clock: fold the time since 'paused-since' into
+# the accumulated 'paused' total.  Safe to call when not paused.
+#
+# KEYS[1] = MISC|clock hash
+# ARGV[1] = now (epoch seconds)
+#
+# Returns the seconds this pause lasted (0 if the clock wasn't paused).
+CLOCK_RESUME = """
+local since = tonumber(redis.call('HGET', KEYS[1], 'paused-since'))
+if not since then
+    return '0'
+end
+local lasted = math.max(tonumber(ARGV[1]) - since, 0)
+redis.call('HINCRBYFLOAT', KEYS[1], 'paused', tostring(lasted))
+redis.call('HDEL', KEYS[1], 'paused-since')
+return tostring(lasted)
+"""
+
+# Take a nest's player lease if nobody holds it.
+#
+# Every takeover bumps the nest's player epoch and the new value is the
+# player's fencing token; a deposed player's token is always older than
+# the epoch, so its fenced writes are refused.
+#
+# KEYS[1] = MISC|master-player (lease, value 'owner|token')
+# KEYS[2] = MISC|player-epoch
+# ARGV[1] = owner id, ARGV[2] = lease TTL in ms
+#
+# Returns the fencing token, or nil if the lease is held.
+PLAYER_LEASE_ACQUIRE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return nil
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1] .. '|' .. token, 'PX', ARGV[2])
+return token
+"""
+
+# Extend the player lease, or drop it, if the caller still holds it.
+#
+# KEYS[1] = MISC|master-player
+# ARGV[1] = lease value ('owner|token')
+# ARGV[2] = new TTL in ms, or '0' to release the lease
+#
+# Returns 1 if the caller held the lease, 0 if it had been lost.
+PLAYER_LEASE_RENEW = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Extend every player lease a scheduler holds in one call.  The keys span
+# nests, so this needs a single Redis (not Cluster), like PLAYERS|workers.
+# A lease that expired because a renewal ran late is taken back as long as
+# MISC|player-epoch still holds its token, i.e. no other player took over.
+#
+# KEYS      = MISC|master-player, MISC|player-epoch for each nest, in pairs
+# ARGV[1]   = new TTL in ms
+# ARGV[2..] = lease value ('owner|token') for each nest, in order
+#
+# Returns a list with 1 for each lease still held, 0 for each one lost.
+PLAYER_LEASE_RENEW_ALL = """
+local held = {}
+for i = 1, #KEYS / 2 do
+    local lease, epoch, value = KEYS[2 * i - 1], KEYS[2 * i], ARGV[i + 1]
+    local current = redis.call('GET', lease)
+    if current == value or (not current and
+            redis.call('GET', epoch) == string.match(value, '|(%d+)$')) then
+        redis.call('SET', lease, value, 'PX', ARGV[1])
+        held[i] = 1
+    else
+        held[i] = 0
+    end
+end
+return held
+"""
+
+# Empty the queue along with its expiry and per-user indexes.
+#
+# KEYS[1] = priority queue ZSET
+# KEYS[2] = expiry index ZSET
+# ARGV[1] = nest key prefix
+#
+# Returns the number of songs that were queued.
+QUEUE_CLEAR = _QUEUE_LIB + """
+local size = redis.call('ZCARD', KEYS[1])
+index_clear(ARGV[1])
+redis.call('DEL', KEYS[1], KEYS[2])
+return size
+"""
+
+# Put a nest with no live members into hibernation: add it to the global
+# NESTS|hibernating set (player workers stop playing it) and stop its player
+# clock so the playing song keeps its position.  MISC|current-done loses its
+# TTL, which would otherwise run out in real time.  Checking the members in
+# the same call means a concurrent join is never lost: it either lands first
+# (no hibernation) or resumes the nest afterwards.
+#
+# KEYS[1] = NESTS|hibernating SET
+# KEYS[2] = MEMBERS ZSET (heartbeat expiry scores)
+# KEYS[3] = MISC|clock hash
+# KEYS[4] = MISC|current-done
+# ARGV[1] = nest id
+# ARGV[2] = now (epoch seconds)
+#
+# Returns 1 if the nest went into hibernation, 0 if it has live members or
+# already hibernates.
+NEST_HIBERNATE = """
+if redis.call('ZCOUNT', KEYS[2], '(' .. ARGV[2], '+inf') > 0 then
+    return 0
+end
+if redis.call('SADD', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSETNX', KEYS[3], 'start', ARGV[2])
+redis.call('HSETNX', KEYS[3], 'paused-since', ARGV[2])
+redis.call('PERSIST', KEYS[4])
+return 1
+"""
+
+# Wake a hibernating nest: take it out of NESTS|hibernating, restart its
+# player clock (as CLOCK_RESUME does) and give MISC|current-done back the TTL
+# of the song's remaining time.  A nest the users had paused stays paused;
+# unpause() restarts its clock as usual.
+#
+# KEYS[1] = NESTS|hibernating SET
+# KEYS[2] = MISC|clock hash
+# KEYS[3] = MISC|current-done
+# KEYS[4] = MISC|paused
+# ARGV[1] = nest id
+# ARGV[2] = now (epoch seconds)
+#
+# Returns 1 if the nest was hibernating, 0 otherwise.
+NEST_RESUME = """
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 1
+end
+local now = tonumber(ARGV[2])
+local since = tonumber(redis.call('HGET', KEYS[2], 'paused-since'))
+if since then
+    redis.call('HINCRBYFLOAT', KEYS[2], 'paused', tostring(math.max(now - since, 0)))
+    redis.call('HDEL', KEYS[2], 'paused-since')
+end
+local done = tonumber(redis.call('GET', KEYS[3]))
+if done then
+    local reading = now - tonumber(redis.call('HGET', KEYS[2], 'paused') or 0)
+    redis.call('EXPIRE', KEYS[3], math.max(math.floor(done - reading), 1))
+end
+return 1
+"""
+
+# Drop an archived nest's keys once they are safely on disk.  The nest must
+# still be hibernating with no live members and still be registered;
+# otherwise someone joined (or deleted it) while it was being written out and
+# the archive is abandoned.  The keys span the nest and the global registry,
+# so this needs a single Redis (not Cluster), like PLAYERS|workers.
+#
+# KEYS[1]   = NESTS|hibernating SET
+# KEYS[2]   = MEMBERS ZSET (heartbeat expiry scores)
+# KEYS[3]   = NESTS|registry hash
+# KEYS[4..] = the nest keys that were archived
+# ARGV[1]   = nest id
+# ARGV[2]   = now (epoch seconds)
+# ARGV[3]   = registry metadata (JSON) marking the nest archived
+#
+# Returns 1 if the keys were dropped, 0 if the archive was abandoned.
+NEST_ARCHIVE = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 or
+        redis.call('HEXISTS', KEYS[3], ARGV[1]) == 0 or
+        redis.call('ZCOUNT', KEYS[2], '(' .. ARGV[2], '+inf') > 0 then
+    return 0
+end
+for i = 4, #KEYS, 1000 do
+    redis.call('UNLINK', unpack(KEYS, i, math.min(i + 999, #KEYS)))
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+return 1
+"""
@@ -0,0 +1,1331 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Redis-backed queue and player paths.
+
+Runs against fakeredis by default. Pass --redis-url to use a real Redis;
+latency numbers only mean something there, because fakeredis has no
+network round trip. Round-trip counts are exact either way.
+
+Usage:
+    python scripts/bench.py snapshot --depths 10,25,50,100,250
+    python scripts/bench.py expiry
+    python scripts/bench.py payload --songs 100 --nests 3
+    python scripts/bench.py add --adders 1,10,50
+    python scripts/bench.py score --depths 100,1000,5000
+    python scripts/bench.py vote --voters 1,10,50
+    python scripts/bench.py ranks --songs 500 --votes 100000
+    python scripts/bench.py jam --jammers 10,50,100
+    python scripts/bench.py pop --depth 50
+    python scripts/bench.py skip --skips 10
+    python scripts/bench.py position --resync 1,5,15 --seconds 10
+    python scripts/bench.py transition --songs 10 --spotify-ms 200
+    python scripts/bench.py --redis-url redis://localhost:6379/15 failover --kills 5
+    python scripts/bench.py scheduler --nests 1000 --seconds 10
+    python scripts/bench.py cleanup --nests 500 --members 4
+    python scripts/bench.py hibernate --nests 200 --seconds 20
+    python scripts/bench.py archive --nests 50 --songs 25
+    python scripts/bench.py --redis-url redis://localhost:6379/15 snapshot
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SKIP_SPOTIFY_PREFETCH', '1')
+
+import redis  # noqa: E402
+
+
+class RoundTripCounter(object):
+    """Count client round trips: one per command, one per pipeline execute."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self._patched = []
+        counter = self
+
+        def wrap(cls, name):
+            original = getattr(cls, name)
+
+            def counted(self, *args, **kwargs):
+                counter.count += 1
+                return original(self, *args, **kwargs)
+
+            setattr(cls, name, counted)
+            self._patched.append((cls, name, original))
+
+        wrap(redis.client.Redis, 'execute_command')
+        wrap(redis.client.Pipeline, 'execute')
+        return self
+
+    def __exit__(self, *exc):
+        for cls, name, original in reversed(self._patched):
+            setattr(cls, name, original)
+
+
+def make_client(args):
+    if args.redis_url:
+        return redis.StrictRedis.from_url(args.redis_url, decode_responses=True)
+    import fakeredis
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+
+
+def another_client(args, client):
+    """A second connection pool onto the same Redis (or fakeredis server) as *client*."""
+    if args.redis_url:
+        return redis.StrictRedis.from_url(args.redis_url, decode_responses=True)
+    import fakeredis
+    return fakeredis.FakeRedis(server=client.connection_pool.connection_kwargs['server'],
+                               decode_responses=True)
+
+
+def make_db(client, nest_id='bench'):
+    from db import DB
+    logging.getLogger('db').setLevel(logging.WARNING)
+    db = DB(nest_id=nest_id, init_history_to_redis=False, redis_client=client)
+    db._msg = lambda *a, **k: None
+    return db
+
+
+def clear_nest(client, nest_id='bench'):
+    keys = list(client.scan_iter(match='NEST:%s|*' % nest_id, count=500))
+    if keys:
+        client.delete(*keys)
+
+
+def clear_payloads(client):
+    keys = list(client.scan_iter(match='TRACK-PAYLOAD|*', count=500))
+    if keys:
+        client.delete(*keys)
+
+
+def timed(fn, repeat):
+    """Return (result, mean milliseconds) over *repeat* calls of fn()."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rv = fn()
+    return rv, (time.perf_counter() - start) * 1000.0 / repeat
+
+
+# ── snapshot ──────────────────────────────────────────────────────────
+
+def _fill_queue(db, depth):
+    """Write *depth* songs straight into the queue, each with a jam and a comment."""
+    users = ['user%d@example.com' % i for i in range(5)]
+    for i in range(depth):
+        sid = str(i + 1)
+        db.set_song_in_queue(sid, dict(
+            src='spotify', trackid='spotify:track:%d' % i, title='Song %d' % i,
+            artist='Bench', duration=200, auto=False, img='', big_img='',
+            user=users[i % len(users)], id=sid, vote=0,
+            background_color='222222', foreground_color='F0F0FF'))
+        db._r.zadd(db._key('MISC|priority-queue'), {sid: float(i + 1)})
+        db.add_jam(db._key('QUEUEJAM|%s' % sid), users[(i + 1) % len(users)])
+        db._r.zadd(db._key('COMMENTS|%s' % sid), {'%s||nice' % users[0]: int(time.time())})
+
+
+def _legacy_queue_read(db):
+    """The pre-snapshot read path: EXISTS purge, ZRANGE, then five reads per song."""
+    queue_key = db._key('MISC|priority-queue')
+    stale = [sid for sid in db._r.zrange(queue_key, 0, -1)
+             if not db._r.exists(db._key('QUEUE|{0}'.format(sid)))]
+    if stale:
+        db._r.zrem(queue_key, *stale)
+    songs = db._r.zrange(queue_key, 0, -1, withscores=True)
+    rv = []
+    for sid, score in songs:
+        data = db.get_song_from_queue(sid)
+        if not data or 'src' not in data:
+            continue
+        data['score'] = score
+        rv.append(data)
+    return rv
+
+
+def bench_snapshot(args):
+    client = make_client(args)
+    db = make_db(client)
+    print('%6s  %12s  %12s  %12s  %12s' % (
+        'depth', 'legacy trips', 'legacy ms', 'snap trips', 'snap ms'))
+    for depth in [int(d) for d in args.depths.split(',')]:
+        clear_nest(client)
+        _fill_queue(db, depth)
+        db.get_queue_snapshot()  # load the script before counting
+
+        with RoundTripCounter() as legacy_trips:
+            legacy = _legacy_queue_read(db)
+        _, legacy_ms = timed(lambda: _legacy_queue_read(db), args.repeat)
+
+        with RoundTripCounter() as snap_trips:
+            snap = db.get_queue_snapshot()
+        _, snap_ms = timed(db.get_queue_snapshot, args.repeat)
+
+        assert snap == legacy, 'snapshot differs from legacy read at depth %d' % depth
+        print('%6d  %12d  %12.2f  %12d  %12.2f' % (
+            depth, legacy_trips.count, legacy_ms, snap_trips.count, snap_ms))
+    clear_nest(client)
+
+
+# ── expiry ────────────────────────────────────────────────────────────
+
+def _legacy_purge(db):
+    """The pre-index purge: ZRANGE plus one EXISTS per queued id."""
+    queue_key = db._key('MISC|priority-queue')
+    song_ids = db._r.zrange(queue_key, 0, -1)
+    stale = [sid for sid in song_ids if not db._r.exists(db._key('QUEUE|{0}'.format(sid)))]
+    if stale:
+        db._r.zrem(queue_key, *stale)
+    return len(song_ids) - len(stale)
+
+
+def bench_expiry(args):
+    client = make_client(args)
+    db = make_db(client)
+    print('%6s  %12s  %12s  %12s  %12s' % (
+        'depth', 'exists trips', 'exists ms', 'index trips', 'index ms'))
+    for depth in [int(d) for d in args.depths.split(',')]:
+        clear_nest(client)
+        _fill_queue(db, depth)
+        db.expire_queue_entries()  # load the script before counting
+
+        with RoundTripCounter() as legacy_trips:
+            legacy = _legacy_purge(db)
+        _, legacy_ms = timed(lambda: _legacy_purge(db), args.repeat)
+
+        with RoundTripCounter() as index_trips:
+            _, size = db.expire_queue_entries()
+        _, index_ms = timed(db.expire_queue_entries, args.repeat)
+
+        assert size == legacy == depth
+        print('%6d  %12d  %12.2f  %12d  %12.2f' % (
+            depth, legacy_trips.count, legacy_ms, index_trips.count, index_ms))
+    clear_nest(client)
+
+
+# ── payload ───────────────────────────────────────────────────────────
+
+_MARKETS = ['AD', 'AE', 'AR', 'AT', 'AU', 'BE', 'BG', 'BO', 'BR', 'CA', 'CH', 'CL', 'CO',
+            'CR', 'CY', 'CZ', 'DE', 'DK', 'DO', 'EC', 'EE', 'ES', 'FI', 'FR', 'GB', 'GR',
+            'GT', 'HK', 'HN', 'HU', 'ID', 'IE', 'IL', 'IS', 'IT', 'JP', 'LI', 'LT', 'LU',
+            'LV', 'MC', 'MT', 'MX', 'MY', 'NI', 'NL', 'NO', 'NZ', 'PA', 'PE', 'PH', 'PL',
+            'PT', 'PY', 'RO', 'SE', 'SG', 'SK', 'SV', 'TH', 'TR', 'TW', 'US', 'UY', 'VN']
+
+
+def _spotify_payload(i):
+    """A /v1/tracks response shaped like the real thing (~4 KB of JSON)."""
+    artist = {'id': 'artist%d' % i, 'name': 'Artist %d' % i, 'type': 'artist',
+              'uri': 'spotify:artist:artist%d' % i,
+              'href': 'https://api.spotify.com/v1/artists/artist%d' % i,
+              'external_urls': {'spotify': 'https://open.spotify.com/artist/artist%d' % i}}
+    images = [{'height': h, 'width': h, 'url': 'https://i.scdn.co/image/%032x' % (i * 3 + n)}
+              for n, h in enumerate((640, 300, 64))]
+    return {
+        'id': 'track%d' % i, 'name': 'Song %d' % i, 'type': 'track',
+        'uri': 'spotify:track:track%d' % i, 'duration_ms': 200000, 'explicit': False,
+        'popularity': 50, 'track_number': 1, 'disc_number': 1, 'is_local': False,
+        'preview_url': 'https://p.scdn.co/mp3-preview/%040x' % i,
+        'href': 'https://api.spotify.com/v1/tracks/track%d' % i,
+        'external_ids': {'isrc': 'USXX%08d' % i},
+        'external_urls': {'spotify': 'https://open.spotify.com/track/track%d' % i},
+        'available_markets': _MARKETS, 'artists': [artist],
+        'album': {'id': 'album%d' % i, 'name': 'Album %d' % i, 'album_type': 'album',
+                  'release_date': '2020-01-01', 'release_date_precision': 'day',
+                  'total_tracks': 12, 'type': 'album', 'uri': 'spotify:album:album%d' % i,
+                  'href': 'https://api.spotify.com/v1/albums/album%d' % i,
+                  'external_urls': {'spotify': 'https://open.spotify.com/album/album%d' % i},
+                  'available_markets': _MARKETS, 'artists': [artist], 'images': images},
+    }
+
+
+def _queue_bytes(client, nest_ids):
+    from migrate_queue_payloads import key_bytes
+    total = 0
+    for nest_id in nest_ids:
+        for key in client.scan_iter(match='NEST:%s|QUEUE|*' % nest_id, count=500):
+            if '|QUEUE|VOTE|' not in key:
+                total += key_bytes(client, key)
+    for key in client.scan_iter(match='TRACK-PAYLOAD|*', count=500):
+        total += key_bytes(client, key)
+    return total
+
+
+def bench_payload(args):
+    """Bytes per queued song with the payload inline vs stored once per URI."""
+    client = make_client(args)
+    nest_ids = ['bench%d' % n for n in range(args.nests)]
+    songs = args.songs * args.nests
+
+    def fill(legacy):
+        clear_payloads(client)
+        for nest_id in nest_ids:
+            clear_nest(client, nest_id)
+            db = make_db(client, nest_id)
+            for i in range(args.songs):
+                payload = _spotify_payload(i)
+                song = dict(data=payload, src='spotify', trackid='spotify:track:track%d' % i,
+                            title='Song %d' % i, artist='Artist %d' % i, duration=200,
+                            big_img=payload['album']['images'][0]['url'], auto=False,
+                            img=payload['album']['images'][-1]['url'], user='a@example.com',
+                            id=i + 1, vote=0, background_color='222222',
+                            foreground_color='F0F0FF')
+                if legacy:
+                    db._r.hset(db._key('QUEUE|%d' % (i + 1)), mapping=dict(
+                        {k: str(v) for k, v in song.items()}, data=json.dumps(payload)))
+                else:
+                    db.set_song_in_queue(i + 1, song)
+
+    fill(legacy=True)
+    legacy = _queue_bytes(client, nest_ids)
+    fill(legacy=False)
+    compact = _queue_bytes(client, nest_ids)
+    print('%d songs (%d per nest x %d nests), same tracks in every nest' % (
+        songs, args.songs, args.nests))
+    print('  inline payload:    %8d bytes/song' % (legacy // songs))
+    print('  compact + shared:  %8d bytes/song' % (compact // songs))
+    for nest_id in nest_ids:
+        clear_nest(client, nest_id)
+    clear_payloads(client)
+
+
+# ── add ───────────────────────────────────────────────────────────────
+
+def _legacy_score(queued, userid, auto):
+    """The pre-script fair-interleave scoring over a full snapshot."""
+    if not queued:
+        return 1.0
+    if auto:
+        return queued[-1]['score'] + 1.0
+    mine = 1 + sum(1 for x in queued if x.get('user', '') == userid)
+    seen = {}
+    for i, x in enumerate(queued):
+        queuer = x.get('user', '')
+        seen[queuer] = seen.get(queuer, 0) + 1
+        if seen[queuer] == mine + 1:
+            return (queued[i - 1]['score'] + x['score']) / 2.0
+    return queued[-1]['score'] + 1.0
+
+
+def _legacy_add(db, userid, song, retries):
+    """The pre-script insert: WATCH the queue, snapshot + score, MULTI/EXEC, retry."""
+    queue_key = db._key('MISC|priority-queue')
+    while True:
+        with db._r.pipeline() as pipe:
+            try:
+                pipe.watch(queue_key)
+                id_value = db._r.incr(db._key('MISC|playlist-plays'))
+                score = _legacy_score(db.get_queue_snapshot(), userid, False)
+                pipe.multi()
+                db.set_song_in_queue(id_value, dict(song, user=userid, id=id_value, vote=0),
+                                     client=pipe)
+                pipe.sadd(db._key('QUEUE|VOTE|{0}'.format(id_value)), userid)
+                pipe.zadd(queue_key, {str(id_value): score})
+                pipe.incr(db._key('MISC|queue-version'))
+                pipe.execute()
+                return str(id_value)
+            except redis.WatchError:
+                retries.append(1)
+
+
+def bench_add(args):
+    """*adders* users each add one song at the same moment, on top of *depth* queued."""
+    import gevent
+    client = make_client(args)
+    db = make_db(client)
+    db._max_queue_depth = lambda: 0  # bench nest gets main's unlimited queue
+    song = dict(src='spotify', trackid='spotify:track:bench', title='Bench', artist='Bench',
+                duration=200, auto=False, img='', big_img='')
+    print('%8s  %12s  %10s  %12s  %12s' % (
+        'adders', 'legacy ms', 'retries', 'script ms', 'adds/s'))
+    for adders in [int(a) for a in args.adders.split(',')]:
+        results = {}
+        for mode in ('legacy', 'script'):
+            clear_nest(client)
+            _fill_queue(db, args.depth)
+            db._add_song('warmup@example.com', dict(song), False)  # load the script
+            retries = []
+            users = ['adder%d@example.com' % i for i in range(adders)]
+            if mode == 'legacy':
+                jobs = [gevent.spawn(_legacy_add, db, u, song, retries) for u in users]
+            else:
+                jobs = [gevent.spawn(db._add_song, u, dict(song), False) for u in users]
+            start = time.perf_counter()
+            gevent.joinall(jobs, raise_error=True)
+            results[mode] = ((time.perf_counter() - start) * 1000.0, len(retries))
+        legacy_ms, legacy_retries = results['legacy']
+        script_ms, _ = results['script']
+        print('%8d  %12.2f  %10d  %12.2f  %12.0f' % (
+            adders, legacy_ms, legacy_retries, script_ms, adders / (script_ms / 1000.0)))
+    clear_nest(client)
+
+
+# ── score ─────────────────────────────────────────────────────────────
+
+# The pre-index interleave scoring: walk the whole queue counting songs per user.
+_SCAN_SCORE = """
+local ranked = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+if #ranked == 0 then
+    return '1'
+end
+local owners = {}
+for i = 1, #ranked, 2 do
+    owners[#owners + 1] = redis.call('HGET', KEYS[2], ranked[i])
+end
+local mine = 1
+for _, owner in ipairs(owners) do
+    if owner == ARGV[1] then
+        mine = mine + 1
+    end
+end
+local seen = {}
+for i, owner in ipairs(owners) do
+    seen[owner] = (seen[owner] or 0) + 1
+    if seen[owner] == mine + 1 then
+        return tostring((ranked[2 * i - 2] + ranked[2 * i]) / 2.0)
+    end
+end
+return tostring(ranked[#ranked] + 1.0)
+"""
+
+
+def bench_score(args):
+    """Fair-interleave scoring cost as the queue gets deeper: scan vs per-user indexes."""
+    client = make_client(args)
+    db = make_db(client)
+    db._max_queue_depth = lambda: 0
+    scan = client.register_script(_SCAN_SCORE)
+    song = dict(src='spotify', trackid='spotify:track:bench', title='Bench', artist='Bench',
+                duration=200, auto=False, img='', big_img='')
+    print('%8s  %14s  %14s  %10s' % ('depth', 'scan score ms', 'indexed add ms', 'speedup'))
+    for depth in [int(d) for d in args.depths.split(',')]:
+        clear_nest(client)
+        _fill_queue(db, depth)
+        db._add_song('user0@example.com', dict(song), False)  # builds the indexes
+        keys = [db._key('MISC|priority-queue'), db._key('MISC|queue-users')]
+        _, scan_ms = timed(lambda: scan(keys=keys, args=['user1@example.com']), args.repeat)
+        _, add_ms = timed(lambda: db._add_song('user1@example.com', dict(song), False),
+                          args.repeat)
+        print('%8d  %14.3f  %14.3f  %9.1fx' % (depth, scan_ms, add_ms, scan_ms / add_ms))
+    clear_nest(client)
+
+
+# ── vote ──────────────────────────────────────────────────────────────
+
+def _legacy_vote(db, userid, id, up):
+    """The pre-script vote: a dozen separate reads and writes."""
+    queue_key = db._key('MISC|priority-queue')
+    user = db.get_song_from_queue(id).get('user', '')
+    self_down = user == userid and not up
+    s_id = db._key('QUEUE|VOTE|{0}'.format(id))
+    if not self_down and db._r.sismember(s_id, userid):
+        return
+    db._r.sadd(s_id, userid)
+    exist_rank = db._r.zrank(queue_key, id)
+    low_rank = exist_rank - 2 if up else exist_rank + 1
+    ids = db._r.zrange(queue_key, max(low_rank, 0), low_rank + 1)
+    if not ids:
+        return
+    current_score = db._r.zscore(queue_key, id)
+    low_score = db._r.zscore(queue_key, ids[0])
+    if len(ids) == 1:
+        new_score = low_score - 120.0 if low_rank == -1 else low_score + 120.0
+    else:
+        new_score = (low_score + db._r.zscore(queue_key, ids[1])) / 2
+    queue_hash = db._key('QUEUE|{0}'.format(id))
+    if up or not self_down:
+        db._r.hincrby(queue_hash, 'vote', 1 if up else -1)
+    votes = min(abs(int(db._r.hget(queue_hash, 'vote'))), 5)
+    channel = (votes * (68 if up else 0) + (5 - votes) * 34) // 5
+    db._r.hset(queue_hash, 'background_color', '{:02x}'.format(channel) * 3)
+    db._r.hset(queue_hash, 'foreground_color', 'f0f0ff')
+    db._r.zincrby(queue_key, new_score - current_score, id)
+    db._r.incr(db._key('MISC|queue-version'))
+
+
+def bench_vote(args):
+    """*voters* users up-vote the same song at once; report latency and round trips."""
+    import gevent
+    client = make_client(args)
+    db = make_db(client)
+    db._max_queue_depth = lambda: 0
+    song = dict(src='spotify', trackid='spotify:track:bench', title='Bench', artist='Bench',
+                duration=200, auto=False, img='', big_img='')
+    print('%8s  %10s  %12s  %10s  %12s  %14s' % (
+        'voters', 'legacy ms', 'legacy rt/v', 'script ms', 'script rt/v', 'script votes/s'))
+    for voters in [int(v) for v in args.voters.split(',')]:
+        results = {}
+        for mode in ('legacy', 'script'):
+            clear_nest(client)
+            _fill_queue(db, args.depth)
+            db._add_song('warmup@example.com', dict(song), False)  # load scripts
+            db.vote('warmup@example.com', str(args.depth), True)
+            vote = _legacy_vote if mode == 'legacy' else db.vote
+            users = ['voter%d@example.com' % i for i in range(voters)]
+            with RoundTripCounter() as trips:
+                start = time.perf_counter()
+                jobs = [gevent.spawn(vote, db, u, '1', True) if mode == 'legacy'
+                        else gevent.spawn(vote, u, '1', True) for u in users]
+                gevent.joinall(jobs, raise_error=True)
+                elapsed = (time.perf_counter() - start) * 1000.0
+            results[mode] = (elapsed, trips.count / float(voters))
+        legacy_ms, legacy_rt = results['legacy']
+        script_ms, script_rt = results['script']
+        print('%8d  %10.2f  %12.1f  %10.2f  %12.1f  %14.0f' % (
+            voters, legacy_ms, legacy_rt, script_ms, script_rt,
+            voters / (script_ms / 1000.0)))
+    clear_nest(client)
+
+
+# ── jam ───────────────────────────────────────────────────────────────
+
+def _legacy_jam(db, id, userid, threshold):
+    """The pre-script jam: reread the jam list, toggle, then check the horn.
+
+    Returns True when this jam saw the count at or past the threshold, i.e.
+    when it would have sent update_freehorn.
+    """
+    key = db._key('QUEUEJAM|{0}'.format(id))
+    userid = userid.lower()
+    if any(j['user'] == userid for j in db.get_jams(key)):
+        db._r.zrem(key, userid)
+    else:
+        db._r.zadd(key, {userid: int(time.time())})
+    db._r.expire(key, 24*60*60)
+    if db._r.zrank(db._key('MISC|priority-queue'), id) is not None:
+        db._r.incr(db._key('MISC|queue-version'))
+    if db.num_jams(key) >= threshold:
+        user = db.get_now_playing()['user']
+        db._r.sadd(db._key('FREEHORN_{0}'.format(user)), id)
+        return True
+    return False
+
+
+def bench_jam(args):
+    """*jammers* users jam the playing song at once; report latency, round trips and awards."""
+    import gevent
+    from config import CONF
+    client = make_client(args)
+    db = make_db(client)
+    print('%8s  %10s  %12s  %12s  %10s  %12s  %12s' % (
+        'jammers', 'legacy ms', 'legacy rt/j', 'legacy horns',
+        'script ms', 'script rt/j', 'script horns'))
+    for jammers in [int(v) for v in args.jammers.split(',')]:
+        CONF.FREE_AIRHORN = threshold = max(jammers // 2, 1)
+        results = {}
+        for mode in ('legacy', 'script'):
+            clear_nest(client)
+            _fill_queue(db, 1)
+            db._r.zrem(db._key('MISC|priority-queue'), '1')
+            db._r.set(db._key('MISC|now-playing'), '1')
+            db.jam('1', 'warmup@example.com')  # load the script
+            db.jam('1', 'warmup@example.com')
+            users = ['jammer%d@example.com' % i for i in range(jammers)]
+            with RoundTripCounter() as trips:
+                start = time.perf_counter()
+                if mode == 'legacy':
+                    jobs = [gevent.spawn(_legacy_jam, db, '1', u, threshold) for u in users]
+                else:
+                    jobs = [gevent.spawn(db.jam, '1', u) for u in users]
+                gevent.joinall(jobs, raise_error=True)
+                elapsed = (time.perf_counter() - start) * 1000.0
+            if mode == 'legacy':
+                horns = sum(1 for job in jobs if job.value)
+            else:
+                horns = sum(1 for job in jobs if job.value['free_horn'])
+            results[mode] = (elapsed, trips.count / float(jammers), horns)
+        print('%8d  %10.2f  %12.1f  %12d  %10.2f  %12.1f  %12d' % (
+            (jammers,) + results['legacy'] + results['script']))
+    clear_nest(client)
+
+
+# ── pop ───────────────────────────────────────────────────────────────
+
+def _legacy_pop(db):
+    """The pre-script pop_next: read the head, remove it, reread it, then set now-playing."""
+    song = db._r.zrange(db._key('MISC|priority-queue'), 0, 0)
+    if not song:
+        db._r.delete(db._key('MISC|now-playing'))
+        return {}
+    song = song[0]
+    db._remove_from_queue(song)
+    data = db.get_song_from_queue(song)
+    db._r.expire(db._key('QUEUE|{0}'.format(song)), 3*60*60)
+    db._r.setex(db._key('MISC|now-playing'), 2*60*60, song)
+    db._r.setex(db._key('MISC|now-playing-done'), data['duration'], song)
+    db._queue_changed('now_playing_update')
+    return data
+
+
+def bench_pop(args):
+    """*players* overlapping players drain a queue of Bender songs; report per-pop cost and double plays."""
+    import gevent
+    client = make_client(args)
+    db = make_db(client)
+    print('%8s  %10s  %12s  %12s' % ('mode', 'ms/pop', 'rt/pop', 'double plays'))
+    for mode in ('legacy', 'script'):
+        clear_nest(client)
+        _fill_queue(db, args.depth + 1)
+        for i in range(args.depth + 1):
+            db._r.hset(db._key('QUEUE|%d' % (i + 1)), 'user', 'the@echonest.com')
+        db.pop_next()  # load the scripts
+        db._remove_from_queue('warmup')
+        pop = (lambda: _legacy_pop(db)) if mode == 'legacy' else db.pop_next
+
+        def drain():
+            popped = []
+            song = pop()
+            while song:
+                popped.append(song['id'])
+                song = pop()
+            return popped
+
+        with RoundTripCounter() as trips:
+            start = time.perf_counter()
+            jobs = [gevent.spawn(drain) for _ in range(args.players)]
+            gevent.joinall(jobs, raise_error=True)
+            elapsed = (time.perf_counter() - start) * 1000.0
+        popped = [id for job in jobs for id in job.value]
+        pops = float(len(popped))
+        print('%8s  %10.3f  %12.1f  %12d' % (
+            mode, elapsed / pops, trips.count / pops, len(popped) - len(set(popped))))
+    clear_nest(client)
+
+
+# ── skip ──────────────────────────────────────────────────────────────
+
+def bench_skip(args):
+    """Run the real master_player and time kill_playing() until the next song plays."""
+    import gevent
+    from config import CONF
+    client = make_client(args)
+    db = make_db(client)
+    CONF.USE_BENDER = False
+    # Keep the player off Spotify and the play log
+    db.log_finished_song = lambda song: None
+    db.refresh_preview_card = lambda: None
+    db._ensure_preview_card = lambda: None
+    clear_nest(client)
+    _fill_queue(db, args.skips + 2)
+    for i in range(args.skips + 2):
+        db._r.hset(db._key('QUEUE|%d' % (i + 1)), 'user', 'the@echonest.com')
+    now_playing = db._key('MISC|now-playing')
+
+    def wait_for_change(old, limit=5.0):
+        start = time.perf_counter()
+        while client.get(now_playing) == old:
+            if time.perf_counter() - start > limit:
+                raise RuntimeError('player did not advance')
+            gevent.sleep(0.002)
+        return time.perf_counter() - start
+
+    player = gevent.spawn(db.master_player)
+    try:
+        wait_for_change(None, limit=10.0)
+        latencies = []
+        for _ in range(args.skips):
+            gevent.sleep(0.3)  # land somewhere inside the player's wait
+            playing = client.get(now_playing)
+            start = time.perf_counter()
+            db.kill_playing('bench@example.com')
+            wait_for_change(playing)
+            latencies.append((time.perf_counter() - start) * 1000.0)
+    finally:
+        player.kill()
+    latencies.sort()
+    print('%8s  %10s  %10s  %10s' % ('skips', 'p50 ms', 'max ms', 'mean ms'))
+    print('%8d  %10.1f  %10.1f  %10.1f' % (
+        len(latencies), latencies[len(latencies) // 2], latencies[-1],
+        sum(latencies) / len(latencies)))
+    clear_nest(client)
+
+
+def bench_position(args):
+    """Run the real master_player and count pp frames per resync setting."""
+    import gevent
+    from config import CONF
+    client = make_client(args)
+    db = make_db(client)
+    CONF.USE_BENDER = False
+    db.log_finished_song = lambda song: None
+    db.refresh_preview_card = lambda: None
+    db._ensure_preview_card = lambda: None
+    print('%8s  %10s  %22s' % ('resync s', 'frames', 'frames/listener/hour'))
+    for resync in [int(r) for r in args.resync.split(',')]:
+        CONF.POSITION_RESYNC_SECONDS = resync
+        clear_nest(client)
+        _fill_queue(db, 2)
+        for i in range(2):
+            db._r.hset(db._key('QUEUE|%d' % (i + 1)), 'user', 'the@echonest.com')
+        frames = []
+        db._msg = lambda msg: frames.append(msg) if msg.startswith('pp|') else None
+        player = gevent.spawn(db.master_player)
+        try:
+            gevent.sleep(args.seconds)
+        finally:
+            player.kill()
+        # Every listener receives every frame, so per-listener rate = frame rate
+        print('%8d  %10d  %22.0f' % (resync, len(frames), len(frames) * 3600.0 / args.seconds))
+    clear_nest(client)
+
+
+def bench_transition(args):
+    """Song-to-song gap in master_player with the lookahead off and on.
+
+    The queue is left empty so every transition needs a fill song, which
+    is where the old player called Spotify between songs; fill and
+    preview calls sleep --spotify-ms to stand in for Spotify.
+    """
+    import gevent
+    from config import CONF
+    client = make_client(args)
+    db = make_db(client)
+    CONF.USE_BENDER = False
+    delay = args.spotify_ms / 1000.0
+    fills = iter(range(10 ** 6))
+
+    def add_spotify_song(user, trackid, scrobble=True):
+        gevent.sleep(delay)
+        return db._add_song(user, {'src': 'spotify', 'trackid': trackid, 'title': 'Fill',
+                                   'artist': 'Bench', 'duration': 180, 'auto': True}, False)
+
+    def refresh_preview_card():
+        gevent.sleep(delay)
+        db._r.set(db._key('MISC|preview-card'), '{}')
+
+    db.log_finished_song = lambda song: None
+    db.get_fill_song = lambda: ('the@echonest.com', 'spotify:track:fill%d' % next(fills))
+    db.add_spotify_song = add_spotify_song
+    db.refresh_preview_card = refresh_preview_card
+    db._ensure_preview_card = lambda: None
+    print('%10s  %8s  %10s  %10s  %10s' % ('lookahead', 'songs', 'p50 ms', 'p95 ms', 'max ms'))
+    for mode, lookahead in (('off', 0), ('on', 600)):
+        CONF.LOOKAHEAD_SECONDS = lookahead
+        clear_nest(client)
+        player = gevent.spawn(db.master_player)
+        try:
+            for _ in range(args.songs + 1):
+                # Leave the lookahead time to finish, as a real song would
+                gevent.sleep(delay * 2 + 0.2)
+                db.kill_playing('bench@example.com')
+            gevent.sleep(delay * 2 + 0.2)
+        finally:
+            player.kill()
+            db._lookahead = None
+        stats = db.transition_stats()
+        print('%10s  %8d  %10.1f  %10.1f  %10.1f' % (
+            mode, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['max_ms']))
+    clear_nest(client)
+
+
+def bench_player_worker(args):
+    """One master_player process for `failover`; not meant to be run by hand."""
+    import gevent
+    from config import CONF
+    client = make_client(args)
+    db = make_db(client)
+    CONF.USE_BENDER = False
+    db.log_finished_song = lambda song: None
+    db.refresh_preview_card = lambda: None
+    db._ensure_preview_card = lambda: None
+    db.prepare_next = lambda: None
+    pop_next = db.pop_next
+
+    def logged_pop(now=None):
+        song = pop_next(now)
+        if song:
+            client.rpush(db._key('BENCH|plays'), song['id'])
+        return song
+
+    def report_leadership():
+        reported = None
+        while True:
+            if db._fence is not None and db._fence != reported:
+                client.set(db._key('BENCH|leader'), '%d|%s' % (os.getpid(), db._fence))
+                reported = db._fence
+            gevent.sleep(0.01)
+
+    db.pop_next = logged_pop
+    gevent.spawn(report_leadership)
+    if args.greenlets:
+        db.master_player()
+    else:
+        from nest_scheduler import NestScheduler
+        scheduler = NestScheduler(client, db_factory=lambda nest_id: db)
+        scheduler.set_nests([db.nest_id])
+        scheduler.run()
+
+
+def bench_failover(args):
+    """SIGKILL the leading player process while skips keep it busy; time the takeover."""
+    import signal
+    import subprocess
+    import gevent
+    if not args.redis_url:
+        sys.exit('failover runs players as separate processes; pass --redis-url')
+    client = make_client(args)
+    db = make_db(client)
+    clear_nest(client)
+    songs = args.kills * 50 + 100
+    _fill_queue(db, songs)
+    for i in range(songs):
+        db._r.hset(db._key('QUEUE|%d' % (i + 1)), 'user', 'the@echonest.com')
+    cmd = [sys.executable, os.path.abspath(__file__), '--redis-url', args.redis_url, 'player-worker']
+    if args.greenlets:
+        cmd.append('--greenlets')
+
+    def spawn():
+        return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_for(check, limit=30.0):
+        start = time.perf_counter()
+        while not check():
+            if time.perf_counter() - start > limit:
+                raise RuntimeError('no player took over')
+            gevent.sleep(0.005)
+        return time.perf_counter() - start
+
+    def leader():
+        value = client.get(db._key('BENCH|leader'))
+        return value.split('|') if value else (None, None)
+
+    def skip_load():
+        while True:
+            db._player_command('skip')
+            gevent.sleep(args.skip_ms / 1000.0)
+
+    workers = [spawn(), spawn()]
+    load = gevent.spawn(skip_load)
+    takeovers = []
+    try:
+        for _ in range(args.kills):
+            wait_for(lambda: leader()[1] is not None
+                     and leader()[1] == client.get(db._key('MISC|player-epoch')))
+            gevent.sleep(0.5)
+            pid, token = leader()
+            os.kill(int(pid), signal.SIGKILL)
+            takeovers.append(wait_for(
+                lambda: int(client.get(db._key('MISC|player-epoch'))) > int(token)) * 1000.0)
+            workers = [w for w in workers if w.poll() is None] + [spawn()]
+    finally:
+        load.kill()
+        for w in workers:
+            w.kill()
+            w.wait()
+    plays = client.lrange(db._key('BENCH|plays'), 0, -1)
+    takeovers.sort()
+    print('%8s  %10s  %10s  %8s  %12s' % ('kills', 'p50 ms', 'max ms', 'plays', 'double plays'))
+    print('%8d  %10.0f  %10.0f  %8d  %12d' % (
+        len(takeovers), takeovers[len(takeovers) // 2], takeovers[-1],
+        len(plays), len(plays) - len(set(plays))))
+    clear_nest(client)
+
+
+def bench_scheduler(args):
+    """Idle nests: a player greenlet per nest vs one NestScheduler.
+
+    Every nest plays a 200 s song and nothing else happens; the window is
+    measured once all of them are playing.  Per-nest players get a
+    connection pool each, as DB(nest_id=...) does.  Leases lost counts
+    takeovers (player-epoch bumps) in the window, which only happen when a
+    renewal ran too late.  CPU is this process's, which includes fakeredis
+    unless --redis-url is given.
+    """
+    import gevent
+    from config import CONF
+    from nest_scheduler import NestScheduler
+    CONF.USE_BENDER = False
+    if args.lease_seconds:
+        CONF.PLAYER_LEASE_SECONDS = CONF.PLAYER_SCHEDULER_LEASE_SECONDS = args.lease_seconds
+    nest_ids = ['bench%d' % i for i in range(args.nests)]
+
+    def make_player_db(nest_id, client):
+        db = make_db(client, nest_id)
+        db.log_finished_song = lambda song: None
+        db.refresh_preview_card = lambda: None
+        db._ensure_preview_card = lambda: None
+        return db
+
+    def clear(client):
+        keys = list(client.scan_iter(match='NEST:bench*', count=1000))
+        for i in range(0, len(keys), 1000):
+            client.delete(*keys[i:i + 1000])
+
+    epoch_keys = ['NEST:%s|MISC|player-epoch' % nest_id for nest_id in nest_ids]
+
+    def epochs(client):
+        return sum(int(e or 0) for e in client.mget(epoch_keys))
+
+    print('%10s  %6s  %10s  %8s  %14s  %12s  %12s' % (
+        'model', 'nests', 'cpu s', 'cpu %', 'round trips/s', 'nest runs/s', 'leases lost'))
+    for model in ('greenlets', 'scheduler'):
+        # A fresh fakeredis each time: killing players mid-command can
+        # leave an in-process server's lock held
+        client = make_client(args)
+        clear(client)
+        for nest_id in nest_ids:
+            db = make_db(client, nest_id)
+            _fill_queue(db, 2)
+            for i in range(2):
+                db._r.hset(db._key('QUEUE|%d' % (i + 1)), 'user', 'the@echonest.com')
+        runs = [0]
+        if model == 'greenlets':
+            # As in production, each player DB has its own connection pool
+            dbs = [make_player_db(nest_id, another_client(args, client)) for nest_id in nest_ids]
+            for db in dbs:
+                wait_player_command = db._wait_player_command
+
+                def counted(timeout, wait_player_command=wait_player_command):
+                    runs[0] += 1
+                    return wait_player_command(timeout)
+                db._wait_player_command = counted
+            players = [gevent.spawn(db.master_player) for db in dbs]
+        else:
+            scheduler = NestScheduler(client, db_factory=lambda nest_id: make_player_db(nest_id, client))
+            players = [gevent.spawn(scheduler.run)]
+            scheduler.set_nests(nest_ids)
+        keys = ['NEST:%s|MISC|now-playing' % nest_id for nest_id in nest_ids]
+        try:
+            while not all(client.mget(keys)):
+                gevent.sleep(0.1)
+            gevent.sleep(1.0)
+            runs[0] = 0
+            steps = scheduler.steps if model == 'scheduler' else 0
+            taken = epochs(client)
+            cpu = time.process_time()
+            with RoundTripCounter() as trips:
+                gevent.sleep(args.seconds)
+            cpu = time.process_time() - cpu
+            lost = epochs(client) - taken
+            if model == 'scheduler':
+                runs[0] = scheduler.steps - steps
+        finally:
+            gevent.killall(players)
+        print('%10s  %6d  %10.2f  %8.1f  %14.0f  %12.1f  %12d' % (
+            model, len(nest_ids), cpu, cpu * 100.0 / args.seconds,
+            trips.count / args.seconds, runs[0] / args.seconds, lost))
+        if args.redis_url:
+            clear(client)
+
+
+# ── cleanup ───────────────────────────────────────────────────────────
+
+def _legacy_cleanup_sweep(client):
+    """The pre-index sweep: HGETALL and an SCARD per nest (list_nests), then
+    per nest SMEMBERS, a TTL per member, an SREM per stale member and a
+    ZCARD of the queue."""
+    nest_ids = list(client.hgetall('NESTS|registry'))
+    for nest_id in nest_ids:
+        client.scard('NEST:%s|MEMBERS' % nest_id)
+    counts = {}
+    for nest_id in nest_ids:
+        mkey = 'NEST:%s|MEMBERS' % nest_id
+        emails = client.smembers(mkey)
+        stale = [email for email in emails
+                 if client.ttl('NEST:%s|MEMBER:%s' % (nest_id, email)) <= 0]
+        for email in stale:
+            client.srem(mkey, email)
+        counts[nest_id] = (len(emails) - len(stale),
+                           client.zcard('NEST:%s|MISC|priority-queue' % nest_id))
+    return counts
+
+
+def bench_cleanup(args):
+    """One nest_cleanup_loop pass over N nests: per-member TTL keys vs the MEMBERS index.
+
+    Each nest has --members members, half of them with expired heartbeats,
+    and two queued songs.  Both sweeps start from the same state.
+    """
+    from nests import NestManager, refresh_member_ttl, sweep_nests
+
+    def index_sweep(manager):
+        return sweep_nests(manager._r, [nest_id for nest_id, _ in manager.list_nests()])
+
+    def clear(client):
+        keys = list(client.scan_iter(match='NEST:bench*', count=1000))
+        for i in range(0, len(keys), 1000):
+            client.delete(*keys[i:i + 1000])
+        client.hdel('NESTS|registry', *['bench%d' % n for n in range(args.nests)])
+
+    def setup(client, legacy):
+        clear(client)
+        manager = NestManager(redis_client=client)
+        for n in range(args.nests):
+            nest_id = 'bench%d' % n
+            client.hset('NESTS|registry', nest_id, json.dumps({'nest_id': nest_id, 'is_main': False}))
+            client.zadd('NEST:%s|MISC|priority-queue' % nest_id, {'1': 1, '2': 2})
+            for m in range(args.members):
+                email = 'user%d@example.com' % m
+                live = m % 2 == 0
+                if legacy:
+                    client.sadd('NEST:%s|MEMBERS' % nest_id, email)
+                    if live:
+                        client.setex('NEST:%s|MEMBER:%s' % (nest_id, email), 90, '1')
+                else:
+                    refresh_member_ttl(client, nest_id, email, 90 if live else -1)
+        return manager
+
+    print('%8s  %6s  %8s  %12s  %10s' % ('model', 'nests', 'members', 'round trips', 'sweep ms'))
+    results = {}
+    for model in ('ttl keys', 'index'):
+        client = make_client(args)
+        total_ms = 0.0
+        for _ in range(args.repeat):
+            manager = setup(client, model == 'ttl keys')
+            with RoundTripCounter() as trips:
+                start = time.perf_counter()
+                if model == 'ttl keys':
+                    counts = _legacy_cleanup_sweep(client)
+                else:
+                    counts = index_sweep(manager)
+                total_ms += (time.perf_counter() - start) * 1000.0
+        results[model] = {nest_id: c for nest_id, c in counts.items() if nest_id != 'main'}
+        print('%8s  %6d  %8d  %12d  %10.1f' % (
+            model, args.nests, args.members, trips.count, total_ms / args.repeat))
+        clear(client)
+    assert results['ttl keys'] == results['index']
+
+
+# ── hibernate ─────────────────────────────────────────────────────────
+
+def bench_hibernate(args):
+    """Listenerless nests: played as usual vs hibernating.
+
+    Every nest has two queued --song-seconds songs and no members; Bender
+    tops the queue up as songs end.  Spotify is stubbed: each
+    add_spotify_song() (a track lookup), refresh_preview_card() and
+    ensure_fill_songs() (recommendation fetches) counts as one call.  Nests are played by
+    master_player_tick_all and a NestScheduler, as in production.  CPU is
+    this process's, which includes fakeredis unless --redis-url is given.
+    """
+    import gevent
+    import master_player
+    from config import CONF
+    from nests import NestManager
+    from nest_scheduler import NestScheduler
+    CONF.USE_BENDER = True
+    fills = iter(range(10 ** 9))
+    counts = {'spotify': 0, 'frames': 0}
+
+    def make_player_db(nest_id, client):
+        db = make_db(client, nest_id)
+
+        def add_spotify_song(user, trackid, scrobble=True, **kwargs):
+            counts['spotify'] += 1
+            return db._add_song(user, {'src': 'spotify', 'trackid': trackid, 'title': 'Fill',
+                                       'artist': 'Bench', 'duration': args.song_seconds,
+                                       'auto': True}, False)
+
+        def refresh_preview_card():
+            counts['spotify'] += 1
+            db._r.set(db._key('MISC|preview-card'), '{}')
+
+        def ensure_fill_songs():
+            counts['spotify'] += 1
+
+        def msg(*a, **k):
+            counts['frames'] += 1
+
+        db.log_finished_song = lambda song: None
+        db.get_fill_song = lambda: ('the@echonest.com', 'spotify:track:fill%d' % next(fills))
+        db.add_spotify_song = add_spotify_song
+        db.refresh_preview_card = refresh_preview_card
+        db.ensure_fill_songs = ensure_fill_songs
+        db._msg = msg
+        return db
+
+    print('%12s  %6s  %14s  %12s  %8s  %14s' % (
+        'model', 'nests', 'spotify calls', 'pubs', 'cpu %', 'round trips/s'))
+    for model in ('awake', 'hibernating'):
+        CONF.NEST_HIBERNATION = model == 'hibernating'
+        client = make_client(args)
+        manager = NestManager(redis_client=client)
+        client.hdel('NESTS|registry', 'main')
+        nest_ids = []
+        for i in range(args.nests):
+            nest_id = manager.create_nest('bench@example.com')['nest_id']
+            db = make_db(client, nest_id)
+            for j in range(2):
+                db._add_song('bench@example.com', {
+                    'src': 'spotify', 'trackid': 'spotify:track:%d' % j, 'title': 'Song %d' % j,
+                    'artist': 'Bench', 'duration': args.song_seconds, 'auto': False}, False)
+            nest_ids.append(nest_id)
+        # What leave_nest() / nest_cleanup_loop do once the last member is gone
+        for nest_id in nest_ids:
+            manager.hibernate_nest(nest_id)
+
+        # As in production, each player DB has its own connection pool
+        scheduler = NestScheduler(client, db_factory=lambda nest_id: make_player_db(
+            nest_id, another_client(args, client)))
+        players = [gevent.spawn(scheduler.run),
+                   gevent.spawn(master_player.master_player_tick_all, manager,
+                                poll_interval=1, scheduler=scheduler)]
+        try:
+            gevent.sleep(1.0)
+            counts['spotify'] = counts['frames'] = 0
+            cpu = time.process_time()
+            with RoundTripCounter() as trips:
+                gevent.sleep(args.seconds)
+            cpu = time.process_time() - cpu
+        finally:
+            gevent.killall(players)
+        print('%12s  %6d  %14d  %12d  %8.1f  %14.0f' % (
+            model, len(nest_ids), counts['spotify'], counts['frames'],
+            cpu * 100.0 / args.seconds, trips.count / args.seconds))
+        if args.redis_url:
+            for nest_id in nest_ids:
+                manager.delete_nest(nest_id)
+
+
+# ── archive ───────────────────────────────────────────────────────────
+
+def _nest_redis_bytes(client, nest_id):
+    """Bytes a nest's keys hold in Redis: MEMORY USAGE if the server supports
+    it, else the length of their serialized contents."""
+    import nest_archive
+    prefix = 'NEST:%s|' % nest_id
+    keys = list(client.scan_iter(match=prefix + '*', count=500))
+    try:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key)
+        return sum(pipe.execute()), 'MEMORY USAGE'
+    except redis.exceptions.ResponseError:
+        entries = nest_archive.dump_keys(client, prefix)
+        return sum(len(key) + len(json.dumps(value)) for key, _, value, _ in entries), 'payload'
+
+
+def bench_archive(args):
+    """Cold nests: Redis memory released by archiving, and restore latency.
+
+    Every nest has --songs queued songs (each with a jam and a comment), a
+    Bender cache and the usual MISC keys, and is hibernating.  Each nest is
+    archived with NestManager.archive_nest() and brought back by
+    NestManager.get_nest(), as a /nest/<code> visit would, and its keys are
+    checked against what was there before.
+    """
+    import statistics
+    import tempfile
+    import nest_archive
+    from config import CONF
+    from nests import NestManager
+
+    client = make_client(args)
+    CONF.NEST_ARCHIVE_DIR = tempfile.mkdtemp(prefix='nest-archive-')
+    manager = NestManager(redis_client=client)
+    nests = []
+    for _ in range(args.nests):
+        nest = manager.create_nest('bench@example.com')
+        db = make_db(client, nest['nest_id'])
+        _fill_queue(db, args.songs)
+        client.rpush(db._key('MISC|bender-queue'),
+                     *['spotify:track:bender%d' % i for i in range(50)])
+        client.set(db._key('MISC|volume'), 40)
+        manager.hibernate_nest(nest['nest_id'])
+        nests.append(nest)
+
+    def dump(nest_id):
+        return sorted(entry[:3] for entry in nest_archive.dump_keys(client, 'NEST:%s|' % nest_id))
+
+    redis_bytes, file_bytes, archive_ms, restore_ms, keys = [], [], [], [], []
+    for nest in nests:
+        nest_id = nest['nest_id']
+        before = dump(nest_id)
+        size, measure = _nest_redis_bytes(client, nest_id)
+        redis_bytes.append(size)
+        keys.append(len(before))
+
+        start = time.perf_counter()
+        file_bytes.append(manager.archive_nest(nest_id))
+        archive_ms.append((time.perf_counter() - start) * 1000.0)
+        assert not list(client.scan_iter(match='NEST:%s|*' % nest_id))
+
+        start = time.perf_counter()
+        assert manager.get_nest(nest['code'])['nest_id'] == nest_id
+        restore_ms.append((time.perf_counter() - start) * 1000.0)
+        assert dump(nest_id) == before, 'nest %s restored differently' % nest_id
+
+    print('%d nests, %d songs and %d keys per nest (Redis bytes by %s)' % (
+        args.nests, args.songs, statistics.median(keys), measure))
+    print('  Redis bytes released:  %8d per nest' % statistics.mean(redis_bytes))
+    print('  archive file bytes:    %8d per nest' % statistics.mean(file_bytes))
+    print('  archive ms:            %8.2f p50  %8.2f max' % (
+        statistics.median(archive_ms), max(archive_ms)))
+    print('  restore ms:            %8.2f p50  %8.2f max' % (
+        statistics.median(restore_ms), max(restore_ms)))
+    for nest in nests:
+        manager.delete_nest(nest['nest_id'])
+    os.rmdir(CONF.NEST_ARCHIVE_DIR)
+
+
+# ── ranks ─────────────────────────────────────────────────────────────
+
+def _float_midpoint_votes(songs, moves):
+    """Replay *moves* with the old float-midpoint vote; return (ties, min gap)."""
+    queue = [(float(i + 1), str(i + 1)) for i in range(songs)]
+    ties = 0
+    for index, up in moves:
+        score, sid = queue[index]
+        rank = index
+        low_rank = rank - 2 if up else rank + 1
+        window = queue[max(low_rank, 0):low_rank + 2] if low_rank + 2 else queue[max(low_rank, 0):]
+        if not window:
+            continue
+        if len(window) == 1:
+            new = window[0][0] - 120.0 if low_rank == -1 else window[0][0] + 120.0
+        else:
+            new = (window[0][0] + window[1][0]) / 2
+        if new in [score for score, _ in window[:2]]:
+            ties += 1
+        del queue[rank]
+        queue.append((new, sid))
+        queue.sort()
+    gaps = [b[0] - a[0] for a, b in zip(queue, queue[1:])]
+    return ties, min(gaps)
+
+
+def bench_ranks(args):
+    """Random one-place votes on a full queue: integer gap ranks vs float midpoints."""
+    import random
+    client = make_client(args)
+    db = make_db(client)
+    db._max_queue_depth = lambda: 0
+    clear_nest(client)
+    song = dict(src='spotify', trackid='spotify:track:bench', title='Bench', artist='Bench',
+                duration=200, auto=False, img='', big_img='')
+    for i in range(args.songs):
+        db._add_song('user%d@example.com' % (i % 5), dict(song), False)
+    queue_key = db._key('MISC|priority-queue')
+
+    rng = random.Random(args.seed)
+    # hammer a handful of neighboring songs so their gaps actually shrink
+    hot = args.songs // 2
+    moves = [(rng.randrange(hot - 2, hot + 3), rng.random() < 0.5) for _ in range(args.votes)]
+    start = time.perf_counter()
+    for n, (index, up) in enumerate(moves):
+        sid = client.zrange(queue_key, index, index)[0]
+        db.vote('voter%d@example.com' % n, sid, up)
+    elapsed = time.perf_counter() - start
+
+    scores = [score for _, score in client.zrange(queue_key, 0, -1, withscores=True)]
+    gaps = [b - a for a, b in zip(scores, scores[1:])]
+    ties, float_gap = _float_midpoint_votes(args.songs, moves)
+    print('songs=%d votes=%d  %.0f votes/s' % (args.songs, args.votes, args.votes / elapsed))
+    print('gap ranks:      integers=%s distinct=%s min gap=%g renumbered=%s songs' % (
+        all(x == int(x) for x in scores), len(set(scores)) == len(scores), min(gaps),
+        client.get(db._key('MISC|queue-renumbers')) or 0))
+    print('float midpoint: ties=%d min gap=%g' % (ties, float_gap))
+    clear_nest(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', help='Real Redis to benchmark against (default: fakeredis)')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('snapshot', help='Queue read: per-song reads vs one Lua snapshot')
+    p.add_argument('--depths', default='10,25,50,100,250')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_snapshot)
+
+    p = sub.add_parser('expiry', help='Stale-entry purge: EXISTS per id vs expiry index')
+    p.add_argument('--depths', default='10,25,50,100,250')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_expiry)
+
+    p = sub.add_parser('payload', help='Memory per queued song: inline vs shared payload')
+    p.add_argument('--songs', type=int, default=100)
+    p.add_argument('--nests', type=int, default=3)
+    p.set_defaults(func=bench_payload)
+
+    p = sub.add_parser('add', help='Concurrent adds: WATCH/retry vs one Lua insert')
+    p.add_argument('--adders', default='1,10,50')
+    p.add_argument('--depth', type=int, default=50)
+    p.set_defaults(func=bench_add)
+
+    p = sub.add_parser('score', help='Add scoring: queue scan vs per-user indexes')
+    p.add_argument('--depths', default='100,1000,5000')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_score)
+
+    p = sub.add_parser('vote', help='Votes on one song: separate calls vs one Lua vote')
+    p.add_argument('--voters', default='1,10,50')
+    p.add_argument('--depth', type=int, default=50)
+    p.set_defaults(func=bench_vote)
+
+    p = sub.add_parser('ranks', help='Vote stress: integer gap ranks vs float midpoints')
+    p.add_argument('--songs', type=int, default=500)
+    p.add_argument('--votes', type=int, default=100000)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=bench_ranks)
+
+    p = sub.add_parser('jam', help='Room-wide jam: reread-and-toggle vs one Lua jam')
+    p.add_argument('--jammers', default='10,50,100')
+    p.set_defaults(func=bench_jam)
+
+    p = sub.add_parser('pop', help='Player pop: read/remove/reread vs one Lua pop')
+    p.add_argument('--depth', type=int, default=50)
+    p.add_argument('--players', type=int, default=2)
+    p.set_defaults(func=bench_pop)
+
+    p = sub.add_parser('skip', help='Skip latency: kill_playing() to next song in master_player')
+    p.add_argument('--skips', type=int, default=10)
+    p.set_defaults(func=bench_skip)
+
+    p = sub.add_parser('position', help='Position frames: per-second ticks vs throttled resync')
+    p.add_argument('--resync', default='1,5,15')
+    p.add_argument('--seconds', type=float, default=10.0)
+    p.set_defaults(func=bench_position)
+
+    p = sub.add_parser('transition', help='Gap between songs: lookahead off vs on')
+    p.add_argument('--songs', type=int, default=10)
+    p.add_argument('--spotify-ms', type=int, default=200)
+    p.set_defaults(func=bench_transition)
+
+    p = sub.add_parser('failover', help='Player takeover after SIGKILL of the leader, under skips')
+    p.add_argument('--kills', type=int, default=5)
+    p.add_argument('--skip-ms', type=int, default=100)
+    p.add_argument('--greenlets', action='store_true',
+                   help='Players run a greenlet per nest instead of the scheduler')
+    p.set_defaults(func=bench_failover)
+
+    p = sub.add_parser('scheduler', help='Idle nests: a player greenlet each vs one scheduler loop')
+    p.add_argument('--nests', type=int, default=1000)
+    p.add_argument('--seconds', type=float, default=10.0)
+    p.add_argument('--lease-seconds', type=float,
+                   help='Lease for both models (default: PLAYER_LEASE_SECONDS for greenlets, '
+                        'PLAYER_SCHEDULER_LEASE_SECONDS for the scheduler)')
+    p.set_defaults(func=bench_scheduler)
+
+    p = sub.add_parser('cleanup', help='Nest cleanup sweep: per-member TTL keys vs one sorted set per nest')
+    p.add_argument('--nests', type=int, default=500)
+    p.add_argument('--members', type=int, default=4)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_cleanup)
+
+    p = sub.add_parser('hibernate', help='Listenerless nests: played as usual vs hibernating')
+    p.add_argument('--nests', type=int, default=200)
+    p.add_argument('--seconds', type=float, default=20.0)
+    p.add_argument('--song-seconds', type=int, default=10)
+    p.set_defaults(func=bench_hibernate)
+
+    p = sub.add_parser('archive', help='Cold nests: Redis memory released by archiving, restore latency')
+    p.add_argument('--nests', type=int, default=50)
+    p.add_argument('--songs', type=int, default=25)
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser('player-worker', help='One player process for failover (internal)')
+    p.add_argument('--greenlets', action='store_true')
+    p.set_defaults(func=bench_player_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
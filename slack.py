@@ -111,10 +111,18 @@ def _artist_url(song):
     return ''
 
 
-def notify_now_playing(song):
-    """Post now-playing update with album art, title, artist, who added it."""
+def notify_now_playing(song, get_payload=None):
+    """Post now-playing update with album art, title, artist, who added it.
+
+    Queue entries don't carry the raw provider response; *get_payload*, if
+    given, is called for it (only when Slack is configured).
+    """
     if not song or not _get_url():
         return
+    if 'data' not in song and get_payload is not None:
+        payload = get_payload()
+        if payload:
+            song = dict(song, data=payload)
 
     title = song.get('title', 'Unknown')
     artist = song.get('artist', 'Unknown')
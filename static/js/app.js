@@ -133,6 +133,10 @@ _.extend(Socket.prototype, {
             }
         },
         onopen: function(ev){
+            var handlers = this.events['connect'] || [];
+            for(var i=0;i<handlers.length;++i){
+                handlers[i].apply(window, []);
+            }
             while(this.msg_queue.length > 0){
                 var args = this.msg_queue.shift();
                 this.emit.apply(this, args);
@@ -503,11 +507,76 @@ function update_playlist(data) {
     playlist.reset(data);
 }
 
-socket.on('playlist_update', function(data){
+// Incremental queue updates: the server sends playlist_diff events on top of
+// the last playlist_update/playlist_diff seq we saw. On a gap (or an op that
+// doesn't apply) we ask for a full snapshot instead.
+var _queueSeq = null;
+var _queueItems = [];
+
+function _queueItemKey(item) {
+    // The Bender preview card is the only item without an id
+    return item.id ? String(item.id) : '__preview__';
+}
+
+function apply_queue_diff(items, ops) {
+    var next = items.slice();
+    var indexOf = function(key) {
+        for (var i = 0; i < next.length; i++) {
+            if (_queueItemKey(next[i]) === key) {
+                return i;
+            }
+        }
+        return -1;
+    };
+    for (var i = 0; i < ops.length; i++) {
+        var op = ops[i];
+        var idx = op.op === 'insert' ? -1 : indexOf(op.id);
+        if (op.op !== 'insert' && idx < 0) {
+            return null;
+        }
+        if (op.op === 'remove') {
+            next.splice(idx, 1);
+        } else if (op.op === 'patch') {
+            next[idx] = _.extend({}, next[idx], op.fields);
+        } else if (op.op === 'insert') {
+            next.splice(op.index, 0, op.item);
+        } else if (op.op === 'move') {
+            next.splice(op.index, 0, next.splice(idx, 1)[0]);
+        } else {
+            return null;
+        }
+    }
+    return next;
+}
+
+socket.on('connect', function(){
+    // Per connection on the server side, so re-sent after every reconnect
+    socket.emit('enable_queue_diffs');
+});
+
+socket.on('playlist_update', function(data, seq){
     console.log("playlist_update", data);
+    _queueSeq = (seq === undefined) ? null : seq;
+    _queueItems = data;
     update_playlist(data);
 });
 
+socket.on('playlist_diff', function(diff){
+    var next = null;
+    if (_queueSeq !== null && diff.base === _queueSeq) {
+        next = apply_queue_diff(_queueItems, diff.ops);
+    }
+    if (next === null) {
+        console.log("playlist_diff gap, refetching", _queueSeq, diff.base);
+        _queueSeq = null;
+        socket.emit('fetch_playlist');
+        return;
+    }
+    _queueSeq = diff.seq;
+    _queueItems = next;
+    update_playlist(next);
+});
+
 function update_comments_for_song (songID, comments) {
   var songModel = playlist.get(songID);
   songModel.set('comments', comments);
@@ -840,25 +909,81 @@ function seconds_to_time(n){
 }
 
 remaining = 0;
-socket.on('player_position', function(src, track, pos){
+// Last position frame: the server only sends one on start, pause, resume
+// and every POSITION_RESYNC_SECONDS, so the progress bar interpolates.
+var position_anchor = null;
+// Local clock minus server clock (ms), one sample per recent frame
+var clock_samples = [];
+var CLOCK_SAMPLES = 8;
+
+// A frame left the server at started + pos (plus the fraction of a second
+// pos was floored by) and took a while to arrive, so every sample
+// overestimates the offset; the smallest recent one is the closest.
+function sample_clock(pos, started){
+    clock_samples.push(Date.now() - (started + pos) * 1000);
+    if (clock_samples.length > CLOCK_SAMPLES) {
+        clock_samples.shift();
+    }
+}
+
+function clock_offset(){
+    return Math.min.apply(null, clock_samples);
+}
+
+function show_position(pos){
     var current_duration = now_playing.get("duration");
 
     if (isNaN(pos) || isNaN(current_duration)) {
         return; // don't update
     }
-    
+    pos = Math.min(pos, current_duration);
+
     var progressW = $('#progress-wrapper').width() || $('#left').outerWidth();
     $('#playing-progress').css('width', Math.floor(progressW*pos/current_duration));
     $('#progress-wrapper').attr('title', seconds_to_time(pos)+"/"+seconds_to_time(current_duration))
 
     // update the time remaining; this will cause ETAs to be updated for the queue
     remaining = current_duration-pos;
+}
+
+function current_position(){
+    if (!position_anchor || position_anchor.track !== now_playing.get('trackid')) {
+        return now_playing.get('pos') || 0;
+    }
+    return anchored_position(position_anchor);
+}
+
+function anchored_position(anchor){
+    if (anchor.paused || playerpaused) {
+        return anchor.pos;
+    }
+    if (anchor.started != null) {
+        // Read off the server clock, so a frame that arrived late doesn't lag
+        return Math.max(Math.floor((Date.now() - clock_offset()) / 1000 - anchor.started), 0);
+    }
+    return anchor.pos + Math.floor((Date.now() - anchor.at) / 1000);
+}
+
+socket.on('player_position', function(src, track, pos, started, paused){
+    if (started != null) {
+        sample_clock(pos, started);
+    }
+    position_anchor = {track: track, pos: pos, at: Date.now(), started: started, paused: !!paused};
+    pos = anchored_position(position_anchor);
+    show_position(pos);
 
     if(is_player){
         fix_player(src, track, pos, playerpaused);
     }
 });
 
+setInterval(function(){
+    if (position_anchor && !position_anchor.paused && !playerpaused
+            && position_anchor.track === now_playing.get('trackid')) {
+        show_position(current_position());
+    }
+}, 1000);
+
 // Get current Spotify player state including volume
 function get_spotify_volume(callback) {
     if (!auth_token) {
@@ -1552,7 +1677,7 @@ function make_player(ev){
         // Start playing the current track immediately
         var src = now_playing.get('src');
         var trackid = now_playing.get('trackid');
-        var pos = now_playing.get('pos') || 0;
+        var pos = current_position();
         if (src && trackid) {
             fix_player(src, trackid, pos, playerpaused);
         }
@@ -2097,16 +2222,12 @@ window.addEventListener('load', function(){
     $('#search-results').on('click', '.add-all-header', function(ev) {
         ev.preventDefault();
         var src = $(this).attr('data-src');
+        // one bulk add: a single queue write and playlist_update
         if (src === 'youtube') {
             var ids = JSON.parse($(this).attr('data-ids'));
-            for (var i = 0; i < ids.length; i++) {
-                socket.emit('add_song', ids[i], 'youtube');
-            }
+            socket.emit('add_songs', ids.map(function(id) { return 'youtube:' + id; }));
         } else {
-            var uris = JSON.parse($(this).attr('data-uris'));
-            for (var i = 0; i < uris.length; i++) {
-                socket.emit('add_song', uris[i], 'spotify');
-            }
+            socket.emit('add_songs', JSON.parse($(this).attr('data-uris')));
         }
         $('#search-results > div').empty();
         $(window).scrollTop(0);
@@ -184,3 +184,21 @@ class TestAPIWithoutSpotify:
             pytest.skip(f'Cannot import config: {e}')
 
         assert 'ECHONEST_SPOTIFY_EMAIL' in ENV_OVERRIDES
+
+    def test_bulk_add_is_charged_per_song(self):
+        """Bulk adds draw on the same 50 songs/hour as single adds."""
+        try:
+            import fakeredis
+            import app as app_module
+        except Exception as e:
+            pytest.skip(f'Cannot import app: {e}')
+
+        r = fakeredis.FakeRedis(decode_responses=True)
+        for _ in range(40):
+            app_module._check_rate_limit(r, 'a@example.com', 'add_song', app_module.ADD_SONG_LIMIT)
+        assert app_module._bulk_add_allowance(r, 'a@example.com') == 10
+
+        app_module._charge_rate_limit(r, 'a@example.com', 'add_song', 10)
+        assert app_module._bulk_add_allowance(r, 'a@example.com') == 0
+        assert not app_module._check_rate_limit(r, 'a@example.com', 'add_song', app_module.ADD_SONG_LIMIT)
+        assert 0 < r.ttl('RATE|add_song|a@example.com') <= 3600
@@ -0,0 +1,148 @@
+"""Tests for driving nest players from one scheduler loop (nest_scheduler.py)."""
+import pytest
+
+from test_queue import _song_payload, _wait_for
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    try:
+        import fakeredis
+    except ImportError:
+        pytest.skip("fakeredis not installed")
+    import gevent
+    from config import CONF
+    from db import DB
+    from nest_scheduler import NestScheduler
+
+    monkeypatch.setattr(CONF, 'USE_BENDER', False, raising=False)
+    monkeypatch.setattr(CONF, 'PLAYER_SCHEDULER_LEASE_SECONDS', 0.3, raising=False)
+    fake_r = fakeredis.FakeRedis(decode_responses=True)
+    dbs = {}
+
+    def make_db(nest_id):
+        d = DB(nest_id=nest_id, init_history_to_redis=False, redis_client=fake_r)
+        d._msg = lambda *args, **kwargs: None
+        d.log_finished_song = lambda song: None
+        d.refresh_preview_card = lambda: None
+        d._ensure_preview_card = lambda: None
+        dbs[nest_id] = d
+        return d
+
+    for nid in ('n1', 'n2', 'n3'):
+        d = make_db(nid)
+        for i in range(3):
+            d._add_song('the@echonest.com', _song_payload(i, auto=True), False)
+
+    s = NestScheduler(fake_r, owner='w1', db_factory=make_db)
+    runner = gevent.spawn(s.run)
+    s.set_nests(['n1', 'n2', 'n3'])
+    _wait_for(lambda: all(fake_r.get('NEST:%s|MISC|now-playing' % nid) for nid in dbs))
+    yield s, dbs, fake_r
+    runner.kill()
+
+
+class TestNestScheduler:
+    def test_plays_every_nest(self, scheduler):
+        s, dbs, fake_r = scheduler
+        for nid in dbs:
+            assert fake_r.get('NEST:%s|MISC|master-player' % nid).startswith('w1|')
+
+    def test_command_wakes_only_its_nest(self, scheduler):
+        import gevent
+        s, dbs, fake_r = scheduler
+        playing = {nid: fake_r.get('NEST:%s|MISC|now-playing' % nid) for nid in dbs}
+        gevent.sleep(0.4)  # let the listener pick up every held nest
+        dbs['n2'].kill_playing('a@example.com')
+        _wait_for(lambda: fake_r.get('NEST:n2|MISC|now-playing') != playing['n2'], limit=1.5)
+        assert fake_r.get('NEST:n1|MISC|now-playing') == playing['n1']
+        assert fake_r.get('NEST:n3|MISC|now-playing') == playing['n3']
+
+    def test_idle_nests_are_not_stepped(self, scheduler):
+        import gevent
+        s, dbs, fake_r = scheduler
+        gevent.sleep(0.2)
+        steps = s.steps
+        gevent.sleep(1.0)
+        # 60 s songs, 15 s resync: nothing is due, leases renew in one call
+        assert s.steps == steps
+        for nid in dbs:
+            assert fake_r.get('NEST:%s|MISC|player-epoch' % nid) == '1'
+
+    def test_pause_and_unpause(self, scheduler):
+        import gevent
+        s, dbs, fake_r = scheduler
+        gevent.sleep(0.4)
+        frames = []
+        dbs['n1']._msg = lambda msg: frames.append(msg) if msg.startswith('pp|') else None
+        dbs['n1'].pause('a@example.com')
+        _wait_for(lambda: frames and frames[-1].endswith('|1'), limit=1.5)
+        dbs['n1'].unpause('a@example.com')
+        _wait_for(lambda: frames[-1].endswith('|0'), limit=1.5)
+
+    def test_dropped_nest_releases_its_lease(self, scheduler):
+        s, dbs, fake_r = scheduler
+        s.set_nests(['n1', 'n2'])
+        assert fake_r.get('NEST:n3|MISC|master-player') is None
+        assert dbs['n3']._fence is None
+
+    def test_lost_lease_stands_by(self, scheduler):
+        import gevent
+        s, dbs, fake_r = scheduler
+        fake_r.set('NEST:n1|MISC|master-player', 'elsewhere|2', px=5000)
+        fake_r.set('NEST:n1|MISC|player-epoch', 2)
+        gevent.sleep(0.3)
+        queued = fake_r.zcard('NEST:n1|MISC|priority-queue')
+        dbs['n1']._player_command('skip')
+        gevent.sleep(0.3)
+        # The command is left for the new holder and nothing is popped
+        assert fake_r.lrange('NEST:n1|MISC|player-control', 0, -1) == ['skip']
+        assert fake_r.zcard('NEST:n1|MISC|priority-queue') == queued
+
+    def test_lapsed_lease_is_taken_back(self, scheduler):
+        import gevent
+        s, dbs, fake_r = scheduler
+        lease = fake_r.get('NEST:n1|MISC|master-player')
+        # As if a renewal ran late: the key expired but nobody took over
+        fake_r.delete('NEST:n1|MISC|master-player')
+        gevent.sleep(0.3)
+        assert fake_r.get('NEST:n1|MISC|master-player') == lease
+        assert fake_r.get('NEST:n1|MISC|player-epoch') == '1'
+
+
+def test_hibernating_nest_is_parked_and_resumed(scheduler):
+    import gevent
+    import master_player
+    from nests import NestManager
+    s, dbs, fake_r = scheduler
+    manager = NestManager(redis_client=fake_r)
+    fake_r.hdel('NESTS|registry', 'main')
+    for nid in dbs:
+        fake_r.hset('NESTS|registry', nid, '{"nest_id": "%s"}' % nid)
+    supervisor = gevent.spawn(master_player.master_player_tick_all, manager,
+                              poll_interval=0.1, scheduler=s)
+    try:
+        gevent.sleep(0.3)
+        frames = []
+        dbs['n2']._msg = frames.append
+        playing = fake_r.get('NEST:n2|MISC|now-playing')
+        queued = fake_r.zrange('NEST:n2|MISC|priority-queue', 0, -1)
+
+        assert manager.hibernate_nest('n2')
+        _wait_for(lambda: fake_r.get('NEST:n2|MISC|master-player') is None, limit=1.5)
+        del frames[:]
+        gevent.sleep(0.5)
+        # Parked: not scheduled, nothing published, the other nests play on
+        assert 'n2' not in s._nests
+        assert frames == []
+        assert fake_r.get('NEST:n1|MISC|master-player').startswith('w1|')
+
+        manager.join_nest('n2', 'a@example.com')
+        _wait_for(lambda: fake_r.get('NEST:n2|MISC|master-player'), limit=1.5)
+        _wait_for(lambda: dbs['n2']._song is not None, limit=1.5)
+        # The song that was playing carries on; the queue is as it was
+        assert dbs['n2']._song['id'] == playing
+        assert fake_r.get('NEST:n2|MISC|now-playing') == playing
+        assert fake_r.zrange('NEST:n2|MISC|priority-queue', 0, -1) == queued
+    finally:
+        supervisor.kill()
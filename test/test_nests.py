@@ -849,12 +849,12 @@ class TestNestManagerCRUD:
 
         # Join
         manager.join_nest(code, "user1@example.com")
-        members = fake_r.smembers(nests.members_key(code))
+        members = fake_r.zrange(nests.members_key(code), 0, -1)
         assert "user1@example.com" in members
 
         # Leave
         manager.leave_nest(code, "user1@example.com")
-        members = fake_r.smembers(nests.members_key(code))
+        members = fake_r.zrange(nests.members_key(code), 0, -1)
         assert "user1@example.com" not in members
 
     def test_generate_code_uniqueness(self):
@@ -891,19 +891,17 @@ class TestCountActiveMembers:
         nest = manager.create_nest("host@example.com")
         nid = nest["code"]
 
-        # Add two members to the set
+        # Two members; stale@example.com's heartbeat expired a second ago
         manager.join_nest(nid, "active@example.com")
         manager.join_nest(nid, "stale@example.com")
+        nests.refresh_member_ttl(fake_r, nid, "stale@example.com", ttl_seconds=-1)
 
-        # Set heartbeat TTL for active member only
-        nests.refresh_member_ttl(fake_r, nid, "active@example.com")
-        # stale@example.com has no TTL key (simulates expired heartbeat)
-
+        assert nests.active_member_count(fake_r, nid) == 1
         count = nests.count_active_members(fake_r, nid)
         assert count == 1
 
         # Stale member should have been pruned from the MEMBERS set
-        members = fake_r.smembers(nests.members_key(nid))
+        members = fake_r.zrange(nests.members_key(nid), 0, -1)
         assert "active@example.com" in members
         assert "stale@example.com" not in members
 
@@ -941,6 +939,354 @@ class TestCountActiveMembers:
         count = nests.count_active_members(fake_r, nest["code"])
         assert count == 0
 
+    def test_sweep_nests(self):
+        nests = importlib.import_module("nests")
+        try:
+            import fakeredis
+        except ImportError:
+            pytest.skip("fakeredis not installed")
+
+        fake_r = fakeredis.FakeRedis(decode_responses=True)
+        manager = nests.NestManager(redis_client=fake_r)
+        a = manager.create_nest("host@example.com")["code"]
+        b = manager.create_nest("host@example.com")["code"]
+        manager.join_nest(a, "a@example.com")
+        nests.refresh_member_ttl(fake_r, b, "b@example.com", ttl_seconds=-1)
+        fake_r.zadd(f"NEST:{b}|MISC|priority-queue", {"song1": 1, "song2": 2})
+
+        assert nests.sweep_nests(fake_r, [a, b]) == {a: (1, 0), b: (0, 2)}
+        assert fake_r.zcard(nests.members_key(b)) == 0
+        counts = {nid: meta["member_count"] for nid, meta in manager.list_nests()}
+        assert counts[a] == 1 and counts[b] == 0
+
+    def test_migrate_legacy_members_set(self):
+        nests = importlib.import_module("nests")
+        try:
+            import fakeredis
+        except ImportError:
+            pytest.skip("fakeredis not installed")
+        import migrate_members_index
+
+        fake_r = fakeredis.FakeRedis(decode_responses=True)
+        mkey = nests.members_key("X7K2P")
+        fake_r.sadd(mkey, "live@example.com", "gone@example.com")
+        fake_r.setex(nests.member_key("X7K2P", "live@example.com"), 60, "1")
+
+        dry = migrate_members_index.migrate(redis_client=fake_r, dry_run=True)
+        assert (dry["converted"], dry["members"], dry["stale"]) == (1, 1, 1)
+        assert fake_r.type(mkey) == "set"
+
+        migrate_members_index.migrate(redis_client=fake_r, dry_run=False)
+        assert fake_r.zrange(mkey, 0, -1) == ["live@example.com"]
+        assert fake_r.keys("NEST:X7K2P|MEMBER:*") == []
+        assert nests.active_member_count(fake_r, "X7K2P") == 1
+        assert migrate_members_index.migrate(redis_client=fake_r, dry_run=True)["converted"] == 0
+
+
+def _run_cleanup_once(manager, monkeypatch):
+    """Run one pass of master_player.nest_cleanup_loop against *manager*."""
+    import types
+    master_player = importlib.import_module("master_player")
+
+    class Done(Exception):
+        pass
+
+    def stop(seconds):
+        raise Done
+
+    monkeypatch.setattr(master_player, "time", types.SimpleNamespace(sleep=stop))
+    with pytest.raises(Done):
+        master_player.nest_cleanup_loop(manager)
+
+
+class TestHibernation:
+    """Nests with no listeners hibernate; the first join wakes them."""
+
+    @pytest.fixture
+    def manager(self):
+        try:
+            import fakeredis
+        except ImportError:
+            pytest.skip("fakeredis not installed")
+        from nests import NestManager
+        return NestManager(redis_client=fakeredis.FakeRedis(decode_responses=True))
+
+    def test_last_leave_hibernates_and_join_resumes(self, manager):
+        code = manager.create_nest("host@example.com")["code"]
+        manager.join_nest(code, "a@example.com")
+        manager.join_nest(code, "b@example.com")
+
+        manager.leave_nest(code, "a@example.com")
+        assert manager.hibernating_nests() == set()
+        manager.leave_nest(code, "b@example.com")
+        assert manager.hibernating_nests() == {code}
+
+        manager.join_nest(code, "a@example.com")
+        assert manager.hibernating_nests() == set()
+
+    def test_one_tab_leaving_does_not_freeze_the_nest(self, manager, monkeypatch):
+        from nests import refresh_member_ttl
+        code = manager.create_nest("host@example.com")["code"]
+        # Two tabs for the same member; closing one empties MEMBERS
+        manager.join_nest(code, "a@example.com")
+        manager.join_nest(code, "a@example.com")
+        manager.leave_nest(code, "a@example.com")
+        assert manager.hibernating_nests() == {code}
+
+        # The open tab's next heartbeat wakes it
+        manager.heartbeat(code, "a@example.com")
+        assert manager.hibernating_nests() == set()
+
+        # A heartbeat that only refreshes the member is caught by cleanup
+        manager.leave_nest(code, "a@example.com")
+        refresh_member_ttl(manager._r, code, "a@example.com")
+        assert manager.hibernating_nests() == {code}
+        _run_cleanup_once(manager, monkeypatch)
+        assert manager.hibernating_nests() == set()
+        assert manager.get_nest(code) is not None
+
+    def test_main_and_listened_nests_stay_awake(self, manager, monkeypatch):
+        from config import CONF
+        code = manager.create_nest("host@example.com")["code"]
+        manager.join_nest(code, "a@example.com")
+        assert not manager.hibernate_nest(code)
+        assert not manager.hibernate_nest("main")
+        other = manager.create_nest("host@example.com")["code"]
+        monkeypatch.setattr(CONF, 'NEST_HIBERNATION', False, raising=False)
+        assert not manager.hibernate_nest(other)
+        assert manager.hibernating_nests() == set()
+
+    def test_playing_song_keeps_its_place(self, manager):
+        import datetime
+        import time
+        from db import DB, epoch_dump
+        r = manager._r
+        code = manager.create_nest("host@example.com")["code"]
+        d = DB(nest_id=code, init_history_to_redis=False, redis_client=r)
+        d._start_clock()
+        r.set(d._key('MISC|current-done'),
+              epoch_dump(d.player_now() + datetime.timedelta(seconds=30)), ex=30)
+
+        assert manager.hibernate_nest(code)
+        assert r.ttl(d._key('MISC|current-done')) == -1
+        # As if it had hibernated 100 s ago with 30 s of the song left
+        r.hset(d._key('MISC|clock'), 'paused-since', time.time() - 100)
+        r.set(d._key('MISC|current-done'),
+              epoch_dump(d.player_now() + datetime.timedelta(seconds=30)))
+        assert abs(d.player_now().timestamp() - (time.time() - 100)) < 2
+
+        assert manager.resume_nest(code)
+        assert not manager.resume_nest(code)
+        assert 28 <= r.ttl(d._key('MISC|current-done')) <= 30
+        assert abs(d.player_now().timestamp() - (time.time() - 100)) < 2
+
+    def test_delete_forgets_hibernation(self, manager):
+        code = manager.create_nest("host@example.com")["code"]
+        assert manager.hibernate_nest(code)
+        manager.delete_nest(code)
+        assert manager.hibernating_nests() == set()
+
+
+class TestArchival:
+    """Hibernating nests move to a file on disk and come back on access."""
+
+    @pytest.fixture
+    def manager(self, tmp_path, monkeypatch):
+        try:
+            import fakeredis
+        except ImportError:
+            pytest.skip("fakeredis not installed")
+        from config import CONF
+        from nests import NestManager
+        monkeypatch.setattr(CONF, 'NEST_ARCHIVE_DIR', str(tmp_path), raising=False)
+        return NestManager(redis_client=fakeredis.FakeRedis(decode_responses=True))
+
+    def _fill(self, r, code):
+        r.hset("NEST:%s|QUEUE|a" % code, mapping={"title": "Song A", "vote": "2"})
+        r.expire("NEST:%s|QUEUE|a" % code, 600)
+        r.zadd("NEST:%s|MISC|priority-queue" % code, {"a": 1.5})
+        r.rpush("NEST:%s|MISC|bender-queue" % code, "x", "y", "x")
+        r.sadd("NEST:%s|MISC|banned" % code, "u1", "u2")
+        r.set("NEST:%s|MISC|volume" % code, "40")
+
+    def _dump(self, r, code):
+        import nest_archive
+        # Without expiry times, which are only exact to the millisecond
+        return sorted(entry[:3] for entry in nest_archive.dump_keys(r, "NEST:%s|" % code))
+
+    def test_archive_and_restore_on_get(self, manager, tmp_path):
+        import nest_archive
+        r = manager._r
+        nest = manager.create_nest("host@example.com")
+        code = nest["code"]
+        self._fill(r, code)
+        assert manager.hibernate_nest(code)
+        before = self._dump(r, code)
+
+        assert manager.archive_nest(code) > 0
+        assert r.keys("NEST:%s|*" % code) == []
+        assert os.path.exists(nest_archive.archive_path(code))
+        assert manager.list_nests()[-1][1]["archived"]["keys"] == len(before)
+        assert manager.archive_nest(code) is None
+
+        meta = manager.get_nest(code)
+        assert "archived" not in meta
+        assert self._dump(r, code) == before
+        assert 590 <= r.ttl("NEST:%s|QUEUE|a" % code) <= 600
+        assert list(tmp_path.iterdir()) == []
+        # Still parked until somebody joins
+        assert manager.hibernating_nests() == {code}
+
+    def test_join_restores(self, manager):
+        r = manager._r
+        code = manager.create_nest("host@example.com")["code"]
+        self._fill(r, code)
+        manager.hibernate_nest(code)
+        manager.archive_nest(code)
+
+        manager.join_nest(code, "a@example.com")
+        assert r.get("NEST:%s|MISC|volume" % code) == "40"
+        assert r.zrange("NEST:%s|MEMBERS" % code, 0, -1) == ["a@example.com"]
+        assert manager.hibernating_nests() == set()
+
+    def test_only_hibernating_nests_are_archived(self, manager):
+        code = manager.create_nest("host@example.com")["code"]
+        assert manager.archive_nest(code) is None
+        assert manager.archive_nest("main") is None
+        manager.join_nest(code, "a@example.com")
+        # Registered as hibernating, but someone is listening
+        manager._r.sadd("NESTS|hibernating", code)
+        assert manager.archive_nest(code) is None
+        assert manager._r.get("NEST:%s|DELETING" % code) is None
+
+    def test_delete_removes_archive(self, manager, tmp_path):
+        code = manager.create_nest("host@example.com")["code"]
+        self._fill(manager._r, code)
+        manager.hibernate_nest(code)
+        manager.archive_nest(code)
+        manager.delete_nest(code)
+        assert list(tmp_path.iterdir()) == []
+        assert manager.get_nest(code) is None
+
+    def test_unreadable_archive_restores_empty(self, manager):
+        import nest_archive
+        code = manager.create_nest("host@example.com")["code"]
+        self._fill(manager._r, code)
+        manager.hibernate_nest(code)
+        manager.archive_nest(code)
+        with open(nest_archive.archive_path(code), "wb") as f:
+            f.write(b"not an archive")
+        assert manager.get_nest(code)["code"] == code
+        assert manager._r.keys("NEST:%s|*" % code) == []
+
+    def _backdate(self, manager, code, minutes, **fields):
+        import json
+        meta = json.loads(manager._r.hget("NESTS|registry", code))
+        then = (datetime.datetime.now() - datetime.timedelta(minutes=minutes)).isoformat()
+        meta["last_activity"] = meta["hibernated_at"] = then
+        meta.update(fields)
+        manager._r.hset("NESTS|registry", code, json.dumps(meta))
+
+    def _meta(self, manager, code):
+        return dict(manager.list_nests())[code]
+
+    def test_cleanup_archives_expired_nest_then_deletes_it(self, manager, monkeypatch):
+        import json
+        import nest_archive
+        r = manager._r
+        code = manager.create_nest("host@example.com")["code"]
+        self._fill(r, code)
+        manager.join_nest(code, "a@example.com")
+        manager.leave_nest(code, "a@example.com")
+
+        # Within its TTL (NEST_MAX_INACTIVE_MINUTES) it stays in Redis
+        self._backdate(manager, code, 3)
+        _run_cleanup_once(manager, monkeypatch)
+        assert r.get("NEST:%s|MISC|volume" % code) == "40"
+
+        # Past it, it is archived instead of deleted
+        self._backdate(manager, code, 6)
+        _run_cleanup_once(manager, monkeypatch)
+        assert self._meta(manager, code)["archived"]
+        assert r.get("NEST:%s|MISC|volume" % code) is None
+        _run_cleanup_once(manager, monkeypatch)
+        assert os.path.exists(nest_archive.archive_path(code))
+
+        # A visit restores it and its TTL starts over
+        assert manager.get_nest(code) is not None
+        _run_cleanup_once(manager, monkeypatch)
+        assert "archived" not in self._meta(manager, code)
+        assert r.get("NEST:%s|MISC|volume" % code) == "40"
+
+        # Once the archive's retention runs out the nest is deleted
+        self._backdate(manager, code, 6)
+        _run_cleanup_once(manager, monkeypatch)
+        meta = self._meta(manager, code)
+        meta["archived"]["archived_at"] = (
+            datetime.datetime.now() - datetime.timedelta(days=8)).isoformat()
+        r.hset("NESTS|registry", code, json.dumps(meta))
+        _run_cleanup_once(manager, monkeypatch)
+        assert manager.get_nest(code) is None
+        assert manager.hibernating_nests() == set()
+        assert not os.path.exists(nest_archive.archive_path(code))
+
+    def test_long_lived_nest_archives_after_hibernating(self, manager, monkeypatch):
+        r = manager._r
+        code = manager.create_nest("host@example.com")["code"]
+        self._fill(r, code)
+        manager.join_nest(code, "a@example.com")
+        manager.leave_nest(code, "a@example.com")
+        assert "hibernated_at" in self._meta(manager, code)
+
+        self._backdate(manager, code, 30, ttl_minutes=24 * 60)
+        _run_cleanup_once(manager, monkeypatch)
+        assert r.get("NEST:%s|MISC|volume" % code) == "40"
+
+        self._backdate(manager, code, 61)
+        _run_cleanup_once(manager, monkeypatch)
+        assert self._meta(manager, code)["archived"]
+
+        # Joining resumes it and clears the hibernation time
+        manager.join_nest(code, "a@example.com")
+        assert "hibernated_at" not in self._meta(manager, code)
+
+    @pytest.mark.parametrize("setting", ["NEST_ARCHIVE_AFTER_MINUTES", "NEST_ARCHIVE_RETENTION_DAYS"])
+    def test_cleanup_deletes_at_ttl_when_archival_is_off(self, manager, monkeypatch, setting):
+        from config import CONF
+        monkeypatch.setattr(CONF, setting, 0, raising=False)
+        code = manager.create_nest("host@example.com")["code"]
+        assert manager.hibernate_nest(code)
+        self._backdate(manager, code, 6)
+        _run_cleanup_once(manager, monkeypatch)
+        assert manager.get_nest(code) is None
+
+    def test_should_drop_archive(self, monkeypatch):
+        from config import CONF
+        from nests import should_drop_archive
+        now = datetime.datetime.now()
+        week = {"archived": {"archived_at": (now - datetime.timedelta(days=7)).isoformat()}}
+        day = {"archived": {"archived_at": (now - datetime.timedelta(days=1)).isoformat()}}
+        assert should_drop_archive(week, now)
+        assert not should_drop_archive(day, now)
+        assert not should_drop_archive({}, now)
+        monkeypatch.setattr(CONF, 'NEST_ARCHIVE_RETENTION_DAYS', 30, raising=False)
+        assert not should_drop_archive(week, now)
+
+    def test_should_archive_nest(self, monkeypatch):
+        from config import CONF
+        from nests import should_archive_nest
+        now = datetime.datetime.now()
+        old = (now - datetime.timedelta(hours=2)).isoformat()
+        assert should_archive_nest({"last_activity": old}, now)
+        assert not should_archive_nest({"last_activity": now.isoformat()}, now)
+        assert not should_archive_nest({"last_activity": old, "is_main": True}, now)
+        assert not should_archive_nest({"last_activity": old, "archived": {"keys": 1}}, now)
+        # Measured from when it went into hibernation, if known
+        assert not should_archive_nest({"last_activity": old, "hibernated_at": now.isoformat()}, now)
+        assert should_archive_nest({"last_activity": now.isoformat(), "hibernated_at": old}, now)
+        monkeypatch.setattr(CONF, 'NEST_ARCHIVE_AFTER_MINUTES', 0, raising=False)
+        assert not should_archive_nest({"last_activity": old}, now)
+
 
 class TestDeleteNestMainGuard:
     def test_delete_main_is_noop(self):
@@ -0,0 +1,225 @@
+"""Tests for sharding nest players across workers (player_pool.py)."""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def fake_r():
+    try:
+        import fakeredis
+    except ImportError:
+        pytest.skip("fakeredis not installed")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+class TestHashRing:
+    def test_assignment_is_deterministic(self):
+        from player_pool import HashRing
+        a = HashRing(['w1', 'w2', 'w3'])
+        b = HashRing(['w3', 'w1', 'w2'])
+        nests = ['nest%d' % i for i in range(200)]
+        assert [a.owner(n) for n in nests] == [b.owner(n) for n in nests]
+        assert HashRing([]).owner('main') is None
+
+    def test_nests_spread_over_workers(self):
+        from player_pool import HashRing
+        ring = HashRing(['w1', 'w2', 'w3'])
+        counts = {}
+        for i in range(600):
+            owner = ring.owner('nest%d' % i)
+            counts[owner] = counts.get(owner, 0) + 1
+        assert set(counts) == {'w1', 'w2', 'w3'}
+        assert min(counts.values()) > 100
+
+    def test_losing_a_worker_only_moves_its_nests(self):
+        from player_pool import HashRing
+        before = HashRing(['w1', 'w2', 'w3'])
+        after = HashRing(['w1', 'w3'])
+        for i in range(300):
+            nid = 'nest%d' % i
+            if before.owner(nid) != 'w2':
+                assert after.owner(nid) == before.owner(nid)
+
+
+class TestPlayerWorker:
+    def test_workers_split_the_nests(self, fake_r):
+        from player_pool import PlayerWorker
+        w1 = PlayerWorker(fake_r, worker_id='w1')
+        w2 = PlayerWorker(fake_r, worker_id='w2')
+        w1.beat()
+        assert sorted(w2.beat()) == ['w1', 'w2']
+        w1.beat()
+        nests = {'nest%d' % i for i in range(50)}
+        mine, theirs = w1.owned(nests), w2.owned(nests)
+        assert mine and theirs
+        assert mine | theirs == nests
+        assert not mine & theirs
+
+    def test_silent_worker_is_dropped(self, fake_r):
+        from player_pool import PlayerWorker, WORKERS_KEY
+        w1 = PlayerWorker(fake_r, worker_id='w1', timeout=3)
+        fake_r.zadd(WORKERS_KEY, {'w2': time.time() - 10})
+        assert w1.beat() == ['w1']
+        assert w1.owned({'a', 'b', 'c'}) == {'a', 'b', 'c'}
+        assert fake_r.zrange(WORKERS_KEY, 0, -1) == ['w1']
+
+    def test_leave(self, fake_r):
+        from player_pool import PlayerWorker
+        w1 = PlayerWorker(fake_r, worker_id='w1')
+        w2 = PlayerWorker(fake_r, worker_id='w2')
+        w1.beat()
+        w2.beat()
+        w2.leave()
+        assert w1.beat() == ['w1']
+
+
+class TestPlayerAssignments:
+    def test_reports_owner_and_lease_holder(self, fake_r):
+        from player_pool import PlayerWorker, player_assignments
+        w1 = PlayerWorker(fake_r, worker_id='host:1:aaa')
+        w1.beat()
+        fake_r.set('NEST:main|MISC|master-player', 'host:1:aaa|4')
+
+        view = player_assignments(fake_r, ['main', 'XYZ12'])
+
+        assert [w['worker_id'] for w in view['workers']] == ['host:1:aaa']
+        assert view['workers'][0]['nests'] == ['XYZ12', 'main']
+        assert view['nests'] == [
+            {'nest_id': 'XYZ12', 'assigned': 'host:1:aaa', 'playing': None, 'token': None},
+            {'nest_id': 'main', 'assigned': 'host:1:aaa', 'playing': 'host:1:aaa', 'token': 4},
+        ]
+
+
+# One master_player.py worker against the fake Redis server on argv[1]
+_WORKER = r'''
+import sys
+from config import CONF
+CONF.USE_BENDER = False
+CONF.PLAYER_LEASE_SECONDS = 0.3
+CONF.PLAYER_WORKER_HEARTBEAT_SECONDS = 0.2
+CONF.PLAYER_WORKER_TIMEOUT_SECONDS = 0.6
+import gevent
+import redis
+import master_player
+from db import DB
+from nest_scheduler import NestScheduler
+from nests import NestManager
+from player_pool import PlayerWorker
+
+client = redis.StrictRedis(port=int(sys.argv[1]), decode_responses=True)
+for name in ('log_finished_song', 'refresh_preview_card', '_ensure_preview_card',
+             'prepare_next', '_msg'):
+    setattr(DB, name, lambda self, *args, **kwargs: None)
+
+def make_db(nest_id):
+    return DB(nest_id=nest_id, init_history_to_redis=False, redis_client=client)
+
+def run(nest_id, owner=None):
+    make_db(nest_id).master_player(owner)
+
+master_player._run_nest_player = run
+scheduler = None
+if sys.argv[3] == 'scheduler':
+    scheduler = NestScheduler(client, owner=sys.argv[2], db_factory=make_db)
+    gevent.spawn(scheduler.run)
+master_player.master_player_tick_all(
+    NestManager(redis_client=client), poll_interval=0.2,
+    worker=PlayerWorker(client, worker_id=sys.argv[2]), scheduler=scheduler)
+'''
+
+_SERVER = r'''
+import sys
+from fakeredis import TcpFakeServer
+TcpFakeServer(('127.0.0.1', int(sys.argv[1])), server_type='redis').serve_forever()
+'''
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_until(check, limit):
+    deadline = time.monotonic() + limit
+    while not check():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+class TestWorkerFailover:
+    """Killing a worker process hands its nests to the survivors."""
+
+    @pytest.mark.parametrize('mode', ['greenlets', 'scheduler'])
+    def test_killed_workers_nests_resume(self, mode):
+        pytest.importorskip('fakeredis')
+        import redis
+        from db import DB
+        from nests import NestManager
+        from player_pool import player_assignments
+        from test_queue import _song_payload
+
+        port = _free_port()
+        env = dict(os.environ, SKIP_SPOTIFY_PREFETCH='1', PYTHONPATH=REPO)
+        procs = [subprocess.Popen([sys.executable, '-c', _SERVER, str(port)], cwd=REPO, env=env)]
+        try:
+            client = redis.StrictRedis(port=port, decode_responses=True)
+            _wait_until(lambda: _ping(client), 5)
+
+            nm = NestManager(redis_client=client)
+            nest_ids = ['main'] + [nm.create_nest('a@example.com', name='Nest %d' % i)['nest_id']
+                                   for i in range(5)]
+            for nid in nest_ids:
+                d = DB(nest_id=nid, init_history_to_redis=False, redis_client=client)
+                for i in range(3):
+                    d._add_song('a@example.com', _song_payload(i), False)
+
+            workers = {}
+            for name in ('w1', 'w2', 'w3'):
+                workers[name] = subprocess.Popen(
+                    [sys.executable, '-c', _WORKER, str(port), name, mode], cwd=REPO, env=env)
+                procs.append(workers[name])
+
+            def settled(live):
+                view = player_assignments(client, nest_ids, timeout=0.6)
+                return ({w['worker_id'] for w in view['workers']} == live and
+                        all(n['playing'] == n['assigned'] for n in view['nests']))
+
+            _wait_until(lambda: settled({'w1', 'w2', 'w3'}), 30)
+
+            view = player_assignments(client, nest_ids, timeout=0.6)
+            victim = max(view['workers'], key=lambda w: len(w['nests']))
+            moved = victim['nests']
+            assert moved
+            playing = {nid: client.get('NEST:%s|MISC|now-playing' % nid) for nid in moved}
+            epochs = {nid: client.get('NEST:%s|MISC|player-epoch' % nid) for nid in moved}
+
+            workers[victim['worker_id']].send_signal(signal.SIGKILL)
+            killed = time.monotonic()
+            _wait_until(lambda: settled(set(workers) - {victim['worker_id']}), 10)
+            # Timeout + a heartbeat + the lease, with room for a loaded machine
+            assert time.monotonic() - killed < 5
+
+            for nid in moved:
+                assert client.get('NEST:%s|MISC|player-epoch' % nid) != epochs[nid]
+                assert client.get('NEST:%s|MISC|now-playing' % nid) == playing[nid]
+        finally:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+
+
+def _ping(client):
+    import redis
+    try:
+        return client.ping()
+    except redis.ConnectionError:
+        return False
@@ -0,0 +1,1477 @@
+"""
+Queue read/write path tests against fakeredis (Lua scripts need lupa).
+"""
+import os
+import sys
+
+import pytest
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _song_payload(idx, auto=False):
+    return {
+        'src': 'spotify',
+        'trackid': f'spotify:track:{idx}',
+        'title': f'Song {idx}',
+        'artist': 'Tester',
+        'duration': 60,
+        'auto': auto,
+        'big_img': '',
+        'img': '',
+    }
+
+
+def _legacy_pickle(value):
+    """A value as the old pickle_dump_b64 helper stored it."""
+    import base64
+    import pickle
+    return base64.b64encode(pickle.dumps(value)).decode('ascii')
+
+
+@pytest.fixture
+def queue_db():
+    try:
+        import fakeredis
+    except ImportError:
+        pytest.skip("fakeredis not installed")
+
+    from db import DB
+
+    fake_r = fakeredis.FakeRedis(decode_responses=True)
+    db = DB(nest_id="main", init_history_to_redis=False, redis_client=fake_r)
+
+    # Silence pubsub messages during tests
+    db._msg = lambda *args, **kwargs: None
+    return db, fake_r
+
+
+class TestQueueSnapshot:
+    """get_queue_snapshot() must match the per-song reads it replaces."""
+
+    def test_snapshot_matches_per_song_reads(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        db.add_jam(db._key('QUEUEJAM|{0}'.format(ids[0])), 'b@example.com')
+        fake_r.sadd(db._key('QUEUEJAM_TB|{0}'.format(ids[0])), 'b@example.com')
+        db.add_comment(ids[1], 'c@example.com', 'great||tune')
+
+        snapshot = db.get_queue_snapshot()
+
+        assert [s['id'] for s in snapshot] == ids
+        for song in snapshot:
+            expected = db.get_song_from_queue(song['id'])
+            expected['score'] = fake_r.zscore(db._key('MISC|priority-queue'), song['id'])
+            assert song == expected
+        assert snapshot[0]['jam'][0]['throwback'] is True
+        assert snapshot[1]['comments'][0]['user'] == 'c@example.com'
+
+    def test_snapshot_is_one_round_trip(self, queue_db):
+        db, fake_r = queue_db
+        for i in range(10):
+            db._add_song('a@example.com', _song_payload(i), False)
+        db.get_queue_snapshot()  # load the script
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        assert len(db.get_queue_snapshot()) == 10
+        assert calls == ['EVALSHA']
+
+    def test_snapshot_purges_expired_entries(self, queue_db):
+        db, fake_r = queue_db
+        first = db._add_song('a@example.com', _song_payload(1), False)
+        second = db._add_song('a@example.com', _song_payload(2), False)
+        fake_r.delete(db._key('QUEUE|{0}'.format(first)))
+
+        assert [s['id'] for s in db.get_queue_snapshot()] == [second]
+        assert fake_r.zrange(db._key('MISC|priority-queue'), 0, -1) == [second]
+
+    def test_get_queued_appends_preview_card(self, queue_db, monkeypatch):
+        db, _ = queue_db
+        db._add_song('a@example.com', _song_payload(1), False)
+        monkeypatch.setattr(db, 'get_additional_src', lambda: {'playlist_src': True})
+
+        queued = db.get_queued()
+        assert len(queued) == 2
+        assert queued[-1] == {'playlist_src': True}
+
+
+class TestFairScoring:
+    """Fair interleave: a user's nth song goes before anyone's (n+1)th."""
+
+    def test_second_user_interleaves(self, queue_db):
+        db, _ = queue_db
+        a = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        b = db._add_song('b@example.com', _song_payload(10), False)
+
+        order = [s['id'] for s in db.get_queue_snapshot()]
+        assert order == [a[0], b, a[1], a[2]]
+
+    def test_auto_songs_go_last(self, queue_db):
+        db, _ = queue_db
+        a = [db._add_song('a@example.com', _song_payload(i), False) for i in range(2)]
+        bender = db._add_song('the@echonest.com', _song_payload(5, auto=True), False)
+        b = db._add_song('b@example.com', _song_payload(6), False)
+
+        order = [s['id'] for s in db.get_queue_snapshot()]
+        assert order == [a[0], b, a[1], bender]
+
+
+class TestAtomicAdd:
+    """_add_song is one QUEUE_ADD script call."""
+
+    @staticmethod
+    def _reference_index(queued, userid, auto):
+        """Where the pre-script Python scoring placed a new song."""
+        if auto:
+            return len(queued)
+        mine = 1 + sum(1 for x in queued if x.get('user', '') == userid)
+        seen = {}
+        for i, x in enumerate(queued):
+            seen[x['user']] = seen.get(x['user'], 0) + 1
+            if seen[x['user']] == mine + 1:
+                return i
+        return len(queued)
+
+    def test_placement_matches_reference(self, queue_db):
+        import random
+
+        db, fake_r = queue_db
+        rng = random.Random(7)
+        users = ['a@example.com', 'b@example.com', 'c@example.com', 'the@echonest.com']
+        for i in range(60):
+            user = rng.choice(users)
+            auto = user == 'the@echonest.com'
+            expected = self._reference_index(db.get_queue_snapshot(), user, auto)
+            sid = db._add_song(user, _song_payload(i, auto=auto), False)
+            assert fake_r.zrank(db._key('MISC|priority-queue'), sid) == expected
+            if i % 7 == 6:
+                db.pop_next()
+
+    def test_add_is_one_round_trip(self, queue_db):
+        db, fake_r = queue_db
+        db._add_song('a@example.com', _song_payload(0), False)  # load the script
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        sid = db._add_song('b@example.com', _song_payload(1), False)
+        assert calls == ['EVALSHA']
+
+        song = db.get_song_from_queue(sid)
+        assert (song['id'], song['user'], song['vote']) == (sid, 'b@example.com', '0')
+        assert fake_r.smembers(db._key('QUEUE|VOTE|' + sid)) == {'b@example.com'}
+        assert fake_r.hget(db._key('MISC|queue-users'), sid) == 'b@example.com'
+
+    def test_force_first_and_penalty(self, queue_db):
+        db, fake_r = queue_db
+        db._add_song('a@example.com', _song_payload(0), False)
+        first = db._add_song('b@example.com', _song_payload(1), True)
+        late = db._add_song('c@example.com', _song_payload(2), False, penalty=10)
+
+        order = [s['id'] for s in db.get_queue_snapshot()]
+        assert order[0] == first and order[-1] == late
+
+
+class TestQueueUserIndexes:
+    """Per-user counts and positions stay in step with the priority queue."""
+
+    @staticmethod
+    def _expected_indexes(db, fake_r):
+        users, ordinals = {}, {}
+        for sid, score in fake_r.zrange(db._key('MISC|priority-queue'), 0, -1, withscores=True):
+            owner = fake_r.hget(db._key('MISC|queue-users'), sid)
+            users.setdefault(owner, []).append((sid, score))
+            ordinals.setdefault(len(users[owner]), []).append((sid, score))
+        return users, ordinals
+
+    def _assert_consistent(self, db, fake_r):
+        users, ordinals = self._expected_indexes(db, fake_r)
+        for user, songs in users.items():
+            assert fake_r.zrange(db._key('MISC|queue-user|' + user), 0, -1, withscores=True) == songs
+        for n in range(1, 20):
+            got = fake_r.zrange(db._key('MISC|queue-ordinal|{0}'.format(n)), 0, -1, withscores=True)
+            assert got == sorted(ordinals.get(n, []), key=lambda x: (x[1], x[0]))
+
+    def test_indexes_follow_add_pop_kill_vote(self, queue_db):
+        import random
+
+        db, fake_r = queue_db
+        rng = random.Random(11)
+        users = ['a@example.com', 'b@example.com', 'c@example.com']
+        ids = []
+        for i in range(80):
+            action = rng.random()
+            if action < 0.6 or not ids:
+                ids.append(db._add_song(rng.choice(users), _song_payload(i), False))
+            elif action < 0.7:
+                popped = db.pop_next()
+                ids = [x for x in ids if x != popped.get('id')]
+            elif action < 0.8:
+                db.kill_song(ids.pop(rng.randrange(len(ids))), 'a@example.com')
+            else:
+                db.vote('z{0}@example.com'.format(i), rng.choice(ids), rng.random() < 0.5)
+            self._assert_consistent(db, fake_r)
+
+    def test_nuke_clears_indexes(self, queue_db):
+        db, fake_r = queue_db
+        for i in range(4):
+            db._add_song('a@example.com', _song_payload(i), False)
+        db.nuke_queue('a@example.com')
+
+        assert fake_r.keys(db._key('MISC|queue-user*')) == []
+        assert fake_r.keys(db._key('MISC|queue-ordinal|*')) == []
+        assert fake_r.zcard(db._key('MISC|priority-queue')) == 0
+
+    def test_legacy_queue_is_reindexed_on_add(self, queue_db):
+        db, fake_r = queue_db
+        a = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        for key in fake_r.keys(db._key('MISC|queue-*')):
+            if key != db._key('MISC|queue-version'):
+                fake_r.delete(key)
+        fake_r.zadd(db._key('MISC|priority-queue'), {'999': 10.0})  # hash long gone
+
+        b = db._add_song('b@example.com', _song_payload(10), False)
+
+        assert [s['id'] for s in db.get_queue_snapshot()] == [a[0], b, a[1], a[2]]
+        assert fake_r.zscore(db._key('MISC|priority-queue'), '999') is None
+        self._assert_consistent(db, fake_r)
+
+
+class TestAtomicVote:
+    """vote() is one QUEUE_VOTE script call returning the new rank."""
+
+    def _order(self, db):
+        return [s['id'] for s in db.get_queue_snapshot()]
+
+    def test_up_and_down_move_one_place(self, queue_db):
+        db, _ = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(4)]
+
+        assert db.vote('b@example.com', ids[2], True) == 1
+        assert self._order(db) == [ids[0], ids[2], ids[1], ids[3]]
+        assert db.vote('c@example.com', ids[0], False) == 1
+        assert self._order(db) == [ids[2], ids[0], ids[1], ids[3]]
+
+    def test_ends_of_queue(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+
+        assert db.vote('b@example.com', ids[1], True) == 0
+        assert db.vote('b@example.com', ids[1], True) is None
+        assert self._order(db) == [ids[1], ids[0], ids[2]]
+        assert db.vote('b@example.com', ids[2], False) is None
+
+    def test_up_vote_on_head_counts_without_moving(self, queue_db):
+        db, _ = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        version = db.get_queue_version()
+
+        assert db.vote('b@example.com', ids[0], True) is None
+        assert self._order(db) == ids
+        assert db.get_song_from_queue(ids[0])['vote'] == '1'
+        assert db.get_queue_version() == version + 1
+
+    def test_repeat_vote_is_ignored(self, queue_db):
+        db, _ = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        db.vote('b@example.com', ids[2], True)
+        version = db.get_queue_version()
+
+        assert db.vote('b@example.com', ids[1], True) is not None
+        assert db.vote('b@example.com', ids[1], True) is None
+        assert db.get_queue_version() == version + 1
+
+    def test_counter_and_colors(self, queue_db):
+        db, _ = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        db.vote('b@example.com', ids[2], True)
+        db.vote('c@example.com', ids[2], True)
+        song = db.get_song_from_queue(ids[2])
+        assert (song['vote'], song['background_color'], song['foreground_color']) == (
+            '2', '2f2f2f', 'f0f0ff')
+
+        db.vote('a@example.com', ids[0], False)  # owner's own down vote
+        song = db.get_song_from_queue(ids[0])
+        assert (song['vote'], song['background_color']) == ('0', '222222')
+        db.vote('b@example.com', ids[1], False)
+        assert db.get_song_from_queue(ids[1])['background_color'] == '1b1b1b'
+
+    def test_vote_is_one_round_trip(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        db.vote('b@example.com', ids[2], True)  # load the script
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        db.vote('c@example.com', ids[1], False)
+        assert calls == ['EVALSHA']
+
+
+class TestAtomicJam:
+    """jam() is one QUEUE_JAM script call returning the count and award."""
+
+    def test_toggle(self, queue_db):
+        db, fake_r = queue_db
+        song = db._add_song('a@example.com', _song_payload(1), False)
+        key = db._key('QUEUEJAM|{0}'.format(song))
+
+        assert db.jam(song, 'B@example.com') == {'jams': 1, 'jammed': True, 'free_horn': False}
+        assert db.jam(song, 'c@example.com')['jams'] == 2
+        assert db.jam(song, 'b@example.com') == {'jams': 1, 'jammed': False, 'free_horn': False}
+        assert fake_r.zrange(key, 0, -1) == ['c@example.com']
+        assert 0 < fake_r.ttl(key) <= 24*60*60
+
+    def test_free_horn_awarded_once(self, queue_db, monkeypatch):
+        import gevent
+        from config import CONF
+        db, fake_r = queue_db
+        monkeypatch.setattr(CONF, 'FREE_AIRHORN', 3, raising=False)
+        song = db._add_song('a@example.com', _song_payload(1), False)
+
+        jobs = [gevent.spawn(db.jam, song, 'u{0}@example.com'.format(i)) for i in range(10)]
+        gevent.joinall(jobs, raise_error=True)
+        results = [job.value for job in jobs]
+
+        assert sorted(r['jams'] for r in results) == list(range(1, 11))
+        assert [r['jams'] for r in results if r['free_horn']] == [3]
+        assert fake_r.smembers(db._key('FREEHORN_a@example.com')) == {song}
+
+        db.jam(song, 'u0@example.com')
+        assert db.jam(song, 'u0@example.com')['free_horn'] is False
+
+    def test_jam_is_one_round_trip(self, queue_db):
+        db, fake_r = queue_db
+        song = db._add_song('a@example.com', _song_payload(1), False)
+        db.jam(song, 'b@example.com')  # load the script
+        version = db.get_queue_version()
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        db.jam(song, 'c@example.com')
+        assert calls == ['EVALSHA']
+        fake_r.execute_command = original
+        assert db.get_queue_version() == version + 1
+
+
+class TestAtomicPop:
+    """pop_next() is one QUEUE_POP script call that also sets now-playing."""
+
+    def test_pop_sets_now_playing(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('the@echonest.com', _song_payload(i, auto=True), False)
+               for i in range(2)]
+        version = db.get_queue_version()
+
+        song = db.pop_next()
+
+        assert song['id'] == ids[0]
+        assert (song['duration'], song['auto']) == (60, True)
+        assert 'jam' not in song
+        assert fake_r.get(db._key('MISC|now-playing')) == ids[0]
+        assert 0 < fake_r.ttl(db._key('MISC|now-playing-done')) <= 60
+        assert fake_r.zrange(db._key('MISC|priority-queue'), 0, -1) == [ids[1]]
+        assert db.get_queue_version() == version + 1
+
+    def test_skips_entries_without_data(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(2)]
+        fake_r.delete(db._key('QUEUE|{0}'.format(ids[0])))
+
+        assert db.pop_next()['id'] == ids[1]
+        assert db.pop_next() == {}
+        assert not fake_r.exists(db._key('MISC|now-playing'))
+
+    def test_overlapping_players_get_different_songs(self, queue_db):
+        import gevent
+        db, _ = queue_db
+        ids = [db._add_song('the@echonest.com', _song_payload(i, auto=True), False)
+               for i in range(4)]
+
+        jobs = [gevent.spawn(db.pop_next) for _ in range(4)]
+        gevent.joinall(jobs, raise_error=True)
+
+        assert sorted(job.value['id'] for job in jobs) == sorted(ids)
+
+    def test_human_song_resets_bender_after_pop(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        monkeypatch.setattr(db, 'ensure_fill_songs', lambda: None)
+        db._add_song('a@example.com', _song_payload(1), False)
+        fake_r.set(db._key('MISC|bender_streak_start'), 'x')
+        fake_r.set(db._key('BENDER|seed-info'), 'x')
+
+        db.pop_next()
+
+        assert fake_r.get(db._key('MISC|last-queued')) == 'spotify:track:1'
+        assert not fake_r.exists(db._key('MISC|bender_streak_start'))
+        db._wait_bender_reset()
+        assert not fake_r.exists(db._key('BENDER|seed-info'))
+
+    def test_pop_is_one_round_trip(self, queue_db):
+        db, fake_r = queue_db
+        for i in range(3):
+            db._add_song('the@echonest.com', _song_payload(i, auto=True), False)
+        db.pop_next()  # load the script
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        assert db.pop_next()
+        assert calls == ['EVALSHA']
+
+
+class TestPlayerClock:
+    """player_now() is derived from MISC|clock; nothing ticks it forward."""
+
+    def _reading(self, db):
+        return db.player_now().timestamp()
+
+    def test_reading_is_wall_time_minus_pauses(self, queue_db):
+        import time
+        db, fake_r = queue_db
+        now = time.time()
+        fake_r.hset(db._key('MISC|clock'), mapping={'start': now - 100, 'paused': 30})
+        assert abs(self._reading(db) - (now - 30)) < 1
+
+        fake_r.hset(db._key('MISC|clock'), 'paused-since', now - 10)
+        assert abs(self._reading(db) - (now - 40)) < 1
+
+    def test_pause_and_unpause(self, queue_db):
+        import time
+        db, fake_r = queue_db
+        db._start_clock()
+        db.pause('a@example.com')
+        clock = db._key('MISC|clock')
+        fake_r.hset(clock, 'paused-since', time.time() - 5)
+        frozen = self._reading(db)
+
+        db.unpause('a@example.com')
+
+        assert 'paused-since' not in fake_r.hgetall(clock)
+        assert 5 <= float(fake_r.hget(clock, 'paused')) < 6
+        assert abs(self._reading(db) - frozen) < 1
+        db.unpause('a@example.com')
+        assert float(fake_r.hget(clock, 'paused')) < 6
+
+    def test_legacy_clock_is_carried_over(self, queue_db):
+        import datetime
+        db, fake_r = queue_db
+        then = datetime.datetime.now() - datetime.timedelta(hours=1)
+        fake_r.set(db._key('MISC|player-now'), _legacy_pickle(then))
+
+        db._start_clock()
+
+        assert abs(self._reading(db) - then.timestamp()) < 1
+        assert not fake_r.exists(db._key('MISC|player-now'))
+
+    def test_read_is_one_command(self, queue_db):
+        db, fake_r = queue_db
+        db._start_clock()
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        fake_r.execute_command = counting
+        db.player_now()
+        assert calls == ['HMGET']
+
+
+def _start_player(db, monkeypatch, songs=3):
+    """Run the real master_player on *songs* Bender songs, kept off Spotify."""
+    import gevent
+    from config import CONF
+    monkeypatch.setattr(CONF, 'USE_BENDER', False, raising=False)
+    monkeypatch.setattr(db, 'log_finished_song', lambda song: None)
+    monkeypatch.setattr(db, 'refresh_preview_card', lambda: None)
+    monkeypatch.setattr(db, '_ensure_preview_card', lambda: None)
+    for i in range(songs):
+        db._add_song('the@echonest.com', _song_payload(i, auto=True), False)
+    player = gevent.spawn(db.master_player)
+    _wait_for(lambda: db._r.get(db._key('MISC|now-playing')))
+    return player
+
+
+def _wait_for(check, limit=2.0):
+    import time
+    import gevent
+    start = time.monotonic()
+    while not check():
+        assert time.monotonic() - start < limit
+        gevent.sleep(0.005)
+    return time.monotonic() - start
+
+
+class TestPlayerControl:
+    """Skip, pause and unpause wake master_player through MISC|player-control."""
+
+    def test_commands_are_queued(self, queue_db):
+        db, _ = queue_db
+        db.kill_playing('a@example.com')
+        db.pause('a@example.com')
+        db.unpause('a@example.com')
+
+        assert [db._wait_player_command(0.01) for _ in range(4)] == [
+            'skip', 'pause', 'unpause', None]
+
+    def test_skip_wakes_player(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        player = _start_player(db, monkeypatch)
+        try:
+            playing = fake_r.get(db._key('MISC|now-playing'))
+            db.kill_playing('a@example.com')
+            waited = _wait_for(lambda: fake_r.get(db._key('MISC|now-playing')) != playing)
+            assert waited < 0.5
+        finally:
+            player.kill()
+
+    def test_double_skip_skips_one_song(self, queue_db, monkeypatch):
+        import gevent
+        db, fake_r = queue_db
+        player = _start_player(db, monkeypatch)
+        try:
+            playing = fake_r.get(db._key('MISC|now-playing'))
+            db.kill_playing('a@example.com')
+            db.kill_playing('b@example.com')
+            _wait_for(lambda: fake_r.get(db._key('MISC|now-playing')) != playing)
+            gevent.sleep(0.1)
+            assert fake_r.get(db._key('MISC|now-playing')) == str(int(playing) + 1)
+            assert not fake_r.exists(db._key('MISC|player-control'))
+        finally:
+            player.kill()
+
+    def test_idle_player_makes_no_reads(self, queue_db, monkeypatch):
+        import types
+        import gevent
+        from config import CONF
+        from db import DB
+        db, fake_r = queue_db
+        monkeypatch.setattr(CONF, 'PLAYER_LEASE_SECONDS', 30, raising=False)
+        player = _start_player(db, monkeypatch)
+        monkeypatch.setattr(db, '_ensure_preview_card', types.MethodType(DB._ensure_preview_card, db))
+        try:
+            gevent.sleep(0.1)
+            calls = []
+            original = fake_r.execute_command
+
+            def counting(*args, **kwargs):
+                calls.append(args[0])
+                return original(*args, **kwargs)
+
+            fake_r.execute_command = counting
+            gevent.sleep(1.5)
+            # Blocked on the control list until the song's next deadline
+            assert calls == []
+            # The preview card is looked for when a 'preview' command asks
+            db._player_command('preview')
+            _wait_for(lambda: 'EXISTS' in calls)
+        finally:
+            player.kill()
+
+    def test_pause_stops_position_updates_until_unpause(self, queue_db, monkeypatch):
+        import gevent
+        db, fake_r = queue_db
+        messages = []
+        monkeypatch.setattr(db, '_msg', messages.append)
+        player = _start_player(db, monkeypatch)
+        try:
+            playing = fake_r.get(db._key('MISC|now-playing'))
+            db.pause('a@example.com')
+            gevent.sleep(0.05)
+            del messages[:]
+            gevent.sleep(1.2)
+            assert not [m for m in messages if m.startswith('pp|')]
+
+            db.unpause('a@example.com')
+            _wait_for(lambda: any(m.startswith('pp|') for m in messages), limit=1.5)
+            assert fake_r.get(db._key('MISC|now-playing')) == playing
+            assert not fake_r.exists(db._key('MISC|player-control'))
+        finally:
+            player.kill()
+
+    def test_position_frame_carries_start_epoch(self, queue_db, monkeypatch):
+        import time
+        db, _ = queue_db
+        messages = []
+        monkeypatch.setattr(db, '_msg', messages.append)
+        song = {'src': 'spotify', 'trackid': 'abc', 'duration': 200}
+
+        before = time.time()
+        db._publish_position(song, 150.4, None)
+        db._publish_position(song, 150.4, '1')
+
+        src, trackid, pos, started, paused = messages[0].split('|')[1:]
+        assert (src, trackid, pos, paused) == ('spotify', 'abc', '49', '0')
+        assert before - 49.6 - 0.01 <= float(started) <= time.time() - 49.6 + 0.01
+        assert messages[1].endswith('|1')
+
+    def test_position_frames_are_throttled(self, queue_db, monkeypatch):
+        import gevent
+        from config import CONF
+        db, _ = queue_db
+        messages = []
+        monkeypatch.setattr(db, '_msg', messages.append)
+        monkeypatch.setattr(CONF, 'POSITION_RESYNC_SECONDS', 15, raising=False)
+        player = _start_player(db, monkeypatch)
+        try:
+            gevent.sleep(2.2)
+        finally:
+            player.kill()
+        # One frame when the song starts, none of the old once-a-second ticks
+        assert len([m for m in messages if m.startswith('pp|')]) == 1
+
+
+class TestLookahead:
+    """prepare_next() readies the next song so the transition is one swap."""
+
+    def test_pop_with_clock_sets_song_times(self, queue_db):
+        import datetime
+        from db import epoch_load
+        db, fake_r = queue_db
+        db._add_song('the@echonest.com', _song_payload(0, auto=True), False)
+        now = datetime.datetime(2026, 10, 17, 12, 0, 0)
+
+        db.pop_next(now)
+
+        assert epoch_load(fake_r.get(db._key('MISC|current-done'))) == now + datetime.timedelta(seconds=61)
+        assert 0 < fake_r.ttl(db._key('MISC|current-done')) <= 61
+        assert fake_r.get(db._key('MISC|started-on')) == now.isoformat()
+
+    def test_empty_queue_is_filled_ahead_of_the_pop(self, queue_db, monkeypatch):
+        from config import CONF
+        db, fake_r = queue_db
+        monkeypatch.setattr(CONF, 'USE_BENDER', False, raising=False)
+        monkeypatch.setattr(db, 'refresh_preview_card', lambda: None)
+        monkeypatch.setattr(db, 'get_fill_song', lambda: ('the@echonest.com', 'spotify:track:7'))
+        monkeypatch.setattr(db, 'add_spotify_song', lambda user, trackid, scrobble=True: db._add_song(
+            user, _song_payload(7, auto=True), False))
+
+        next_id = db.prepare_next()
+
+        assert next_id and fake_r.zrange(db._key('MISC|priority-queue'), 0, -1) == [next_id]
+        assert fake_r.exists(db._key('MISC|bender_streak_start'))
+        # A queued song is left alone
+        assert db.prepare_next() == next_id
+        assert fake_r.zcard(db._key('MISC|priority-queue')) == 1
+
+    def test_tops_up_one_past_min_depth(self, queue_db, monkeypatch):
+        db, _ = queue_db
+        db._add_song('a@example.com', _song_payload(0), False)
+        calls = []
+        monkeypatch.setattr(db, 'ensure_queue_depth', lambda extra=0: calls.append(extra))
+        monkeypatch.setattr(db, 'refresh_preview_card', lambda: calls.append('card'))
+
+        db.prepare_next()
+
+        assert calls == [1, 'card']
+
+    def test_player_prepares_ahead_and_records_gap(self, queue_db, monkeypatch):
+        import gevent
+        from config import CONF
+        db, fake_r = queue_db
+        monkeypatch.setattr(CONF, 'LOOKAHEAD_SECONDS', 120, raising=False)
+        prepared = []
+        monkeypatch.setattr(db, 'prepare_next', lambda: prepared.append(
+            fake_r.get(db._key('MISC|now-playing'))))
+        player = _start_player(db, monkeypatch)
+        try:
+            gevent.sleep(0.05)
+            playing = fake_r.get(db._key('MISC|now-playing'))
+            assert prepared == [playing]
+            db.kill_playing('a@example.com')
+            _wait_for(lambda: db.transition_stats()['count'] == 1)
+        finally:
+            player.kill()
+        stats = db.transition_stats()
+        assert 0 <= stats['p50_ms'] == stats['max_ms'] < 500
+        assert fake_r.get(db._key('MISC|started-on'))
+
+
+class TestPlayerLease:
+    """master_player holds a renewed lease and fences its writes with a token."""
+
+    @pytest.fixture(autouse=True)
+    def short_lease(self, monkeypatch):
+        from config import CONF
+        monkeypatch.setattr(CONF, 'PLAYER_LEASE_SECONDS', 0.3, raising=False)
+
+    def _standby(self, db, monkeypatch):
+        import gevent
+        from db import DB
+        other = DB(nest_id=db.nest_id, init_history_to_redis=False, redis_client=db._r)
+        other._msg = lambda *args, **kwargs: None
+        for name in ('log_finished_song', 'refresh_preview_card', '_ensure_preview_card'):
+            monkeypatch.setattr(other, name, getattr(db, name))
+        return other, gevent.spawn(other.master_player)
+
+    def test_slow_work_does_not_lose_the_lease(self, queue_db, monkeypatch):
+        import gevent
+        db, fake_r = queue_db
+        monkeypatch.setattr(db, 'ensure_queue_depth', lambda extra=0: gevent.sleep(1.0))
+        player = _start_player(db, monkeypatch)
+        other, standby = self._standby(db, monkeypatch)
+        try:
+            gevent.sleep(0.9)
+            assert fake_r.get(db._key('MISC|player-epoch')) == '1'
+            assert fake_r.get(db._key('MISC|master-player')).endswith('|1')
+        finally:
+            player.kill()
+            standby.kill()
+
+    def test_standby_takes_over_from_a_dead_player(self, queue_db, monkeypatch):
+        import time
+        import gevent
+        db, fake_r = queue_db
+        player = _start_player(db, monkeypatch)
+        other, standby = self._standby(db, monkeypatch)
+        try:
+            gevent.sleep(0.1)
+            playing = fake_r.get(db._key('MISC|now-playing'))
+            # A killed worker neither renews nor releases its lease
+            monkeypatch.setattr(db, '_renew_player_lease', lambda lease, ttl: True)
+            player.kill()
+            killed = time.monotonic()
+            _wait_for(lambda: fake_r.get(db._key('MISC|player-epoch')) == '2')
+            assert time.monotonic() - killed < 0.6
+            # The new player resumes the song the dead one was playing
+            assert fake_r.get(db._key('MISC|now-playing')) == playing
+            other.kill_playing('a@example.com')
+            _wait_for(lambda: fake_r.get(db._key('MISC|now-playing')) != playing)
+        finally:
+            standby.kill()
+
+    def test_stale_token_cannot_pop(self, queue_db):
+        from db import PlayerLeaseLost
+        db, fake_r = queue_db
+        db._add_song('a@example.com', _song_payload(0), False)
+        db._fence = 1
+        fake_r.set(db._key('MISC|player-epoch'), 2)
+
+        with pytest.raises(PlayerLeaseLost):
+            db.pop_next()
+        with pytest.raises(PlayerLeaseLost):
+            db._fenced(lambda pipe: pipe.delete(db._key('MISC|current-done')))
+        assert fake_r.zcard(db._key('MISC|priority-queue')) == 1
+        assert not fake_r.exists(db._key('MISC|now-playing'))
+
+    def test_stale_token_cannot_fill_or_refresh(self, queue_db, monkeypatch):
+        from db import PlayerLeaseLost
+        db, fake_r = queue_db
+        monkeypatch.setattr(db, 'build_preview_card', lambda: ({'title': 'Bender'}, None))
+        db._fence = 1
+        fake_r.set(db._key('MISC|player-epoch'), 2)
+
+        with pytest.raises(PlayerLeaseLost):
+            db._add_song('the@echonest.com', _song_payload(0, auto=True), False)
+        with pytest.raises(PlayerLeaseLost):
+            db._start_bender_streak()
+        with pytest.raises(PlayerLeaseLost):
+            db.refresh_preview_card()
+        assert fake_r.zcard(db._key('MISC|priority-queue')) == 0
+        assert not fake_r.exists(db._key('MISC|bender_streak_start'))
+        assert not fake_r.exists(db._key('MISC|preview-card'))
+
+        fake_r.set(db._key('MISC|player-epoch'), 1)
+        assert db._add_song('the@echonest.com', _song_payload(0, auto=True), False)
+        assert db.refresh_preview_card() == {'title': 'Bender'}
+
+    def test_deposed_player_stands_by(self, queue_db, monkeypatch):
+        import gevent
+        db, fake_r = queue_db
+        player = _start_player(db, monkeypatch)
+        try:
+            # Someone else takes the lease, as after a network partition
+            fake_r.set(db._key('MISC|master-player'), 'elsewhere|2', px=5000)
+            fake_r.set(db._key('MISC|player-epoch'), 2)
+            _wait_for(lambda: db._fence is None)
+            queued = fake_r.zcard(db._key('MISC|priority-queue'))
+            db._player_command('skip')
+            gevent.sleep(0.3)
+            assert fake_r.zcard(db._key('MISC|priority-queue')) == queued
+            assert not player.dead
+        finally:
+            player.kill()
+
+
+class TestEpochTimes:
+    """Times are stored as epoch seconds; legacy pickles are still read."""
+
+    def test_round_trip_and_legacy_read(self):
+        import datetime
+        from db import epoch_dump, epoch_load
+        when = datetime.datetime(2026, 10, 17, 12, 30, 15, 250000)
+
+        assert float(epoch_dump(when)) == when.timestamp()
+        assert epoch_load(epoch_dump(when)) == when
+        assert epoch_load(_legacy_pickle(when)) == when
+        assert epoch_load(None) is None
+
+    def test_legacy_read_only_rebuilds_datetimes(self):
+        import collections
+        import pickle
+        from db import epoch_load
+
+        with pytest.raises(pickle.UnpicklingError):
+            epoch_load(_legacy_pickle(collections.OrderedDict(a=1)))
+        with pytest.raises(ValueError):
+            epoch_load(_legacy_pickle('not a time'))
+
+    def test_guest_expiry(self, queue_db):
+        import datetime
+        db, fake_r = queue_db
+        db.create_guest('g@example.com', 'pw')
+        assert float(fake_r.hget(db._key('MISC|guest-login-expire'), 'g@example.com')) > 0
+        assert db.try_login('g@example.com', 'pw') == 'g@example.com'
+
+        expired = datetime.datetime.now() - datetime.timedelta(days=1)
+        fake_r.hset(db._key('MISC|guest-login-expire'), 'g@example.com', _legacy_pickle(expired))
+        assert db.try_login('g@example.com', 'pw') is False
+
+    def test_migration_rewrites_pickles(self, queue_db):
+        import datetime
+        import migrate_time_values
+        from db import epoch_load
+        db, fake_r = queue_db
+        when = datetime.datetime.now() + datetime.timedelta(minutes=3)
+        fake_r.set(db._key('MISC|current-done'), _legacy_pickle(when), ex=180)
+        fake_r.set(db._key('MISC|bender_streak_start'), repr(when.timestamp()))
+        fake_r.hset(db._key('MISC|guest-login-expire'), mapping={
+            'a@example.com': _legacy_pickle(when), 'b@example.com': 'garbage'})
+
+        dry = migrate_time_values.migrate(redis_client=fake_r, dry_run=True)
+        assert dry == {'converted': 2, 'current': 1, 'unreadable': 1}
+        assert fake_r.get(db._key('MISC|current-done')) == _legacy_pickle(when)
+
+        migrate_time_values.migrate(redis_client=fake_r, dry_run=False)
+        done = fake_r.get(db._key('MISC|current-done'))
+        assert float(done) == when.timestamp()
+        assert 0 < fake_r.ttl(db._key('MISC|current-done')) <= 180
+        assert epoch_load(fake_r.hget(db._key('MISC|guest-login-expire'), 'a@example.com')) == when
+        assert migrate_time_values.migrate(redis_client=fake_r, dry_run=True)['converted'] == 0
+
+
+class TestGapRanks:
+    """Priority queue scores are integers that never run out of room."""
+
+    def test_scores_are_spaced_integers(self, queue_db):
+        db, fake_r = queue_db
+        for i in range(3):
+            db._add_song('a@example.com', _song_payload(i), False)
+        first = db._add_song('b@example.com', _song_payload(9), True)
+
+        scores = [s for _, s in fake_r.zrange(db._key('MISC|priority-queue'), 0, -1, withscores=True)]
+        assert scores == [0.0, 1024.0, 2048.0, 3072.0]
+        assert fake_r.zrank(db._key('MISC|priority-queue'), first) == 0
+
+    def test_repeated_moves_renumber_locally(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('u{0}@example.com'.format(i % 3), _song_payload(i), False)
+               for i in range(30)]
+        order = [s['id'] for s in db.get_queue_snapshot()]
+        # swap two songs over and over: each lands between the same neighbors
+        for i in range(200):
+            db.vote('v{0}@example.com'.format(i), order[15], True)
+            db.vote('v{0}@example.com'.format(i), order[14], True)
+
+        ranked = fake_r.zrange(db._key('MISC|priority-queue'), 0, -1, withscores=True)
+        assert [sid for sid, _ in ranked] == order
+        scores = [score for _, score in ranked]
+        assert all(score == int(score) for score in scores)
+        assert len(set(scores)) == len(scores)
+        renumbered = int(fake_r.get(db._key('MISC|queue-renumbers')))
+        assert 0 < renumbered < 200 * len(ids)
+        TestQueueUserIndexes()._assert_consistent(db, fake_r)
+
+    def test_legacy_float_scores_are_respaced(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        fake_r.zadd(db._key('MISC|priority-queue'), {ids[0]: 1.0, ids[1]: 1.5, ids[2]: 1.75})
+
+        b = db._add_song('b@example.com', _song_payload(10), False)
+
+        assert [s['id'] for s in db.get_queue_snapshot()] == [ids[0], b, ids[1], ids[2]]
+
+
+class TestQueueVersion:
+    """Every queue mutation bumps MISC|queue-version."""
+
+    def test_mutations_bump_version(self, queue_db):
+        db, _ = queue_db
+        versions = [db.get_queue_version()]
+
+        db._add_song('a@example.com', _song_payload(1), False)
+        versions.append(db.get_queue_version())
+        second = db._add_song('b@example.com', _song_payload(2), False)
+        db.vote('c@example.com', second, True)
+        versions.append(db.get_queue_version())
+        db.jam(second, 'c@example.com')
+        versions.append(db.get_queue_version())
+        db.kill_song(second, 'a@example.com')
+        versions.append(db.get_queue_version())
+        db.pop_next()
+        versions.append(db.get_queue_version())
+        db._add_song('a@example.com', _song_payload(3), False)
+        db.nuke_queue('a@example.com')
+        versions.append(db.get_queue_version())
+
+        assert versions == sorted(set(versions))
+
+    def test_used_up_backup_queue_bumps_version(self, queue_db):
+        db, fake_r = queue_db
+        fake_r.hset(db._key('MISC|backup-queue-data'), mapping={'user': 'a@example.com'})
+        fake_r.hset(db._key('BENDER|next-preview'), mapping={
+            'trackid': 'spotify:track:preview', 'strategy': 'genre', 'user': 'the@echonest.com'})
+        version = db.get_queue_version()
+
+        assert db.get_fill_song() == ('the@echonest.com', 'spotify:track:preview')
+        assert not fake_r.exists(db._key('MISC|backup-queue-data'))
+        assert db.get_queue_version() == version + 1
+
+    def test_throwback_jam_bumps_version(self, queue_db, monkeypatch):
+        from config import CONF
+        db, fake_r = queue_db
+        monkeypatch.setattr(CONF, 'MIN_QUEUE_DEPTH', 1, raising=False)
+        monkeypatch.setattr(db, 'get_fill_song', lambda: ('the@echonest.com', 'spotify:track:7'))
+        monkeypatch.setattr(db, 'add_spotify_song', lambda user, trackid, scrobble=True: db._add_song(
+            user, _song_payload(7, auto=True), False))
+        fake_r.hset(db._key('BENDER|throwback-jam-pending'), 'spotify:track:7', 'a@example.com')
+        bumps = []
+        real_add_jam = db.add_jam
+
+        def add_jam(*args, **kwargs):
+            bumps.append(db.get_queue_version())
+            real_add_jam(*args, **kwargs)
+            bumps.append(db.get_queue_version())
+        monkeypatch.setattr(db, 'add_jam', add_jam)
+
+        db.ensure_queue_depth()
+
+        assert bumps[1] == bumps[0] + 1
+        song_id = fake_r.zrange(db._key('MISC|priority-queue'), 0, -1)[0]
+        jams = db.get_queue_snapshot()[0]['jam']
+        assert [(jam['user'], jam.get('throwback')) for jam in jams] == [('a@example.com', True)]
+        assert fake_r.ttl(db._key('QUEUEJAM_TB|{0}'.format(song_id))) > 0
+
+
+class TestPlaylistCache:
+    """The shared cache builds each (nest, version) snapshot once."""
+
+    def test_hit_until_queue_changes(self, queue_db, monkeypatch):
+        from playlist_cache import PlaylistCache
+
+        db, _ = queue_db
+        monkeypatch.setattr(db, 'get_additional_src', lambda: {'playlist_src': True})
+        cache = PlaylistCache()
+
+        db._add_song('a@example.com', _song_payload(1), False)
+        first = cache.get(db)
+        assert cache.get(db) is first
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        db._add_song('a@example.com', _song_payload(2), False)
+        second = cache.get(db)
+        assert second is not first
+        assert len(second.queue) == 3
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_concurrent_callers_share_one_build(self, queue_db, monkeypatch):
+        import gevent
+        from playlist_cache import PlaylistCache
+
+        db, _ = queue_db
+        builds = []
+
+        def slow_get_queued():
+            builds.append(1)
+            gevent.sleep(0.05)
+            return [{'playlist_src': True}]
+
+        monkeypatch.setattr(db, 'get_queued', slow_get_queued)
+        cache = PlaylistCache()
+
+        greenlets = [gevent.spawn(cache.get, db) for _ in range(20)]
+        gevent.joinall(greenlets, raise_error=True)
+
+        assert len(builds) == 1
+        assert len({id(g.value) for g in greenlets}) == 1
+        assert cache.stats()['coalesced'] == 19
+
+    def test_encoded_forms_are_memoized(self, queue_db, monkeypatch):
+        from playlist_cache import PlaylistCache
+
+        db, _ = queue_db
+        monkeypatch.setattr(db, 'get_queued', lambda: [{'id': '1'}])
+        snapshot = PlaylistCache().get(db)
+        calls = []
+
+        def encode(queue):
+            calls.append(1)
+            return repr(queue)
+
+        assert snapshot.encoded('ws', encode) == snapshot.encoded('ws', encode)
+        assert len(calls) == 1
+
+
+def _apply_ops(items, ops):
+    """Reference client: apply queue_diff ops the way app.js / SyncAgent do."""
+    from playlist_cache import item_key
+
+    items = list(items)
+    for op in ops:
+        if op['op'] == 'insert':
+            items.insert(op['index'], op['item'])
+            continue
+        idx = [item_key(x) for x in items].index(op['id'])
+        if op['op'] == 'remove':
+            del items[idx]
+        elif op['op'] == 'patch':
+            items[idx] = {k: v for k, v in dict(items[idx], **op['fields']).items()
+                          if v is not None}
+        elif op['op'] == 'move':
+            items.insert(op['index'], items.pop(idx))
+    return items
+
+
+class TestQueueDiff:
+    """queue_diff() ops rebuild the new playlist from the old one."""
+
+    OLD = [{'id': '1', 'vote': 0}, {'id': '2', 'vote': 0},
+           {'id': '3', 'vote': 0}, {'playlist_src': True}]
+
+    def test_vote_is_patch_and_move(self):
+        from playlist_cache import queue_diff
+
+        new = [{'id': '3', 'vote': 1}, {'id': '1', 'vote': 0},
+               {'id': '2', 'vote': 0}, {'playlist_src': True}]
+        ops = queue_diff(self.OLD, new)
+        assert [op['op'] for op in ops] == ['patch', 'move']
+        assert _apply_ops(self.OLD, ops) == new
+
+    def test_insert_and_remove(self):
+        from playlist_cache import queue_diff
+
+        new = [{'id': '2', 'vote': 0}, {'id': '3', 'vote': 0},
+               {'id': '4', 'vote': 0}, {'playlist_src': True}]
+        ops = queue_diff(self.OLD, new)
+        assert {op['op'] for op in ops} == {'remove', 'insert'}
+        assert _apply_ops(self.OLD, ops) == new
+
+    def test_dropped_field_patched_to_none(self):
+        from playlist_cache import queue_diff
+
+        new = [dict(x) for x in self.OLD]
+        new[0]['jam'] = [{'user': 'a@example.com'}]
+        assert _apply_ops(new, queue_diff(new, self.OLD)) == self.OLD
+
+    def test_full_reorder_falls_back(self):
+        from playlist_cache import queue_diff
+
+        old = [{'id': str(i)} for i in range(6)]
+        new = [dict(x, vote=1) for x in reversed(old)]
+        assert queue_diff(old, new) is None
+        assert queue_diff([{'id': '1'}, {'id': '1'}], []) is None
+
+    def test_snapshot_diff_from_previous_version(self, queue_db, monkeypatch):
+        from playlist_cache import PlaylistCache
+
+        db, _ = queue_db
+        monkeypatch.setattr(db, 'get_additional_src', lambda: {'playlist_src': True})
+        cache = PlaylistCache()
+
+        db._add_song('a@example.com', _song_payload(1), False)
+        first = cache.get(db)
+        assert first.diff() is None
+        db._add_song('b@example.com', _song_payload(2), False)
+        second = cache.get(db)
+
+        diff = second.diff()
+        assert (diff['base'], diff['seq']) == (first.version, second.version)
+        assert _apply_ops(first.queue, diff['ops']) == second.queue
+        assert second.diff() is diff
+
+
+class TestQueueExpiryIndex:
+    """MISC|queue-expiry tracks when each queued hash expires."""
+
+    def test_index_follows_queue(self, queue_db):
+        db, fake_r = queue_db
+        index_key = db._key('MISC|queue-expiry')
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(3)]
+        assert sorted(fake_r.zrange(index_key, 0, -1)) == sorted(ids)
+
+        db.kill_song(ids[2], 'a@example.com')
+        db.pop_next()
+        assert fake_r.zrange(index_key, 0, -1) == [ids[1]]
+
+        db.nuke_queue('a@example.com')
+        assert not fake_r.exists(index_key)
+
+    def test_expire_drops_only_due_entries(self, queue_db):
+        db, fake_r = queue_db
+        index_key = db._key('MISC|queue-expiry')
+        gone, alive, fresh = [db._add_song('a@example.com', _song_payload(i), False)
+                              for i in range(3)]
+        fake_r.delete(db._key('QUEUE|{0}'.format(gone)))
+        fake_r.zadd(index_key, {gone: 1, alive: 1})  # both look due
+
+        removed, size = db.expire_queue_entries()
+
+        assert removed == [gone]
+        assert size == 2
+        assert fake_r.zrange(db._key('MISC|priority-queue'), 0, -1) == [alive, fresh]
+        # alive's hash still has a TTL, so it is re-indexed, not dropped
+        assert fake_r.zscore(index_key, alive) > 1
+
+    def test_reindex_backfills_missing_entries(self, queue_db):
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(2)]
+        fake_r.delete(db._key('MISC|queue-expiry'))
+
+        assert db.reindex_queue_expiry() == 2
+        assert db.reindex_queue_expiry() == 0
+        assert sorted(fake_r.zrange(db._key('MISC|queue-expiry'), 0, -1)) == sorted(ids)
+
+    def test_sweeper_reports_reclaimed(self, queue_db):
+        import master_player
+        from nests import NestManager
+
+        db, fake_r = queue_db
+        ids = [db._add_song('a@example.com', _song_payload(i), False) for i in range(2)]
+        fake_r.delete(db._key('QUEUE|{0}'.format(ids[0])))
+        fake_r.zadd(db._key('MISC|queue-expiry'), {ids[0]: 1})
+
+        dbs = {}
+        manager = NestManager(redis_client=fake_r)
+        assert master_player.sweep_expired_queue_entries(manager, dbs) == 1
+        assert master_player.sweep_expired_queue_entries(manager, dbs) == 0
+        assert fake_r.zrange(db._key('MISC|priority-queue'), 0, -1) == [ids[1]]
+
+
+class TestPreviewCard:
+    """get_queued() serves a prebuilt Bender card and never builds one."""
+
+    @staticmethod
+    def _stub_bender(db, fake_r, monkeypatch, calls):
+        def peek():
+            fake_r.hset(db._key('BENDER|next-preview'),
+                        mapping={'trackid': 'spotify:track:p', 'strategy': 'genre'})
+            return 'spotify:track:p', 'the@echonest.com', 'genre'
+
+        def fill_info(track_uri):
+            calls.append(track_uri)
+            return {'trackid': track_uri, 'title': 'Preview', 'artist': 'Bender'}
+
+        monkeypatch.setattr(db, 'ensure_fill_songs', lambda: None)
+        monkeypatch.setattr(db, '_peek_next_fill_song', peek)
+        monkeypatch.setattr(db, 'get_fill_info', fill_info)
+
+    def test_read_path_never_builds(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        calls = []
+        self._stub_bender(db, fake_r, monkeypatch, calls)
+
+        card = db.get_queued()[-1]
+        assert card['playlist_src'] is True
+        assert 'trackid' not in card
+        print("CALLS", calls); assert calls == []
+
+    def test_refresh_stores_card_and_bumps_version(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        calls = []
+        self._stub_bender(db, fake_r, monkeypatch, calls)
+        version = db.get_queue_version()
+
+        db.refresh_preview_card()
+        card = db.get_queued()[-1]
+
+        assert card['trackid'] == 'spotify:track:p'
+        assert card['title'] == 'Bender : Preview'
+        assert db.get_queue_version() == version + 1
+        assert calls == ['spotify:track:p']
+
+    def test_filter_drops_card(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        self._stub_bender(db, fake_r, monkeypatch, [])
+        db.refresh_preview_card()
+
+        db.benderfilter('spotify:track:p', 'a@example.com')
+        assert not fake_r.exists(db._key('MISC|preview-card'))
+        assert 'trackid' not in db.get_queued()[-1]
+
+    def test_card_for_replaced_preview_is_not_stored(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        self._stub_bender(db, fake_r, monkeypatch, [])
+        built = db.build_preview_card
+
+        def build_then_filter():
+            rv = built()
+            db._clear_preview()
+            return rv
+
+        monkeypatch.setattr(db, 'build_preview_card', build_then_filter)
+        assert db.refresh_preview_card() is None
+        assert not fake_r.exists(db._key('MISC|preview-card'))
+
+    def test_fallback_card_expires(self, queue_db, monkeypatch):
+        db, fake_r = queue_db
+        monkeypatch.setattr(db, 'ensure_fill_songs', lambda: None)
+        monkeypatch.setattr(db, '_peek_next_fill_song', lambda: (None, None, None))
+
+        assert db.refresh_preview_card()['title'] == 'No songs available'
+        assert fake_r.ttl(db._key('MISC|preview-card')) > 0
+
+
+class TestCompactQueueEntries:
+    """Raw provider payloads live in TRACK-PAYLOAD|{uri}, not in QUEUE hashes."""
+
+    def test_payload_stored_once_outside_queue_hash(self, queue_db):
+        from db import DB
+
+        db, fake_r = queue_db
+        other = DB(nest_id="other", init_history_to_redis=False, redis_client=fake_r)
+        other._msg = lambda *args, **kwargs: None
+        payload = {'name': 'Song 1', 'available_markets': ['US', 'GB']}
+
+        ids = [d._add_song('a@example.com', dict(_song_payload(1), data=payload), False)
+               for d in (db, db, other)]
+
+        assert 'data' not in fake_r.hgetall(db._key('QUEUE|{0}'.format(ids[0])))
+        assert 'data' not in db.get_song_from_queue(ids[0])
+        assert list(fake_r.scan_iter(match='TRACK-PAYLOAD|*')) == ['TRACK-PAYLOAD|spotify:track:1']
+        assert other.get_track_payload('spotify', 'spotify:track:1') == payload
+
+    def test_now_playing_notification_gets_the_payload(self, queue_db, monkeypatch):
+        import slack
+        from config import CONF
+
+        db, fake_r = queue_db
+        posts = []
+        monkeypatch.setattr(CONF, 'SLACK_WEBHOOK_URL', 'https://hooks.example.com/x', raising=False)
+        monkeypatch.setattr(slack, 'post', lambda text, blocks=None: posts.append(blocks[0]))
+        payload = {'artists': [{'external_urls': {'spotify': 'https://open.spotify.com/artist/a1'}}]}
+        db._add_song('a@example.com', dict(_song_payload(1), data=payload), False)
+        # Expired from TRACK-PAYLOAD, still in the catalog
+        db._add_song('a@example.com', _song_payload(2), False)
+        db._catalog.put('spotify:track:2', payload)
+
+        first, second = db.pop_next(), db.pop_next()
+        assert 'data' not in first and 'data' not in second
+        assert len(posts) == 2
+        for block in posts:
+            assert '<https://open.spotify.com/artist/a1|Tester>' in block['text']['text']
+
+    def test_non_spotify_uri(self):
+        from db import _track_uri
+
+        assert _track_uri('youtube', 'abc') == 'youtube:abc'
+        assert _track_uri('soundcloud', 123) == 'soundcloud:123'
+        assert _track_uri('spotify', 'spotify:track:x') == 'spotify:track:x'
+
+    def test_migration_moves_inline_payloads(self, queue_db):
+        import json
+        import migrate_queue_payloads
+
+        db, fake_r = queue_db
+        payload = {'name': 'Song 1', 'available_markets': ['US'] * 50}
+        for sid in ('1', '2'):
+            fake_r.hset(db._key('QUEUE|' + sid), mapping=dict(
+                src='spotify', trackid='spotify:track:1', title='Song 1',
+                data=json.dumps(payload)))
+        fake_r.hset(db._key('QUEUE|3'), mapping=dict(
+            src='soundcloud', trackid='9', title='SC', data='<Response [200]>'))
+
+        dry = migrate_queue_payloads.migrate(redis_client=fake_r, dry_run=True)
+        assert dry['compacted'] == 3
+        assert fake_r.hexists(db._key('QUEUE|1'), 'data')
+
+        stats = migrate_queue_payloads.migrate(redis_client=fake_r, dry_run=False)
+        assert (stats['compacted'], stats['payloads'], stats['skipped']) == (3, 1, 1)
+        assert stats['bytes_after'] < stats['bytes_before']
+        assert not any(fake_r.hexists(db._key('QUEUE|' + sid), 'data') for sid in '123')
+        assert db.get_track_payload('spotify', 'spotify:track:1') == payload
+
+
+class TestCatalog:
+    """One global metadata catalog serves every nest."""
+
+    def test_track_fetched_once_across_nests(self, queue_db, monkeypatch):
+        from db import DB
+
+        db, fake_r = queue_db
+        other = DB(nest_id="other", init_history_to_redis=False, redis_client=fake_r)
+        fetches = []
+
+        def fetch(trackid, cache=True):
+            fetches.append(trackid)
+            return {'name': 'Song', 'duration_ms': 61000, 'available_markets': ['US'],
+                    'artists': [{'id': 'a1', 'name': 'Artist'}], 'album': {'images': []}}
+
+        monkeypatch.setattr(DB, '_fetch_spotify_track', lambda self, *a, **k: fetch(*a, **k))
+
+        song = db.get_spotify_song('spotify:track:t1', scrobble=True)
+        info = other.get_fill_info('spotify:track:t1')
+
+        assert fetches == ['spotify:track:t1']
+        assert (song['title'], info['title'], info['duration']) == ('Song', 'Song', 61)
+        assert 'data' not in info
+        assert 'available_markets' not in db._catalog.get('spotify:track:t1')
+        assert db._catalog.stats()['hits'] == 2
+
+    def test_seed_info_shares_track_and_artist(self, queue_db, monkeypatch):
+        from unittest.mock import MagicMock
+        import db as db_mod
+        from db import DB
+        from nests import NestManager
+
+        db, fake_r = queue_db
+        mock_spotify = MagicMock()
+        mock_spotify.track.return_value = {
+            'artists': [{'id': 'a1', 'name': 'Artist'}], 'album': {'id': 'al1'}}
+        mock_spotify.artist.return_value = {'genres': ['funk']}
+        monkeypatch.setattr(db_mod, 'spotify_client', mock_spotify)
+        monkeypatch.setattr(db, '_resolve_seed_uri', lambda: 'spotify:track:seed')
+
+        assert NestManager(redis_client=fake_r)._resolve_track_seed(
+            'spotify:track:seed') == ('spotify:track:seed', 'funk')
+        other = DB(nest_id="other", init_history_to_redis=False, redis_client=fake_r)
+        monkeypatch.setattr(other, '_resolve_seed_uri', lambda: 'spotify:track:seed')
+        assert db._get_seed_info()['genres'] == ['funk']
+        assert other._get_seed_info()['artist_id'] == 'a1'
+
+        assert mock_spotify.track.call_count == 1
+        assert mock_spotify.artist.call_count == 1
+
+    def test_lru_eviction_under_budget(self, queue_db):
+        from catalog import Catalog
+
+        _, fake_r = queue_db
+        cat = Catalog(fake_r, max_bytes=350)  # room for three entries
+        for i in range(3):
+            cat.put('spotify:artist:%d' % i, {'name': 'x' * 100})
+        cat.get('spotify:artist:0')  # most recently used now
+        cat.put('spotify:artist:3', {'name': 'x' * 100})
+
+        assert cat.get('spotify:artist:1') is None
+        assert cat.get('spotify:artist:0') is not None
+        assert cat.stats()['bytes'] <= 350
+        assert cat.stats()['evictions'] == 1
+
+
+class TestBulkAdd:
+    """add_songs() batches metadata fetches and queues everything in one call."""
+
+    @staticmethod
+    def _track(tid):
+        return {'uri': 'spotify:track:' + tid, 'name': 'Song ' + tid, 'duration_ms': 60000,
+                'artists': [{'id': 'a1', 'name': 'Artist'}], 'album': {'images': []}}
+
+    def test_bulk_matches_one_by_one(self, queue_db):
+        from db import DB
+        import fakeredis
+
+        db, _ = queue_db
+        other = DB(nest_id="main", init_history_to_redis=False,
+                   redis_client=fakeredis.FakeRedis(decode_responses=True))
+        other._msg = lambda *args, **kwargs: None
+        for target in (db, other):
+            for i in range(3):
+                target._add_song('a@example.com', _song_payload(i), False)
+                target._add_song('b@example.com', _song_payload(10 + i), False)
+
+        db._add_songs('c@example.com', [_song_payload(20 + i) for i in range(4)])
+        for i in range(4):
+            other._add_song('c@example.com', _song_payload(20 + i), False)
+
+        def order(target):
+            return [s['trackid'] for s in target.get_queue_snapshot()]
+        assert order(db) == order(other)
+
+    def test_one_script_call_and_one_update(self, queue_db):
+        db, fake_r = queue_db
+        db._add_song('a@example.com', _song_payload(0), False)
+        db._add_songs('a@example.com', [_song_payload(1)])  # load the script
+        messages = []
+        db._msg = messages.append
+
+        calls = []
+        original = fake_r.execute_command
+
+        def counting(*args, **kwargs):
+            calls.append(args[0])
+            return original(*args, **kwargs)
+
+        version = db.get_queue_version()
+        fake_r.execute_command = counting
+        ids = db._add_songs('b@example.com', [_song_payload(i) for i in range(2, 7)])
+        fake_r.execute_command = original
+
+        assert calls == ['EVALSHA'] and messages == ['playlist_update']
+        assert len(ids) == 5 and db.get_queue_version() == version + 1
+
+    def test_depth_limit_keeps_what_fits(self, queue_db, monkeypatch):
+        db, _ = queue_db
+        monkeypatch.setattr(db, '_max_queue_depth', lambda: 3)
+        db._add_song('a@example.com', _song_payload(0), False)
+
+        assert len(db._add_songs('b@example.com', [_song_payload(i) for i in range(1, 6)])) == 2
+        with pytest.raises(RuntimeError, match="Queue is full"):
+            db._add_songs('b@example.com', [_song_payload(9)])
+
+    def test_spotify_tracks_fetched_in_batches(self, queue_db, monkeypatch):
+        import db as db_mod
+        from unittest.mock import MagicMock
+
+        db, fake_r = queue_db
+        db._catalog.put('spotify:track:t0', self._track('t0'))
+        calls = []
+
+        def get(url, params=None, **kwargs):
+            ids = params['ids'].split(',')
+            calls.append(ids)
+            return MagicMock(status_code=200, json=lambda: {'tracks': [self._track(i) for i in ids]})
+
+        monkeypatch.setattr(db_mod.requests, 'get', get)
+        monkeypatch.setattr(db_mod.auth, 'get_access_token', lambda *a, **k: 'token')
+        monkeypatch.setattr(db_mod, 'is_spotify_rate_limited', lambda: False)
+        monkeypatch.setattr(db, '_catalog_album_track_uris',
+                            lambda album_id: ['spotify:track:t%d' % i for i in range(60, 70)])
+
+        uris = ['spotify:track:t%d' % i for i in range(60)] + ['spotify:album:al1']
+        ids = db.add_songs('a@example.com', uris, limit=70)
+
+        assert [len(c) for c in calls] == [50, 19]
+        assert len(ids) == 70
+        assert db.get_song_from_queue(ids[0])['title'] == 'Song t0'
+        assert fake_r.exists(db._key('FILTER|spotify:track:t69'))